@@ -1,97 +1,802 @@
 # app.py 
 # the http server written in python
 import json
+import os
+import sys
+import time
+import asyncio
+import traceback
+import contextlib
+from datetime import datetime, timezone
 import h5py
 import numpy as np
 import argparse
 from aiohttp import web, WSMsgType
 
+# the server must quantise referenced vertices exactly as the blocks were at ingest
+from ingest.modules.quantise import QUANT_MAX, quantise_positions
+
 
 STATIC_PATH = "./static/"
 
-# returns the buffer for a given mesh block request
-def get_mesh_block_resp(request):
-    # start_time = time.time()
+# size of a node in the tree and treelet buffers
+NODE_BYTE_LENGTH = 5 * 4
+
+# name of a group holding the data of a time step, the first time step uses the plain name
+def get_time_step_name(name, t_index):
+    if t_index == 0: return name
+    return "%s_T%i" % (name, t_index)
+
+
+# name of the group holding the values of a time step within a zone
+def get_flow_solution_name(t_index):
+    return get_time_step_name("FlowSolution", t_index)
+
+
+# the time steps requested, either a single index or a [start, end) range
+# defaults to the first time step
+def get_request_time_steps(request):
+    time = request.get("time", 0)
+    if isinstance(time, list):
+        return list(range(time[0], time[1]))
+    
+    return [time]
+
+
+# request metrics ==============================
+
+# histogram bucket upper bounds
+TIME_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+BYTE_BUCKETS = [2**i for i in range(10, 31, 2)]
+BLOCK_BUCKETS = [2**i for i in range(0, 11)]
+
+
+# a prometheus histogram, with a series for each combination of label values
+class Histogram:
+    def __init__(self, name, description, buckets, label_names=("mode",)):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.label_names = label_names
+        # label values -> [count of each bucket, sum, count]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        if label_values not in self.series:
+            self.series[label_values] = [[0] * len(self.buckets), 0, 0]
+        series = self.series[label_values]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound: series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def format(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s histogram" % self.name]
+        for label_values, (bucket_counts, total, count) in sorted(self.series.items()):
+            labels = format_labels(self.label_names, label_values)
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append('%s_bucket{%s} %i' % (self.name, format_labels(self.label_names + ("le",), label_values + (bound,)), bucket_count))
+            lines.append('%s_bucket{%s} %i' % (self.name, format_labels(self.label_names + ("le",), label_values + ("+Inf",)), count))
+            lines.append("%s_sum{%s} %s" % (self.name, labels, repr(float(total))))
+            lines.append("%s_count{%s} %i" % (self.name, labels, count))
+        return lines
+
+
+# a prometheus counter, with a series for each combination of label values
+class Counter:
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.series = {}
+
+    def inc(self, *label_values):
+        self.series[label_values] = self.series.get(label_values, 0) + 1
+
+    def format(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s counter" % self.name]
+        for label_values, count in sorted(self.series.items()):
+            lines.append("%s{%s} %i" % (self.name, format_labels(self.label_names, label_values), count))
+        return lines
+
+
+def format_labels(label_names, label_values):
+    return ",".join('%s="%s"' % (name, value) for name, value in zip(label_names, label_values))
+
+
+# the metrics of the requests handled since the server started, exposed at /metrics
+# > queue wait is from a message being received to it being handled, this includes the time the server spends
+#   handling earlier requests as messages are handled one at a time
+# > read is the time spent opening the file and reading from it, assembly is the rest of creating the response
+REQUEST_METRICS = {
+    "requests": Counter("volvis_requests_total", "Websocket requests handled", ("mode", "status")),
+    "blocks": Histogram("volvis_request_blocks", "Blocks requested per request", BLOCK_BUCKETS),
+    "bytes": Histogram("volvis_response_bytes", "Bytes sent per response", BYTE_BUCKETS),
+    "queue_wait": Histogram("volvis_request_queue_wait_seconds", "Time requests wait to be handled", TIME_BUCKETS),
+    "read": Histogram("volvis_request_read_seconds", "Time spent reading block mesh files per request", TIME_BUCKETS),
+    "assembly": Histogram("volvis_request_assembly_seconds", "Time spent assembling responses", TIME_BUCKETS),
+    "send": Histogram("volvis_request_send_seconds", "Time spent sending responses", TIME_BUCKETS),
+    "duration": Histogram("volvis_request_duration_seconds", "Time from receiving requests to sending responses", TIME_BUCKETS),
+    "cache": Counter("volvis_cache_lookups_total", "Lookups of the cached file indices", ("cache", "result")),
+}
+
+
+def count_cache_lookup(cache_name, hit):
+    REQUEST_METRICS["cache"].inc(cache_name, "hit" if hit else "miss")
+
+
+# the prometheus text format of the request metrics
+def get_metrics_text():
+    lines = []
+    for metric in REQUEST_METRICS.values():
+        lines += metric.format()
+    lines.append("# HELP volvis_cache_entries Entries held in the cached file indices")
+    lines.append("# TYPE volvis_cache_entries gauge")
+    lines.append('volvis_cache_entries{cache="packed_index"} %i' % len(packed_index_cache))
+    lines.append('volvis_cache_entries{cache="block_index"} %i' % len(block_index_cache))
+    lines.append('volvis_cache_entries{cache="shard_manifest"} %i' % len(shard_manifest_cache))
+    return "\n".join(lines) + "\n"
+
+
+# records the stats of a handled request in the metrics and access log
+def record_request(stats, access_log):
+    mode = stats["mode"]
+    REQUEST_METRICS["requests"].inc(mode, stats["status"])
+    REQUEST_METRICS["blocks"].observe(stats["blocks"], mode)
+    REQUEST_METRICS["bytes"].observe(stats["bytes"], mode)
+    for key in ["queue_wait", "read", "assembly", "send", "duration"]:
+        REQUEST_METRICS[key].observe(stats[key], mode)
+
+    if access_log is not None:
+        print(json.dumps(stats), file=access_log, flush=True)
+
+
+# the block offsets of packed block mesh files, keyed by path, group and modification time
+packed_index_cache = {}
+
+# the groups of packed blocks, leaves and then the simplified meshes of internal nodes
+PACKED_GROUP_NAMES = ["PackedBlocks", "PackedLodBlocks"]
+
+
+# reads the index of a packed block mesh file, this is the same for every request so is only read once
+def get_packed_index(path, packed_grp):
+    key = (path, packed_grp.name, os.path.getmtime(path))
+    count_cache_lookup("packed_index", key in packed_index_cache)
+    if key not in packed_index_cache:
+        packed_index_cache[key] = {
+            "block_nodes": packed_grp["BlockNodes/ data"][()],
+            "vert_offsets": packed_grp["VertOffsets/ data"][()],
+            "conn_offsets": packed_grp["ConnOffsets/ data"][()],
+        }
+        # blocks written with shared vertices also reference the vertices of other blocks
+        if "RefOffsets" in packed_grp:
+            packed_index_cache[key]["ref_offsets"] = packed_grp["RefOffsets/ data"][()]
+    
+    return packed_index_cache[key]
+
+
+# the block index of block mesh files, keyed by path and modification time
+block_index_cache = {}
+
+
+# reads the counts of every block from the block index, this is the same for every request so is only read once
+# the value ranges change when scalars are updated so are read from the file each time
+def get_block_index(path, index_grp):
+    key = (path, os.path.getmtime(path))
+    count_cache_lookup("block_index", key in block_index_cache)
+    if key not in block_index_cache:
+        block_index_cache[key] = {
+            "block_nodes": index_grp["BlockNodes/ data"][()],
+            "vert_counts": index_grp["VertCounts/ data"][()],
+            "cell_counts": index_grp["CellCounts/ data"][()],
+        }
+        if "VarintByteCounts" in index_grp:
+            block_index_cache[key]["varint_byte_counts"] = index_grp["VarintByteCounts/ data"][()]
+    
+    return block_index_cache[key]
+
+
+# finds the rows of the given blocks within the block index
+def get_block_index_rows(block_index, blocks):
+    block_nodes = block_index["block_nodes"]
+    rows = np.searchsorted(block_nodes, blocks)
+    if np.any(rows >= len(block_nodes)) or np.any(block_nodes[np.minimum(rows, len(block_nodes) - 1)] != blocks):
+        raise KeyError("not all blocks are stored")
+    
+    return rows
+
+
+# the values or [min, max] intervals of each scalar that the blocks must be able to contain, if any
+def get_request_iso(request):
+    return request.get("iso")
+
+
+# finds which of the blocks have values in every scalar's interval of the iso request, in any of the time steps
+# the ranges come from the block index, blocks of files without one are always included
+def get_block_iso_mask(path, base_grp, blocks, iso, time_steps):
+    mask = np.ones(len(blocks), dtype=bool)
+    if "BlockIndex" not in base_grp: return mask
+
+    index_grp = base_grp["BlockIndex"]
+    rows = get_block_index_rows(get_block_index(path, index_grp), blocks)
+
+    for name, interval in iso.items():
+        low, high = interval if isinstance(interval, list) else (interval, interval)
+        contains = np.zeros(len(blocks), dtype=bool)
+        for t_index in time_steps:
+            ranges = index_grp[get_time_step_name("FlowSolutionRanges", t_index)]["%s/ data" % name][()][rows]
+            contains |= (ranges[:, 0] <= high) & (ranges[:, 1] >= low)
+        mask &= contains
+
+    return mask
+
+
+# finds the row of the given block within the packed datasets
+def get_packed_block_row(packed_index, block_index):
+    block_nodes = packed_index["block_nodes"]
+    i = np.searchsorted(block_nodes, block_index)
+    if i >= len(block_nodes) or block_nodes[i] != block_index:
+        raise KeyError("block %i is not a leaf" % block_index)
+    
+    return i
+
+
+# finds the packed group and index that hold the given block
+def find_packed_block(packed_grps, block_index):
+    for packed_grp, packed_index in packed_grps:
+        block_nodes = packed_index["block_nodes"]
+        i = np.searchsorted(block_nodes, block_index)
+        if i < len(block_nodes) and block_nodes[i] == block_index:
+            return packed_grp, packed_index
+    
+    raise KeyError("block %i is not stored" % block_index)
+
+
+# the shards of sharded block mesh files, keyed by path and modification time
+shard_manifest_cache = {}
+
+
+# reads the start and path of each shard from the manifest of a sharded block mesh file
+# each shard holds the blocks from its start up to the next shard's, as ingest/generate_block_mesh.py writes them
+def get_shard_manifest(path, manifest_grp):
+    key = (path, os.path.getmtime(path))
+    count_cache_lookup("shard_manifest", key in shard_manifest_cache)
+    if key not in shard_manifest_cache:
+        shard_names = manifest_grp["ShardFiles/ data"][()].tobytes().decode().split("\n")
+        shard_manifest_cache[key] = {
+            "starts": manifest_grp["ShardStarts/ data"][()],
+            "paths": [os.path.join(os.path.dirname(path), name) for name in shard_names],
+        }
+    
+    return shard_manifest_cache[key]
+
+
+# finds the shard that holds the given block
+def get_block_shard(manifest, block_index):
+    return int(np.searchsorted(manifest["starts"], block_index, "right")) - 1
+
+
+# finds the slices of the packed datasets holding the block at the given row
+def get_packed_block_slices(packed_index, i):
+    vert_offsets = packed_index["vert_offsets"]
+    conn_offsets = packed_index["conn_offsets"]
+    return slice(vert_offsets[i], vert_offsets[i + 1]), slice(conn_offsets[i], conn_offsets[i + 1])
+
+
+# whether the precomputed treelets of the blocks are requested
+def get_request_treelets(request):
+    return request.get("treelets", False)
+
+
+# whether the vertex references of blocks with shared vertices are sent as-is for the client to resolve
+# by default the server resolves them and the blocks are sent with all of their vertices
+def get_request_raw_refs(request):
+    return request.get("sharedVerts", "resolve") == "raw"
+
+
+# the encoding of the geometry requested
+# > "float" full precision positions and 32 bit connectivity
+# > "quantised" 16 bit positions within each block's box, and 16 bit connectivity if the blocks are small enough
+# > "varint" 16 bit positions and delta coded varint connectivity
+def get_request_encoding(request):
+    return request.get("encoding", "float")
+
+
+# reads the geometry of a block from its quantised geometry group
+# the positions are given as 16 bit integers, which are sliced as bytes from packed groups
+def read_quantised_geometry(quant_grp, request, box_slice=slice(None), coord_slice=slice(None), con_slice=None, varint_slice=slice(None)):
+    geometry = {
+        "box": quant_grp["QuantBox/ data"][box_slice],
+        "coords": np.reshape(quant_grp["QuantCoordinates/ data"][coord_slice].view(np.uint16), (-1, 3)),
+    }
+    if get_request_encoding(request) == "varint":
+        geometry["con_varint"] = quant_grp["ConnectivityVarint/ data"][varint_slice]
+    else:
+        geometry["con"] = quant_grp.parent["GridElements/ElementConnectivity/ data"][con_slice or slice(None)]
+    
+    return geometry
+
 
-    block_count = len(request["blocks"])
+# reads the geometry, treelet, scalars and vertex references of a block stored as its own zone
+# the references are None if the block stores all of its vertices
+def read_zone_block(base_grp, block_index, request, time_steps):
+    block_grp = base_grp["Zone%i" % block_index]
+    geometry = None
+    if request["geometry"] and get_request_encoding(request) != "float":
+        geometry = read_quantised_geometry(block_grp["QuantisedGeometry"], request)
+    elif request["geometry"]:
+        coord_grp = block_grp["GridCoordinates"]
+        coord_arr = np.array([
+            coord_grp["CoordinateX/ data"], 
+            coord_grp["CoordinateY/ data"], 
+            coord_grp["CoordinateZ/ data"]
+        ]).transpose()
+        con_arr = block_grp["GridElements/ElementConnectivity/ data"][()]
+        geometry = {"coords": coord_arr, "con": con_arr}
 
-    # get the h5py file object
-    with h5py.File(STATIC_PATH + request["path"]) as file:
+    # the simplified meshes of internal nodes have no treelets
+    treelet = None
+    if get_request_treelets(request) and "Treelet" in block_grp:
+        treelet_grp = block_grp["Treelet"]
+        treelet = (
+            treelet_grp["TreeletNodes/ data"][()],
+            treelet_grp["TreeletRootSplit/ data"][()],
+            treelet_grp["TreeletCells/ data"][()]
+        )
+    
+    scalars = {}
+    for t_index in time_steps:
+        sol_grp = block_grp[get_flow_solution_name(t_index)]
+        for name in request["scalars"]:
+            scalars[(t_index, name)] = sol_grp["%s/ data" % name][()]
+
+    refs = None
+    if "VertexRefs" in block_grp:
+        refs = np.reshape(block_grp["VertexRefs/ data"][()], (-1, 2))
+
+    return geometry, treelet, scalars, refs
+
+
+# reads the geometry, treelet, scalars and vertex references of a block stored as a slice of the packed datasets
+def read_packed_block(packed_grp, packed_index, block_index, request, time_steps):
+    i = get_packed_block_row(packed_index, block_index)
+    vert_slice, conn_slice = get_packed_block_slices(packed_index, i)
+    geometry = None
+    if request["geometry"] and get_request_encoding(request) != "float":
+        quant_grp = packed_grp["QuantisedGeometry"]
+        varint_offsets = quant_grp["VarintOffsets/ data"][i : i + 2]
+        geometry = read_quantised_geometry(
+            quant_grp,
+            request,
+            slice(6 * i, 6 * (i + 1)),
+            slice(6 * vert_slice.start, 6 * vert_slice.stop),
+            conn_slice,
+            slice(varint_offsets[0], varint_offsets[1])
+        )
+    elif request["geometry"]:
+        coord_grp = packed_grp["GridCoordinates"]
+        coord_arr = np.array([
+            coord_grp["CoordinateX/ data"][vert_slice], 
+            coord_grp["CoordinateY/ data"][vert_slice], 
+            coord_grp["CoordinateZ/ data"][vert_slice]
+        ]).transpose()
+        con_arr = packed_grp["GridElements/ElementConnectivity/ data"][conn_slice]
+        geometry = {"coords": coord_arr, "con": con_arr}
+
+    # the simplified meshes of internal nodes, in PackedLodBlocks, have no treelets
+    treelet = None
+    if get_request_treelets(request) and "Treelet" in packed_grp:
+        # every treelet has the same number of nodes
+        treelet_grp = packed_grp["Treelet"]
+        node_bytes = len(treelet_grp["TreeletNodes/ data"]) // len(packed_index["block_nodes"])
+        cell_offsets = treelet_grp["TreeletCellOffsets/ data"][i : i + 2]
+        treelet = (
+            treelet_grp["TreeletNodes/ data"][i * node_bytes : (i + 1) * node_bytes],
+            treelet_grp["TreeletRootSplit/ data"][i : i + 1],
+            treelet_grp["TreeletCells/ data"][cell_offsets[0] : cell_offsets[1]]
+        )
+    
+    scalars = {}
+    for t_index in time_steps:
+        sol_grp = packed_grp[get_flow_solution_name(t_index)]
+        for name in request["scalars"]:
+            scalars[(t_index, name)] = sol_grp["%s/ data" % name][vert_slice]
+
+    refs = None
+    if "ref_offsets" in packed_index:
+        ref_offsets = packed_index["ref_offsets"]
+        refs = np.reshape(packed_grp["VertexRefs/ data"][2 * ref_offsets[i] : 2 * ref_offsets[i + 1]], (-1, 2))
+
+    return geometry, treelet, scalars, refs
+
+
+# appends the referenced vertices to a block's own, read from the blocks that own them
+# read_owner returns the full precision geometry and scalars of a block, owners are only read once per request
+# the referenced positions are quantised within the block's box if its geometry is quantised
+def resolve_block_refs(geometry, scalars, refs, read_owner, owner_cache):
+    ref_coords = np.empty((len(refs), 3), dtype=np.float32)
+    ref_scalars = {key: np.empty(len(refs), dtype=np.float32) for key in scalars}
+
+    for owner in np.unique(refs[:, 0]):
+        if owner not in owner_cache:
+            owner_cache[owner] = read_owner(int(owner))
+        owner_geometry, owner_scalars = owner_cache[owner]
+
+        rows = refs[:, 0] == owner
+        owner_verts = refs[rows, 1]
+        if geometry is not None:
+            ref_coords[rows] = owner_geometry["coords"][owner_verts]
+        for key in scalars:
+            ref_scalars[key][rows] = owner_scalars[key][owner_verts]
+
+    if geometry is not None:
+        if "box" in geometry:
+            ref_coords = quantise_positions(ref_coords, geometry["box"])
+        geometry = {**geometry, "coords": np.concatenate([geometry["coords"], ref_coords])}
+    scalars = {key: np.concatenate([arr, ref_scalars[key]]) for key, arr in scalars.items()}
+
+    return geometry, scalars
+
+
+# creates the function that reads a block from whichever layout the file uses
+# blocks are either in their own zones or slices of the packed datasets, or in the shards listed by a manifest
+# > shards are opened the first time they are read from and stay open until shard_files is closed
+def create_block_reader(path, base_grp, time_steps, read_stats, shard_files):
+    if "ShardManifest" in base_grp:
+        manifest = get_shard_manifest(path, base_grp["ShardManifest"])
+        shard_readers = {}
+
+        def read_shard_block(block_index, block_request):
+            shard = get_block_shard(manifest, block_index)
+            if shard not in shard_readers:
+                read_start = time.perf_counter()
+                shard_path = manifest["paths"][shard]
+                shard_file = shard_files.enter_context(h5py.File(shard_path, "r"))
+                shard_readers[shard] = create_block_reader(shard_path, shard_file["Base"], time_steps, read_stats, shard_files)
+                read_stats["read"] += time.perf_counter() - read_start
+            
+            return shard_readers[shard](block_index, block_request)
+        
+        return read_shard_block
+
+    packed_grps = [
+        (base_grp[name], get_packed_index(path, base_grp[name])) 
+        for name in PACKED_GROUP_NAMES if name in base_grp
+    ]
+
+    def read_block(block_index, block_request):
+        read_start = time.perf_counter()
+        try:
+            if len(packed_grps) > 0:
+                packed_grp, packed_index = find_packed_block(packed_grps, block_index)
+                return read_packed_block(packed_grp, packed_index, block_index, block_request, time_steps)
+            
+            return read_zone_block(base_grp, block_index, block_request, time_steps)
+        finally:
+            read_stats["read"] += time.perf_counter() - read_start
+    
+    return read_block
+
+
+# pads a section of the response to a multiple of 4 bytes
+def pad_to_word(section):
+    return section + bytes(-len(section) % 4)
+
+
+# returns the buffer for a given mesh block request
+# the response contains the geometry and treelets (if requested) followed by the scalars of each time step in turn
+# if the raw vertex references are requested, the geometry is followed by the owned and referenced vertex
+# counts of each block and their references, and the positions and scalars only hold the owned vertices
+# compact geometry encodings start with the box of each block and each of their sections is padded to 4 bytes
+# if an iso request is given, the response starts with a flag for each block that is 0 if it can't contain
+# the iso values and is left out of the rest of the response
+# the time spent reading the file is added to stats["read"] if stats are given
+def get_mesh_block_resp(request, stats=None):
+    time_steps = get_request_time_steps(request)
+    path = STATIC_PATH + request["path"]
+    read_stats = stats if stats is not None else {"read": 0}
+
+    # get the h5py file object, the shards of sharded files are opened as they are read from
+    read_start = time.perf_counter()
+    with h5py.File(path) as file, contextlib.ExitStack() as shard_files:
         base_grp = file["Base"]
+
+        blocks = request["blocks"]
+        iso = get_request_iso(request)
+        if iso is not None:
+            iso_mask = get_block_iso_mask(path, base_grp, blocks, iso, time_steps)
+            blocks = [block_index for block_index, included in zip(blocks, iso_mask) if included]
+        block_count = len(blocks)
         # load info about max verts and cells per mesh block
         (max_cells, max_verts) = base_grp["MaxPrimitives/ data"]
 
+        read_block = create_block_reader(path, base_grp, time_steps, read_stats, shard_files)
+        read_stats["read"] += time.perf_counter() - read_start
+
+        # the owned vertices of the blocks that others reference
+        owner_request = {"geometry": request["geometry"], "scalars": request["scalars"]}
+        def read_owner(owner_index):
+            geometry, _, scalars, _ = read_block(owner_index, owner_request)
+            return geometry, scalars
+        owner_cache = {}
+
+        raw_refs = get_request_raw_refs(request)
+        encoding = get_request_encoding(request)
+
         # create the buffers to hold all the response data
-        if request["geometry"]:
+        if request["geometry"] and encoding != "float":
+            # the box each block's positions are quantised within
+            block_box_buff = np.empty((block_count, 6), dtype=np.float32)
+            # quantised vert position information
+            block_vert_pos_buff = np.empty((block_count, max_verts, 3), dtype=np.uint16)
+            if encoding == "varint":
+                # the byte length of each block's varint connectivity, followed by the bytes
+                block_varint_len_buff = np.empty(block_count, dtype=np.uint32)
+                block_varint_arrs = []
+            else:
+                # cell connectivity information, 1-based indices fit in 16 bits if the blocks are small enough
+                con_dtype = np.uint16 if max_verts <= QUANT_MAX else np.uint32
+                block_cell_con_buff = np.empty((block_count, 4 * max_cells), dtype=con_dtype)
+        elif request["geometry"]:
             # vert position information
             block_vert_pos_buff = np.empty((block_count, max_verts, 3), dtype=np.float32)
             # cell connectivity information
             block_cell_con_buff = np.empty((block_count, 4 * max_cells), dtype=np.uint32)
+
+        if raw_refs and request["geometry"]:
+            # owned and referenced vertex counts, and the (owner block, owner vertex) of each reference
+            block_ref_count_buff = np.empty((block_count, 2), dtype=np.uint32)
+            block_ref_buff = np.empty((block_count, max_verts, 2), dtype=np.uint32)
+
+        if get_request_treelets(request):
+            (treelet_depth, max_treelet_cells) = base_grp["TreeletInfo/ data"]
+            # treelet nodes as bytes, the split of each treelet root and the cells of the treelet leaves
+            treelet_node_buff = np.zeros((block_count, (2**(treelet_depth + 1) - 2) * NODE_BYTE_LENGTH), dtype=np.uint8)
+            # zeroed so blocks without treelets are sent an empty one
+            treelet_split_buff = np.zeros((block_count, 1), dtype=np.float32)
+            treelet_cells_buff = np.zeros((block_count, max_treelet_cells), dtype=np.uint32)
         
         scalar_buffs = {}
-        for name in request["scalars"]:
-            scalar_buffs[name] = np.empty((block_count, max_verts), dtype=np.float32)
+        for t_index in time_steps:
+            for name in request["scalars"]:
+                scalar_buffs[(t_index, name)] = np.empty((block_count, max_verts), dtype=np.float32)
 
         # iterate through all the blocks requested
-        for i, block_index in enumerate(request["blocks"]):
-            # get the zone node for this block
-            block_grp = base_grp["Zone%i" % block_index]
+        for i, block_index in enumerate(blocks):
+            geometry, treelet, scalars, refs = read_block(block_index, request)
+
+            if refs is None:
+                refs = np.empty((0, 2), dtype=np.uint32)
+            elif not raw_refs:
+                geometry, scalars = resolve_block_refs(geometry, scalars, refs, read_owner, owner_cache)
+
             if request["geometry"]:
                 # write geometry information
-                coord_grp = block_grp["GridCoordinates"]
-                coord_arr = np.array([
-                    coord_grp["CoordinateX/ data"], 
-                    coord_grp["CoordinateY/ data"], 
-                    coord_grp["CoordinateZ/ data"]
-                ]).transpose()
+                coord_arr = geometry["coords"]
                 block_vert_pos_buff[i][:len(coord_arr)] = coord_arr 
-
-                con_arr = block_grp["GridElements/ElementConnectivity/ data"]
-                block_cell_con_buff[i][:len(con_arr)] = con_arr
+                if "box" in geometry:
+                    block_box_buff[i] = geometry["box"]
+                if "con_varint" in geometry:
+                    block_varint_len_buff[i] = len(geometry["con_varint"])
+                    block_varint_arrs.append(geometry["con_varint"])
+                else:
+                    con_arr = geometry["con"]
+                    block_cell_con_buff[i][:len(con_arr)] = con_arr
+            if raw_refs and request["geometry"]:
+                # write vertex reference information
+                block_ref_count_buff[i] = (len(geometry["coords"]), len(refs))
+                block_ref_buff[i][:len(refs)] = refs
+            if get_request_treelets(request) and treelet is not None:
+                # write treelet information
+                nodes_arr, split_arr, cells_arr = treelet
+                treelet_node_buff[i] = nodes_arr
+                treelet_split_buff[i] = split_arr
+                treelet_cells_buff[i][:len(cells_arr)] = cells_arr
             # write scalar data
-            for j, name in enumerate(request["scalars"]):
-                scal_arr = block_grp["FlowSolution/%s/ data" % name]
-                scalar_buffs[name][i][:len(scal_arr)] = scal_arr
+            for key, scal_arr in scalars.items():
+                scalar_buffs[key][i][:len(scal_arr)] = scal_arr
         
         
         # combine buffers into one response
         resp = bytes()
+
+        if iso is not None:
+            resp += iso_mask.astype(np.uint32).tobytes()
         
-        if request["geometry"]:
+        if request["geometry"] and encoding != "float":
+            # sections are padded to 4 bytes so the client can view those that follow as 32 bit arrays
+            resp += block_box_buff.data
+            resp += pad_to_word(block_vert_pos_buff.tobytes())
+            if encoding == "varint":
+                resp += block_varint_len_buff.data
+                resp += pad_to_word(b"".join(arr.tobytes() for arr in block_varint_arrs))
+            else:
+                resp += pad_to_word(block_cell_con_buff.tobytes())
+        elif request["geometry"]:
             resp += block_vert_pos_buff.data
             resp += block_cell_con_buff.data
+
+        if raw_refs and request["geometry"]:
+            resp += block_ref_count_buff.data
+            resp += block_ref_buff.data
+
+        if get_request_treelets(request):
+            resp += treelet_node_buff.data
+            resp += treelet_split_buff.data
+            resp += treelet_cells_buff.data
         
-        for name in request["scalars"]:
-            resp += scalar_buffs[name].data
+        for buff in scalar_buffs.values():
+            resp += buff.data
+
+        return resp
+
+
+# returns the buffer for a given iso filter request, a flag for each block that is 0 if it can't contain the iso values
+def get_iso_filter_resp(request):
+    path = STATIC_PATH + request["path"]
+    with h5py.File(path) as file:
+        iso_mask = get_block_iso_mask(path, file["Base"], request["blocks"], request["iso"], get_request_time_steps(request))
+        return iso_mask.astype(np.uint32).tobytes()
+
+
+# returns the buffer for a given mesh info request, the index of the requested blocks or all if none are given
+# the response is the block count, then for each block its node, vertex count, cell count and the unpadded
+# byte lengths of its positions, connectivity and each scalar in the requested encoding, followed by the
+# [min, max] range of each block for each scalar of each time step
+def get_mesh_info_resp(request):
+    time_steps = get_request_time_steps(request)
+    encoding = get_request_encoding(request)
+    path = STATIC_PATH + request["path"]
+
+    with h5py.File(path) as file:
+        index_grp = file["Base/BlockIndex"]
+        block_index = get_block_index(path, index_grp)
+        block_nodes = block_index["block_nodes"]
+
+        rows = np.arange(len(block_nodes))
+        if "blocks" in request:
+            rows = get_block_index_rows(block_index, request["blocks"])
+
+        vert_counts = block_index["vert_counts"][rows]
+        cell_counts = block_index["cell_counts"][rows]
 
-        # print("took " + "%.3f" % (time.time()-start_time) + "s")
+        # the byte lengths of the positions, connectivity and each scalar of the blocks
+        field_byte_buff = np.empty((len(rows), 3), dtype=np.uint32)
+        if encoding == "float":
+            field_byte_buff[:, 0] = vert_counts * 3 * 4
+            field_byte_buff[:, 1] = cell_counts * 4 * 4
+        else:
+            field_byte_buff[:, 0] = vert_counts * 3 * 2
+            if encoding == "varint":
+                field_byte_buff[:, 1] = block_index["varint_byte_counts"][rows]
+            else:
+                con_bytes = 2 if file["Base/MaxPrimitives/ data"][1] <= QUANT_MAX else 4
+                field_byte_buff[:, 1] = cell_counts * 4 * con_bytes
+        field_byte_buff[:, 2] = vert_counts * 4
+
+        resp = np.array([len(rows)], dtype=np.uint32).tobytes()
+        resp += block_nodes[rows].astype(np.uint32).tobytes()
+        resp += vert_counts.astype(np.uint32).tobytes()
+        resp += cell_counts.astype(np.uint32).tobytes()
+        resp += field_byte_buff.tobytes()
+
+        for t_index in time_steps:
+            ranges_grp = index_grp[get_time_step_name("FlowSolutionRanges", t_index)]
+            for name in request["scalars"]:
+                resp += ranges_grp["%s/ data" % name][()][rows].astype(np.float32).tobytes()
 
         return resp
 
 
+# the response function of each websocket request mode
+RESPONSE_FUNCS = {
+    "meshblocks": lambda req, stats: get_mesh_block_resp(req, stats),
+    "meshinfo": lambda req, stats: get_mesh_info_resp(req),
+    "isofilter": lambda req, stats: get_iso_filter_resp(req),
+}
+
+
+# handles a request message, returns the response and fills in the request's stats
+# only mesh block requests separate the time spent reading, the others are counted entirely as reading
+def handle_request(msg_data, stats):
+    req = json.loads(msg_data)
+    if req["mode"] not in RESPONSE_FUNCS:
+        raise ValueError("unknown request mode %s" % req["mode"])
+    # modes are only used as metric labels once known so clients can't create arbitrary series
+    stats["mode"] = req["mode"]
+    stats["path"] = req.get("path")
+    stats["blocks"] = len(req.get("blocks", []))
+
+    handle_start = time.perf_counter()
+    resp = RESPONSE_FUNCS[req["mode"]](req, stats)
+    handle_time = time.perf_counter() - handle_start
+    if req["mode"] != "meshblocks":
+        stats["read"] = handle_time
+    stats["assembly"] = handle_time - stats["read"]
+    return resp
+
+
 async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
+    access_log = request.app[ACCESS_LOG_KEY]
 
-    async for msg in ws:
-        if msg.type == WSMsgType.TEXT:
-            try:
-                req = json.loads(msg.data)
-                if req["mode"] == "meshblocks":
-                    await ws.send_bytes(get_mesh_block_resp(req))
-                else:
-                    await ws.send_bytes(bytearray(1))
-            except Exception:
-                await ws.send_bytes(bytearray(1))
-        elif msg.type == WSMsgType.ERROR:
-            print("ws connection closed with exception %s" % ws.exception())
+    # messages are timestamped as they are received so the time they wait to be handled can be measured
+    queue = asyncio.Queue()
+    async def receive_messages():
+        try:
+            async for msg in ws:
+                queue.put_nowait((time.perf_counter(), msg))
+        finally:
+            # always ends the handler's loop, even if receiving raised
+            queue.put_nowait(None)
+    receiver = asyncio.create_task(receive_messages())
+
+    try:
+        while (item := await queue.get()) is not None:
+            received_time, msg = item
+            if msg.type == WSMsgType.TEXT:
+                handle_start = time.perf_counter()
+                stats = {
+                    "time": datetime.now(timezone.utc).isoformat(),
+                    "remote": request.remote,
+                    "mode": "unknown",
+                    "path": None,
+                    "blocks": 0,
+                    "status": "ok",
+                    "bytes": 0,
+                    "queue_wait": handle_start - received_time,
+                    "read": 0,
+                    "assembly": 0,
+                    "send": 0,
+                }
+                try:
+                    resp = handle_request(msg.data, stats)
+                except Exception as e:
+                    # errors are sent as a single byte
+                    stats["status"] = "error"
+                    stats["error"] = "%s: %s" % (type(e).__name__, e)
+                    stats["assembly"] = time.perf_counter() - handle_start - stats["read"]
+                    resp = bytearray(1)
+                    traceback.print_exc()
+
+                send_start = time.perf_counter()
+                await ws.send_bytes(resp)
+                stats["send"] = time.perf_counter() - send_start
+                stats["bytes"] = len(resp)
+                stats["duration"] = time.perf_counter() - received_time
+                record_request(stats, access_log)
+            elif msg.type == WSMsgType.ERROR:
+                print("ws connection closed with exception %s" % ws.exception())
+    finally:
+        receiver.cancel()
 
     return ws
 
 
-def create_app():
+# serves the request metrics in the prometheus text format
+async def metrics_handler(request):
+    return web.Response(text=get_metrics_text(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+ACCESS_LOG_KEY = web.AppKey("access_log", object)
+
+
+# closes the access log file when the server shuts down, stdout is left open
+async def close_access_log(app):
+    access_log = app[ACCESS_LOG_KEY]
+    if access_log is not None and access_log is not sys.stdout:
+        access_log.close()
+
+
+# access_log is a file each request is logged to as a line of json, or None for no log
+# the app takes ownership of the file and closes it on cleanup
+def create_app(access_log=None):
     app = web.Application()
+    app[ACCESS_LOG_KEY] = access_log
+    app.on_cleanup.append(close_access_log)
     app.router.add_get("/data-blocks", websocket_handler)
+    app.router.add_get("/metrics", metrics_handler)
     app.router.add_static("/", STATIC_PATH)
     return app
 
@@ -99,13 +804,20 @@ def create_app():
 def main():
     parser = argparse.ArgumentParser(prog="app_asyncio")
     parser.add_argument("address", default="localhost:8080", nargs="?", help="<HOSTNAME>:<PORT> to run server at")
+    parser.add_argument("--access-log", help="file to write a json line for each websocket request to, - for stdout")
     args = vars(parser.parse_args())
 
     host = args["address"].split(":")
     HOSTNAME = host[0]
     PORT = int(host[1])
 
-    web.run_app(create_app(), host=HOSTNAME, port=PORT)
+    access_log = None
+    if args["access_log"] == "-":
+        access_log = sys.stdout
+    elif args["access_log"]:
+        access_log = open(args["access_log"], "a")
+
+    web.run_app(create_app(access_log), host=HOSTNAME, port=PORT)
 
     print("server closed")
 
@@ -0,0 +1,227 @@
+# benchmark_ingest.py
+# times each stage of the conversion on synthetic tet meshes of increasing size and reports how they scale
+# the outputs can be saved as a reference and checked against later, so changes to the stages can't
+# silently change the tree or the blocks
+
+import os
+import json
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+import generate_block_mesh as gbm
+from modules.mesh import Mesh
+from modules.tree import Tree
+from modules.leaf_mesh import generate_gather_plan, generate_corner_values, generate_node_val_ranges, split_mesh_at_leaves
+from modules.load_mesh import create_raw_tet_con
+from modules.profiler import StageProfiler
+
+
+# the stages timed, in the order they run
+STAGES = [
+    "generate_node_median",
+    "convert_to_buffers",
+    "generate_gather_plan",
+    "generate_corner_values",
+    "generate_node_val_ranges",
+    "split_mesh_at_leaves",
+    "save_block_mesh_data",
+]
+
+
+# creates a tet mesh over a grid of size^3 points
+# > grading is the ratio between the widths of the last and first cells along each axis, 1 for a uniform grid
+# > jitter moves each point randomly by up to this fraction of the local cell width
+# the values are the distance from a point off the centre, so the blocks have a spread of ranges
+def create_synthetic_mesh(size, grading=1, jitter=0, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # the cell widths grow geometrically along the axis
+    widths = grading ** (np.arange(size - 1) / max(size - 2, 1))
+    axis = np.concatenate([[0], np.cumsum(widths)]) / np.sum(widths) * (size - 1)
+    local_width = np.concatenate([widths[:1], np.minimum(widths[:-1], widths[1:]), widths[-1:]]) / np.sum(widths) * (size - 1)
+
+    grid = np.stack(np.meshgrid(axis, axis, axis, indexing="ij")[::-1], axis=-1).reshape(-1, 3)
+    grid_width = np.stack(np.meshgrid(local_width, local_width, local_width, indexing="ij")[::-1], axis=-1).reshape(-1, 3)
+
+    # keep the outer points on the boundary so the box is unchanged
+    inner = np.all((grid > 0) & (grid < size - 1), axis=1)
+    offsets = rng.uniform(-0.5, 0.5, grid.shape) * jitter * grid_width
+    positions = (grid + offsets * inner[:, None]).astype(np.float32)
+
+    centre = np.array([0.4, 0.5, 0.6]) * (size - 1)
+    values = {"Distance": np.linalg.norm(positions - centre, axis=1).astype(np.float32)}
+
+    mesh = Mesh(positions, create_raw_tet_con((size, size, size)), values)
+    mesh.calculate_box()
+    mesh.calculate_limits()
+    return mesh
+
+
+# digest of an array's contents, dtype and shape
+def hash_array(arr):
+    arr = np.ascontiguousarray(arr)
+    digest = hashlib.sha256(str((arr.dtype.str, arr.shape)).encode())
+    digest.update(arr.tobytes())
+    return digest.hexdigest()
+
+
+# digest of a list of arrays
+def hash_arrays(arrs):
+    digest = hashlib.sha256()
+    for arr in arrs:
+        digest.update(hash_array(arr).encode())
+    return digest.hexdigest()
+
+
+# digests of the tree, node values and blocks, the parts of the output the stages produce
+def get_output_digests(tree, corner_values, node_val_ranges, leaf_meshes):
+    digests = {
+        "node_buffer": hash_array(tree.node_buffer),
+        "cell_buffer": hash_array(tree.cell_buffer),
+        "block_positions": hash_arrays([m.positions for m in leaf_meshes]),
+        "block_connectivity": hash_arrays([m.connectivity for m in leaf_meshes]),
+    }
+    for name in corner_values:
+        digests["corner_values/" + name] = hash_array(corner_values[name])
+        digests["node_val_ranges/" + name] = hash_array(node_val_ranges[name])
+        digests["block_values/" + name] = hash_arrays([m.values[name] for m in leaf_meshes])
+
+    return digests
+
+
+# runs the stages on a synthetic mesh, this is run in its own process so the peak memory is of this size only
+def run_case(case):
+    mesh = create_synthetic_mesh(case["size"], case["grading"], case["jitter"], case["seed"])
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        out_name = os.path.join(out_dir, "bench")
+        profiler = StageProfiler(out_name, True)
+
+        with profiler.stage("generate_node_median"):
+            tree = Tree.generate_node_median(mesh, case["depth"], case["max_cells"], False)
+        with profiler.stage("convert_to_buffers"):
+            tree.convert_to_buffers()
+        with profiler.stage("generate_gather_plan"):
+            plan = generate_gather_plan(mesh, tree)
+        with profiler.stage("generate_corner_values"):
+            corner_values = generate_corner_values(mesh, tree, plan)
+        with profiler.stage("generate_node_val_ranges"):
+            node_val_ranges = generate_node_val_ranges(mesh, tree, plan)
+        with profiler.stage("split_mesh_at_leaves"):
+            leaf_meshes = split_mesh_at_leaves(mesh, tree)
+        max_verts = max(len(m.positions) for m in leaf_meshes)
+        with profiler.stage("save_block_mesh_data"):
+            gbm.save_block_mesh_data(out_name, leaf_meshes, tree, max_verts, options=case["options"])
+
+    return {
+        **case,
+        "verts": len(mesh.positions),
+        "cells": mesh.get_cell_count(),
+        "leaves": len(leaf_meshes),
+        "max_verts": max_verts,
+        "stages": {stage["name"]: stage for stage in profiler.stages},
+        "digests": get_output_digests(tree, corner_values, node_val_ranges, leaf_meshes),
+    }
+
+
+# the exponent k of time ~ cells^k for each stage, fitted over the sizes
+def get_scaling_exponents(results):
+    if len(results) < 2: return {}
+    cells = np.log([r["cells"] for r in results])
+    return {
+        name: float(np.polyfit(cells, np.log([max(r["stages"][name]["wall_time"], 1e-6) for r in results]), 1)[0])
+        for name in STAGES
+    }
+
+
+# compares the digests of each case with those of the reference, returns the differences
+def check_reference(results, reference):
+    diffs = []
+    for r in results:
+        key = get_case_key(r)
+        if key not in reference:
+            diffs.append("%s: no reference" % key)
+            continue
+        for name, digest in reference[key].items():
+            if r["digests"].get(name) != digest:
+                diffs.append("%s: %s differs" % (key, name))
+
+    return diffs
+
+
+def get_case_key(case):
+    return "size%i_c%i_g%g_j%g_s%i" % (case["size"], case["max_cells"], case["grading"], case["jitter"], case["seed"])
+
+
+def print_results(results, exponents):
+    print("%-26s" % "stage" + "".join("%14s" % ("%i cells" % r["cells"]) for r in results) + "%10s" % "scaling")
+    for name in STAGES:
+        times = "".join("%13.3fs" % r["stages"][name]["wall_time"] for r in results)
+        print("%-26s" % name + times + "%10s" % ("%.2f" % exponents[name] if name in exponents else "-"))
+
+    print("%-26s" % "peak rss (MB)" + "".join("%14.1f" % (r["peak_rss"] / 2**20 if r["peak_rss"] else 0) for r in results))
+    print("%-26s" % "leaves / max verts" + "".join("%14s" % ("%i/%i" % (r["leaves"], r["max_verts"])) for r in results))
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="benchmark_ingest", description="times the conversion stages on synthetic meshes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 24, 32], help="points along each axis of the synthetic meshes")
+    parser.add_argument("-c", "--max-cells", type=int, default=1024, help="max cells in the leaf nodes")
+    parser.add_argument("-d", "--depth", type=int, default=40, help="max depth of the tree")
+    parser.add_argument("--grading", type=float, default=1, help="ratio of the widths of the last and first cells along each axis")
+    parser.add_argument("--jitter", type=float, default=0.25, help="random perturbation of the points as a fraction of the cell width")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random perturbation")
+    parser.add_argument("--packed", action="store_true", help="write the blocks packed")
+    parser.add_argument("--report", default=None, help="write the results as json to this file")
+    parser.add_argument("--save-reference", default=None, help="save the output digests of each size to this json file")
+    parser.add_argument("--check-reference", default=None, help="check the output digests against this json file")
+    return parser
+
+
+def main():
+    args = vars(create_parser().parse_args())
+    cases = [{
+        "size": size,
+        "max_cells": args["max_cells"],
+        "depth": args["depth"],
+        "grading": args["grading"],
+        "jitter": args["jitter"],
+        "seed": args["seed"],
+        "options": gbm.get_output_options({"packed": args["packed"]}),
+    } for size in sorted(args["sizes"])]
+
+    # each case runs in a fresh process so the peak memory of one doesn't hide the next
+    results = []
+    for case in cases:
+        print("Running %s..." % get_case_key(case))
+        with multiprocessing.Pool(1) as pool:
+            result = pool.apply(run_case, (case,))
+        result["peak_rss"] = max((s.get("peak_rss") or 0) for s in result["stages"].values())
+        results.append(result)
+
+    exponents = get_scaling_exponents(results)
+    print_results(results, exponents)
+
+    if args["report"]:
+        with open(args["report"], "w") as file:
+            json.dump({"results": results, "scaling": exponents}, file, indent=4)
+
+    if args["save_reference"]:
+        with open(args["save_reference"], "w") as file:
+            json.dump({get_case_key(r): r["digests"] for r in results}, file, indent=4)
+        print("Saved reference to %s" % args["save_reference"])
+
+    if args["check_reference"]:
+        with open(args["check_reference"]) as file:
+            diffs = check_reference(results, json.load(file))
+        for diff in diffs: print(diff)
+        print("Outputs differ from the reference" if diffs else "Outputs match the reference")
+        if diffs: exit(1)
+
+
+if __name__ == "__main__":
+    main()
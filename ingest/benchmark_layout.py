@@ -0,0 +1,131 @@
+# benchmark_layout.py
+# compares the cost of traversing the serialised tree from the root to the leaves with each node layout
+# takes the same arguments as generate_block_mesh.py, the mesh and tree are only built once
+
+import time
+
+import numpy as np
+
+import generate_block_mesh as gbm
+from modules.tree import Tree, NODE_LAYOUTS, get_node_order
+from modules.reorder import get_morton_codes
+
+
+# the sizes of the units of memory counted per traversal, a cache line and a page
+CACHE_LINE_BYTES = 64
+PAGE_BYTES = 4096
+
+# how many times each traversal is timed, the fastest is reported
+REPEATS = 5
+
+
+# finds the leaf containing each point by descending the node buffer as getContainingLeafNode does
+# all points move down one level at a time, like the threads of a workgroup
+# if record_path, also returns the node each point visits at each depth, -1 once it has reached its leaf
+def find_leaves(node_buffer, points, record_path=False):
+    ptrs = np.zeros(len(points), dtype=np.int64)
+    active = np.arange(len(points))
+    path = []
+    depth = 0
+
+    while len(active) > 0:
+        if record_path:
+            step = np.full(len(points), -1, dtype=np.int64)
+            step[active] = ptrs[active]
+            path.append(step)
+
+        nodes = node_buffer[ptrs[active]]
+        branch = nodes["right_ptr"] != 0
+        active = active[branch]
+        nodes = nodes[branch]
+
+        go_left = points[active, depth % 3] <= nodes["split_val"]
+        ptrs[active] = np.where(go_left, nodes["left_ptr"], nodes["right_ptr"])
+        depth += 1
+
+    if record_path: return ptrs, np.stack(path, axis=1)
+    return ptrs
+
+
+# the mean number of distinct units of memory of the given size that the nodes of each path are in
+def count_touched(path, node_bytes, unit_bytes):
+    units = np.sort(np.where(path >= 0, path * node_bytes // unit_bytes, -1), axis=1)
+    # the padding sorts first, so every change to a valid unit is a new one
+    new_units = (np.diff(units, axis=1) != 0) & (units[:, 1:] >= 0)
+    return float(np.mean(np.sum(new_units, axis=1) + (units[:, 0] >= 0)))
+
+
+# times the traversal of the points and counts the memory it touches
+def measure_layout(node_buffer, points):
+    times = []
+    for _ in range(REPEATS):
+        start_t = time.time()
+        find_leaves(node_buffer, points)
+        times.append(time.time() - start_t)
+
+    _, path = find_leaves(node_buffer, points, True)
+    node_bytes = node_buffer.dtype.itemsize
+
+    return {
+        "time": min(times),
+        "lines": count_touched(path, node_bytes, CACHE_LINE_BYTES),
+        "pages": count_touched(path, node_bytes, PAGE_BYTES),
+        "depth": float(np.mean(np.sum(path >= 0, axis=1))),
+    }
+
+
+# random points within the box, in random order and in morton order as neighbouring rays would be
+def create_query_points(box, count, seed=0):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(box["min"], box["max"], (count, 3)).astype(np.float32)
+    coherent = points[np.argsort(get_morton_codes(points, box), kind="stable")]
+    return {"random": points, "coherent": coherent}
+
+
+def create_parser():
+    parser = gbm.create_parser()
+    parser.prog = "benchmark_layout"
+    parser.add_argument("--queries", type=int, default=1000000, help="points located in the tree for each layout")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the query points")
+    return parser
+
+
+def main():
+    args = vars(create_parser().parse_args())
+
+    mesh = gbm.prepare_mesh(args)
+    if mesh is None:
+        print("Could not load mesh, exiting...")
+        return
+
+    print("Generating tree...")
+    tree = Tree.generate_node_median(mesh, args["depth"], args["max_cells"], args["verbose"], *gbm.get_split_args(args))
+    print("%i nodes, %i leaves" % (tree.node_count, tree.leaf_count))
+
+    query_sets = create_query_points(tree.box, args["queries"], args["seed"])
+    print("%-6s %-10s %12s %10s %10s %10s" % ("layout", "queries", "time (ns)", "lines", "pages", "depth"))
+
+    dfs_nodes = get_node_order(tree.root, "dfs")
+    leaves = None
+    for layout in NODE_LAYOUTS:
+        # the tree is kept so it can be serialised again
+        node_buffer = tree.serialise(layout, args["layout_top_depth"])[0]
+
+        for name, points in query_sets.items():
+            result = measure_layout(node_buffer, points)
+            print("%-6s %-10s %12.1f %10.2f %10.2f %10.2f" % (
+                layout, name, result["time"] / len(points) * 1e9, result["lines"], result["pages"], result["depth"]
+            ))
+
+        # every layout must find the same leaves, compared by their index in the dfs layout
+        dfs_index = np.empty(tree.node_count, dtype=np.int64)
+        dfs_index[[node["this_ptr"] for node in dfs_nodes]] = np.arange(tree.node_count)
+        found = dfs_index[find_leaves(node_buffer, query_sets["random"])]
+        if leaves is None:
+            leaves = found
+        elif not np.array_equal(leaves, found):
+            print("%s finds different leaves than %s" % (layout, NODE_LAYOUTS[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# benchmark_output.py
+# compares the size, write time and block read time of the block mesh file layouts
+# takes the same arguments as generate_block_mesh.py, the mesh and tree are only built once
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+import numpy as np
+
+import generate_block_mesh as gbm
+from modules.tree import Tree
+from modules.leaf_mesh import split_mesh_at_leaves
+
+# the server reads blocks through app.py at the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+
+
+# output options to compare, each is applied over the defaults
+PRESETS = {
+    "default": {},
+    "latest": {"libver_latest": True},
+    "paged": {"libver_latest": True, "page_size": 65536},
+    "gzip": {"compression": "gzip", "shuffle": True},
+    "lzf": {"compression": "lzf", "shuffle": True},
+    "packed": {"packed": True},
+    "packed_gzip": {"packed": True, "compression": "gzip", "shuffle": True},
+    "packed_lzf": {"packed": True, "compression": "lzf", "shuffle": True},
+}
+
+# how many random requests are timed for each preset
+READ_REQUESTS = 20
+# blocks in each request, a typical amount for the client to ask for at once
+BLOCKS_PER_REQUEST = 32
+
+
+# times reading random sets of blocks through the server
+def time_block_reads(path, block_nodes, scalar_names, seed=0):
+    app.STATIC_PATH = ""
+    app.packed_index_cache.clear()
+    rng = random.Random(seed)
+    count = min(BLOCKS_PER_REQUEST, len(block_nodes))
+
+    start_t = time.time()
+    for _ in range(READ_REQUESTS):
+        app.get_mesh_block_resp({
+            "path": path,
+            "blocks": rng.sample(block_nodes, count),
+            "geometry": True,
+            "scalars": scalar_names,
+        })
+
+    return (time.time() - start_t) / READ_REQUESTS
+
+
+def main():
+    args = vars(gbm.create_parser().parse_args())
+
+    mesh = gbm.prepare_mesh(args)
+    if mesh is None:
+        print("Could not load mesh, exiting...")
+        return
+
+    print("Generating tree...")
+    tree = Tree.generate_node_median(mesh, args["depth"], args["max_cells"], args["verbose"])
+    tree.convert_to_buffers()
+
+    print("Splitting mesh...")
+    leaf_meshes = split_mesh_at_leaves(mesh, tree)
+    max_verts = max(len(m.positions) for m in leaf_meshes)
+    block_nodes = [int(m.id) for m in leaf_meshes]
+    scalar_names = list(mesh.values.keys())
+
+    print("%i blocks, %i max verts" % (len(leaf_meshes), max_verts))
+    print("%-12s %12s %10s %10s" % ("preset", "size (MB)", "write (s)", "read (ms)"))
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        for name, preset in PRESETS.items():
+            # use the same option handling as the converter
+            options = gbm.get_output_options({**args, **preset})
+            out_name = os.path.join(out_dir, name)
+
+            start_t = time.time()
+            gbm.save_block_mesh_data(out_name, leaf_meshes, tree, max_verts, 0, options)
+            write_t = time.time() - start_t
+
+            path = out_name + "_block_mesh.cgns"
+            size = os.path.getsize(path)
+            read_t = time_block_reads(path, block_nodes, scalar_names)
+
+            print("%-12s %12.2f %10.3f %10.2f" % (name, size / 1e6, write_t, read_t * 1e3))
+
+
+if __name__ == "__main__":
+    main()
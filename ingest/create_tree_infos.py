@@ -4,39 +4,97 @@ import argparse
 import json
 import time
 
+import h5py
+import numpy as np
+
+import generate_block_mesh as gbm
+from modules.tree import Tree
+from modules.scheduler import Scheduler
+
 def print_t_end(msg, start_t):
     print(msg % (time.time() - start_t))
 
-def run_job(job, prog, force=False, verbose=False):
-    start_job = time.time()
-    job_cmd_parts = [prog, "./generate_block_mesh.py", job["file"], "-e"] 
+# creates the arguments passed to generate_block_mesh.py that are common to all tasks of a job
+def get_job_args(job):
+    job_args = [job["file"], "-e"]
 
     if job.get("decimate"): 
-        job_cmd_parts.extend(["--decimate", str(job["decimate"])])
+        job_args.extend(["--decimate", str(job["decimate"])])
     if job.get("size"): 
-        job_cmd_parts.extend(["--size-x", str(job["size"][0])])
-        job_cmd_parts.extend(["--size-y", str(job["size"][1])])
-        job_cmd_parts.extend(["--size-z", str(job["size"][2])])
+        job_args.extend(["--size-x", str(job["size"][0])])
+        job_args.extend(["--size-y", str(job["size"][1])])
+        job_args.extend(["--size-z", str(job["size"][2])])
     if job.get("type"):
-        job_cmd_parts.extend(["--data-type", job["type"]])
+        job_args.extend(["--data-type", job["type"]])
     if job.get("noFiles"):
-        job_cmd_parts.extend(["-n"])
+        job_args.extend(["-n"])
     if job.get("verbose"):
-        job_cmd_parts.extend(["-v"])
+        job_args.extend(["-v"])
     if job.get("scalars"):
-        job_cmd_parts.extend(["-s", *job["scalars"]])
-        
+        job_args.extend(["-s", *job["scalars"]])
+    if job.get("timeSteps"):
+        job_args.extend(["-t", *map(str, job["timeSteps"])])
+    if job.get("cornerType"):
+        job_args.extend(["--corner-type", job["cornerType"]])
+    if job.get("lodDepth") is not None:
+        job_args.extend(["--lod-depth", str(job["lodDepth"])])
+    if job.get("treeletDepth"):
+        job_args.extend(["--treelet-depth", str(job["treeletDepth"])])
+    if job.get("packed"):
+        job_args.extend(["--packed"])
+    if job.get("sharedVerts"):
+        job_args.extend(["--shared-verts"])
+    if job.get("quantise"):
+        job_args.extend(["--quantise"])
+    if job.get("reorderMesh"):
+        job_args.extend(["--reorder-mesh"])
+    if job.get("reorderLeaves"):
+        job_args.extend(["--reorder-leaves"])
+    if job.get("compression"):
+        job_args.extend(["--compression", job["compression"]])
+    if job.get("maxVerts"):
+        job_args.extend(["--max-verts", str(job["maxVerts"])])
+    if job.get("splitOutliers"):
+        # true for the default percentile
+        job_args.extend(["--split-outliers", *([] if job["splitOutliers"] is True else [str(job["splitOutliers"])])])
+    if job.get("straddle"):
+        job_args.extend(["--straddle", job["straddle"]])
+    if job.get("nudgeTolerance") is not None:
+        job_args.extend(["--nudge-tolerance", str(job["nudgeTolerance"])])
+    if job.get("shards"):
+        job_args.extend(["--shards", str(job["shards"])])
+    if job.get("nodeLayout"):
+        job_args.extend(["--node-layout", job["nodeLayout"]])
+    if job.get("profile"):
+        job_args.extend(["--profile"])
+    if job.get("meshCache"):
+        job_args.extend(["--mesh-cache", job["meshCache"]])
+
+    return job_args
+
+
+# creates the output directory for a task
+# returns false if the task should be skipped
+def make_task_dir(out_dir, force):
+    try:
+        os.mkdir(out_dir)
+    except FileExistsError:
+        if not force:
+            print("%s exists, skipping..." % out_dir)
+            return False
+    
+    return True
+
+
+def run_job(job, prog, force=False, verbose=False):
+    start_job = time.time()
+    job_cmd_parts = [prog, "./generate_block_mesh.py", *get_job_args(job)]
     
     for i, cells in enumerate(job["cells"]):
         start_task = time.time()
         out_dir = job["out"] + "_" + str(cells)
         print("running task %i/%i" % (i + 1, len(job["cells"])))
-        try:
-            os.mkdir(out_dir)
-        except FileExistsError:
-            if not force:
-                print("%s exists, skipping..." % out_dir)
-                continue
+        if not make_task_dir(out_dir, force): continue
         
         print("processing %s..." % out_dir)
         out_path = out_dir + "/"
@@ -56,6 +114,177 @@ def run_job(job, prog, force=False, verbose=False):
     if verbose: print_t_end("Job done, took %fs", start_job)
 
 
+# runs all tasks of a job within this process
+# the mesh is loaded once and a single tree is built to the smallest cell target
+# the trees for the other targets are found by truncating this
+def run_job_single_load(job, force=False, verbose=False):
+    start_job = time.time()
+    job_args = get_job_args(job)
+    parser = gbm.create_parser()
+
+    # find the tasks that still need to be run
+    tasks = []
+    for cells in job["cells"]:
+        out_dir = job["out"] + "_" + str(cells)
+        if not make_task_dir(out_dir, force): continue
+        tasks.append((out_dir + "/", cells))
+    
+    if len(tasks) == 0: return
+
+    min_cells = min(cells for _, cells in tasks)
+    args = vars(parser.parse_args([*job_args, "-c", str(min_cells)]))
+    if not gbm.check_split_args(args):
+        print("Skipping job...")
+        return
+
+    print("loading %s..." % job["file"])
+    mesh = gbm.prepare_mesh(args)
+    if mesh is None:
+        print("Could not load mesh, skipping job...")
+        return
+
+    original_verts = len(mesh.positions)
+    original_cells = mesh.get_cell_count()
+
+    vert_order = None
+    if args["reorder_mesh"]:
+        vert_order = gbm.reorder_mesh(mesh)
+
+    start_tree = time.time()
+    print("generating tree with %i cells..." % min_cells)
+    tree = Tree.generate_node_median(mesh, args["depth"], min_cells, args["verbose"], *gbm.get_split_args(args))
+    if verbose: print_t_end("Tree done, took %fs", start_tree)
+
+    for i, (out_path, cells) in enumerate(tasks):
+        start_task = time.time()
+        print("running task %i/%i" % (i + 1, len(tasks)))
+        print("processing %s..." % out_path)
+
+        task_args = vars(parser.parse_args([*job_args, "-o", out_path, "-c", str(cells)]))
+        # the mesh and tree are shared by the tasks so only the stages of each task are profiled
+        profiler = gbm.create_profiler(task_args)
+        task_tree = tree.truncate(cells, args["max_verts"], mesh)
+        # outliers are found within each task's tree, as they would be in a separate run
+        if task_args["split_outliers"] is not None:
+            with profiler.stage("split_outliers"):
+                gbm.split_tree_outliers(mesh, task_tree, task_args)
+        gbm.report_split_growth(task_tree, task_args)
+        gbm.process_tree(mesh, task_tree, task_args, original_verts, original_cells, vert_order, profiler)
+        profiler.write_report(gbm.get_profile_info(task_args, original_verts, original_cells))
+
+        if verbose: print_t_end("Task done, took %fs", start_task)
+
+    if verbose: print_t_end("Job done, took %fs", start_job)
+
+
+# rough peak memory use of a conversion in bytes per input vertex for raw files
+# dominated by the tet connectivity and the python cell lists built during tree generation
+RAW_BYTES_PER_VERT = 600
+# rough peak memory use of a conversion in bytes per byte of input for unstructured files
+UNSTRUCT_BYTES_PER_BYTE = 12
+
+# estimates the peak memory needed to convert the dataset of a job in bytes
+def estimate_job_memory(job):
+    path = job["file"]
+    if ".raw" in path and job.get("size"):
+        return int(np.prod(job["size"])) * RAW_BYTES_PER_VERT
+    
+    input_bytes = os.path.getsize(path) if os.path.isfile(path) else 0
+    if ".lb4" in path:
+        # the values are held in a separate file
+        val_path = path.replace("_mesh.lb4", "_volume_data")
+        if os.path.isfile(val_path): input_bytes += os.path.getsize(val_path)
+
+    return input_bytes * UNSTRUCT_BYTES_PER_BYTE
+
+
+# checks that all output files of a task exist and were completely written
+def task_outputs_complete(job, out_dir):
+    prefix = out_dir + "/"
+    # the csv files are always exported, and are written before the cgns files
+    if not os.path.isfile(prefix + "overview.csv"): return False
+    if job.get("noFiles"): return True
+
+    try:
+        with h5py.File(prefix + "_partial.cgns", "r") as file:
+            leaf_count = file["Base/NodeZone/TreeData/ data"][1]
+        with h5py.File(prefix + "_block_mesh.cgns", "r") as file:
+            if "ShardManifest" in file["Base"]:
+                # the manifest is written after all of the shards
+                _, shard_paths = gbm.read_shard_manifest(file.filename, file["Base/ShardManifest"])
+                if not all(os.path.isfile(shard_path) for shard_path in shard_paths): return False
+                # the index of every block is written to the manifest last
+                lod_count = len(file["Base/LodNodes/ data"]) if "LodNodes" in file["Base"] else 0
+                zone_count = len(file["Base/BlockIndex/BlockNodes/ data"]) - lod_count
+            elif "PackedBlocks" in file["Base"]:
+                zone_count = len(file["Base/PackedBlocks/BlockNodes/ data"])
+            else:
+                zone_count = sum(1 for name in file["Base"] if name.startswith("Zone"))
+                # the simplified meshes of internal nodes are zones too
+                if "LodNodes" in file["Base"]:
+                    zone_count -= len(file["Base/LodNodes/ data"])
+    except (OSError, KeyError):
+        return False
+
+    return zone_count == leaf_count
+
+
+# runs a single task of a job within this process
+def run_task(job, cells, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    args = gbm.create_parser().parse_args([*get_job_args(job), "-o", out_dir + "/", "-c", str(cells)])
+    gbm.run(vars(args))
+
+
+# runs the tasks of all jobs concurrently
+# tasks that already have complete outputs are skipped unless forced
+def run_jobs_scheduled(jobs, workers, mem_budget, log_dir, single_load=False, force=False, verbose=False):
+    scheduler = Scheduler(workers, mem_budget, log_dir, verbose)
+
+    for job in jobs:
+        mem_estimate = estimate_job_memory(job)
+        out_dirs = {cells: job["out"] + "_" + str(cells) for cells in job["cells"]}
+        todo_cells = [
+            cells for cells, out_dir in out_dirs.items() 
+            if force or not task_outputs_complete(job, out_dir)
+        ]
+
+        if single_load:
+            # one task per job that only generates the missing outputs
+            check = lambda job=job, out_dirs=out_dirs: all(
+                task_outputs_complete(job, out_dir) for out_dir in out_dirs.values()
+            )
+            scheduler.add_task(
+                os.path.basename(job["out"]),
+                run_job_single_load,
+                ({**job, "cells": todo_cells}, True, verbose),
+                mem_estimate,
+                check,
+                skip=len(todo_cells) == 0
+            )
+            continue
+
+        for cells, out_dir in out_dirs.items():
+            check = lambda job=job, out_dir=out_dir: task_outputs_complete(job, out_dir)
+            scheduler.add_task(
+                os.path.basename(out_dir),
+                run_task,
+                (job, cells, out_dir),
+                mem_estimate,
+                check,
+                skip=cells not in todo_cells
+            )
+
+    return scheduler.run()
+
+
+# an argparse type for counts that must be at least 1
+def positive_int(string):
+    value = int(string)
+    if value < 1: raise argparse.ArgumentTypeError("must be at least 1, got %i" % value)
+    return value
+
+
 def main():
     parser = argparse.ArgumentParser(prog="generate_block_mesh")
     parser.add_argument("--file", help="path to the cgns file to process")
@@ -63,17 +292,13 @@ def main():
     parser.add_argument("--json", default=None, help="path to json job file")
     parser.add_argument("-v", action="store_true", help="verbose switch")
     parser.add_argument("-f", action="store_true", help="run task even if output folder exists")
+    parser.add_argument("-l", "--single-load", action="store_true", help="load each mesh once and derive all cell targets from one tree")
+    parser.add_argument("-j", "--workers", type=positive_int, default=None, help="run tasks concurrently with this many worker processes")
+    parser.add_argument("--mem-budget", type=float, default=None, help="memory budget in GB for concurrent tasks")
+    parser.add_argument("--log-dir", default="logs", help="directory for task logs and the summary when running concurrently")
 
     args = vars(parser.parse_args())
 
-    try:
-        subprocess.run("python3 --version")
-        prog = "python3"
-    except:
-        subprocess.run("python --version")
-        prog = "python"
-
-
     start_tot = time.time()
     # create the jobs
     if args["json"] is not None:
@@ -88,9 +313,28 @@ def main():
             cells: [2048, 1024, 512, 256, 128]
         }]
 
+    if args["workers"] is not None:
+        mem_budget = None
+        if args["mem_budget"] is not None:
+            mem_budget = int(args["mem_budget"] * 1024**3)
+
+        run_jobs_scheduled(jobs, args["workers"], mem_budget, args["log_dir"], args["single_load"], args["f"], args["v"])
+        if args["v"]: print_t_end("All jobs done, took %fs", start_tot)
+        return
+
+    try:
+        subprocess.run("python3 --version")
+        prog = "python3"
+    except:
+        subprocess.run("python --version")
+        prog = "python"
+
     for i, job in enumerate(jobs):
         print("running job %i/%i" % (i + 1, len(jobs)))
-        run_job(job, prog, args["f"], args["v"])
+        if args["single_load"]:
+            run_job_single_load(job, args["f"], args["v"])
+        else:
+            run_job(job, prog, args["f"], args["v"])
     
     if args["v"]: print_t_end("All jobs done, took %fs", start_tot)
 
@@ -1,6 +1,8 @@
+import os
 import argparse
 import numpy as np
 import time
+from functools import partial
 
 import h5py
 
@@ -9,9 +11,17 @@ import csv
 from modules.cgns import *
 from modules.utils import *
 from modules.mesh import Mesh
-from modules.tree import Tree
+from modules.tree import Tree, STRADDLE_POLICIES, DEFAULT_NUDGE_TOLERANCE, NODE_LAYOUTS, DEFAULT_LAYOUT_TOP_DEPTH
 from modules.leaf_mesh import *
-from modules.load_mesh import load_mesh_from_file
+from modules.treelet import generate_leaf_treelets
+from modules.lod_mesh import generate_lod_meshes, gather_lod_values
+from modules.shared_verts import generate_shared_plan, encode_shared_meshes, gather_owned_values
+from modules.quantise import QUANT_BITS, generate_quantised_geometry
+from modules.reorder import reorder_leaf_cells, reorder_mesh
+from modules.profiler import StageProfiler
+from modules.load_mesh import load_mesh_from_file, load_values_from_file, get_time_step_count, get_mesh_source_paths
+from modules.mesh_cache import MeshCache, DEFAULT_CACHE_SIZE, get_cache_key
+from modules.cleanup import clean_mesh
  
 
 
@@ -24,6 +34,9 @@ def add_test_data(mesh):
 def export_overview_info(prefix, orig_verts, orig_cells, target_leaf_cells, meshes):
     total_verts = sum((len(mesh.positions) for mesh in meshes))
     total_cells = sum((mesh.get_cell_count() for mesh in meshes))
+    # the blocks are padded to these
+    max_verts = max((len(mesh.positions) for mesh in meshes))
+    max_cells = max((mesh.get_cell_count() for mesh in meshes))
 
     with open(prefix + "overview.csv", "w", newline="") as file:
         writer = csv.writer(file, dialect="excel")
@@ -33,7 +46,10 @@ def export_overview_info(prefix, orig_verts, orig_cells, target_leaf_cells, mesh
             "Original Verts",
             "Original Cells",
             "Total Leaves",
-            "Target Leaf Cells"
+            "Target Leaf Cells",
+            "Max Leaf Verts",
+            "Max Leaf Cells",
+            "Cell Duplication Ratio"
         ])
         writer.writerow([
             total_verts,
@@ -41,7 +57,10 @@ def export_overview_info(prefix, orig_verts, orig_cells, target_leaf_cells, mesh
             orig_verts,
             orig_cells,
             len(meshes),
-            target_leaf_cells 
+            target_leaf_cells,
+            max_verts,
+            max_cells,
+            total_cells / max(orig_cells, 1)
         ])
 
 
@@ -53,8 +72,41 @@ def export_meshes_info(prefix, meshes):
             writer.writerow([len(mesh.positions), mesh.get_cell_count()])
 
 
+# write the corner values, ranges and limits of each scalar into the node zone
+# replaces any existing arrays for the same scalars and time step
+def write_node_values(node_zone_grp, corner_values, node_val_ranges, limits, t_index=0):
+    # write the corner values
+    flow_sol_grp = require_cgns_subgroup(node_zone_grp, get_time_step_name("FlowSolution", t_index), "FlowSolution_t", "MT")
+
+    for name, buff in corner_values.items():
+        overwrite_cgns_subgroup(flow_sol_grp, name, "DataArray_t", "R4", buff)
+
+    # write the node value ranges
+    flow_ranges_grp = require_cgns_subgroup(node_zone_grp, get_time_step_name("FlowSolutionRanges", t_index), "UserDefinedData_t", "MT")
+
+    for name, buff in node_val_ranges.items():
+        overwrite_cgns_subgroup(flow_ranges_grp, name, "DataArray_t", "R4", buff)
+    
+    # write the limits
+    limits_grp = require_cgns_subgroup(node_zone_grp, get_time_step_name("FlowSolutionLimits", t_index), "UserDefinedData_t", "MT")
+
+    for name, val in limits.items():
+        overwrite_cgns_subgroup(limits_grp, name, "DataArray_t", "R4", np.array(
+            [val["min"], val["max"]], dtype=np.float32
+        ))
+
+
+# adds a time step to the list of those with values stored in the group
+def add_time_step(grp, t_index):
+    time_steps = [t_index]
+    if "TimeSteps" in grp:
+        time_steps.extend(grp["TimeSteps/ data"][()])
+
+    overwrite_cgns_subgroup(grp, "TimeSteps", "UserDefinedData_t", "I4", np.unique(np.array(time_steps, dtype=np.int32)))
+
+
 # write the node and corner value information
-def create_node_zone_group(base_grp, tree, node_buff, corner_values, node_val_ranges, limits):
+def create_node_zone_group(base_grp, tree, node_buff, corner_values, node_val_ranges, limits, t_index=0, corner_type="Sample"):
     # indicate that there are no verts inside this
     node_zone_grp = create_cgns_subgroup(base_grp, "NodeZone", "Zone_t", "I4", np.array([0, 0, 0], dtype=np.int32))
     create_cgns_subgroup(node_zone_grp, "ZoneType", "ZoneType_t", "C1", string_to_np_char("ZoneTypeUserDefined"))
@@ -68,41 +120,23 @@ def create_node_zone_group(base_grp, tree, node_buff, corner_values, node_val_ra
     create_cgns_subgroup(node_zone_grp, "TreeData", "UserDefinedData_t", "I4", tree_data)
 
     # write corner value type information
-    create_cgns_subgroup(node_zone_grp, "CornerValueType", "UserDefinedData_t", "C1", string_to_np_char("Sample"))
-
-    # write the corner values
-    flow_sol_grp = create_cgns_subgroup(node_zone_grp, "FlowSolution", "FlowSolution_t", "MT")
-
-    for name, buff in corner_values.items():
-        create_cgns_subgroup(flow_sol_grp, name, "DataArray_t", "R4", buff)
+    create_cgns_subgroup(node_zone_grp, "CornerValueType", "UserDefinedData_t", "C1", string_to_np_char(corner_type))
 
-    # write the node value ranges
-    flow_ranges_grp = create_cgns_subgroup(node_zone_grp, "FlowSolutionRanges", "UserDefinedData_t", "MT")
-
-    for name, buff in node_val_ranges.items():
-        create_cgns_subgroup(flow_ranges_grp, name, "DataArray_t", "R4", buff)
-    
-    # write the limits
-    limits_grp = create_cgns_subgroup(node_zone_grp, "FlowSolutionLimits", "UserDefinedData_t", "MT")
-
-    for name, val in limits.items():
-        create_cgns_subgroup(limits_grp, name, "DataArray_t", "R4", np.array(
-            [val["min"], val["max"]], dtype=np.float32
-        ))
+    write_node_values(node_zone_grp, corner_values, node_val_ranges, limits, t_index)
 
     return node_zone_grp
 
 
 # writes the data that the client will access directly to a file
 # contains the node and corner buffers as well as what sizes to expect for the mesh
-def save_partial_data(out_name, tree, max_verts, corner_values, node_val_ranges, limits):
+def save_partial_data(out_name, tree, max_verts, corner_values, node_val_ranges, limits, t_index=0, treelet_info=None, corner_type="Sample", lod_nodes=None, quantised=False, node_bounds=None):
     with h5py.File(f"{out_name}_partial.cgns", "w") as file:
         create_cgns_subgroup(file, "CGNSLibraryVersion", "CGNSLibraryVersion_t", "R4", np.array(3.3, dtype=np.float32))
         
         base_grp = create_cgns_subgroup(file, "Base", "CGNSBase_t", "I4", np.array([3, 3], dtype=np.int32))
 
         # create zone for partial information
-        zone_grp = create_node_zone_group(base_grp, tree, tree.node_buffer.view(np.uint8), corner_values, node_val_ranges, limits)
+        zone_grp = create_node_zone_group(base_grp, tree, tree.node_buffer.view(np.uint8), corner_values, node_val_ranges, limits, t_index, corner_type)
 
         # write information about max verts and max cells in all zones
         prim_data = np.array([tree.max_cells, max_verts], dtype=np.uint32)
@@ -112,33 +146,347 @@ def save_partial_data(out_name, tree, max_verts, corner_values, node_val_ranges,
         box_data = np.array(tree.box["min"] + tree.box["max"], dtype=np.float32)
         create_cgns_subgroup(zone_grp, "ZoneBounds", "UserDefinedData_t", "R4", box_data)
 
+        # write the depth and max cells of the treelets that the server can send with the blocks
+        if treelet_info is not None:
+            create_cgns_subgroup(zone_grp, "TreeletInfo", "UserDefinedData_t", "I4", treelet_info)
+
+        # write the internal nodes that have simplified meshes on the server
+        if lod_nodes is not None:
+            create_cgns_subgroup(zone_grp, "LodNodes", "UserDefinedData_t", "I4", lod_nodes)
+
+        # write the tight box of the cells in each node as min xyz, max xyz and whether it has any cells
+        if node_bounds is not None:
+            bounds, occupancy = node_bounds
+            create_cgns_subgroup(zone_grp, "NodeBounds", "UserDefinedData_t", "R4", bounds.ravel())
+            create_cgns_subgroup(zone_grp, "NodeOccupancy", "UserDefinedData_t", "C1", occupancy)
+
+        # indicate that the server can send the blocks with quantised geometry
+        if quantised:
+            create_cgns_subgroup(zone_grp, "QuantisationBits", "UserDefinedData_t", "I4", np.array([QUANT_BITS], dtype=np.int32))
+
+        add_time_step(zone_grp, t_index)
+
+
+# the treelet depth and the max number of cells in any treelet
+def get_treelet_info(depth, treelets):
+    max_treelet_cells = max(len(treelet["cells"]) for treelet in treelets)
+    return np.array([depth, max_treelet_cells], dtype=np.uint32)
+
+
+# writes the treelet of a single block
+# the nodes are stored as bytes in the same way as the node tree
+def create_treelet_subgroup(zone_grp, treelet, options=None):
+    treelet_grp = create_cgns_subgroup(zone_grp, "Treelet", "UserDefinedData_t", "MT")
+    create_cgns_subgroup(treelet_grp, "TreeletNodes", "UserDefinedData_t", "C1", treelet["nodes"].view(np.uint8), options)
+    create_cgns_subgroup(treelet_grp, "TreeletRootSplit", "UserDefinedData_t", "R4", treelet["root_split"])
+    create_cgns_subgroup(treelet_grp, "TreeletCells", "UserDefinedData_t", "I4", treelet["cells"], options)
+
+
+# writes the treelets of all blocks packed in the same order as the blocks
+# every treelet has the same number of nodes, TreeletCellOffsets gives the slice of each block's cells
+def create_packed_treelets_group(packed_grp, treelets, options=None):
+    treelet_grp = create_cgns_subgroup(packed_grp, "Treelet", "UserDefinedData_t", "MT")
+
+    nodes = np.concatenate([treelet["nodes"] for treelet in treelets])
+    create_cgns_subgroup(treelet_grp, "TreeletNodes", "UserDefinedData_t", "C1", nodes.view(np.uint8), options)
+
+    root_splits = np.concatenate([treelet["root_split"] for treelet in treelets])
+    create_cgns_subgroup(treelet_grp, "TreeletRootSplit", "UserDefinedData_t", "R4", root_splits)
+
+    cell_offsets = np.zeros(len(treelets) + 1, dtype=np.int64)
+    cell_offsets[1:] = np.cumsum([len(treelet["cells"]) for treelet in treelets])
+    create_cgns_subgroup(treelet_grp, "TreeletCellOffsets", "UserDefinedData_t", "I8", cell_offsets)
+
+    cells = np.concatenate([treelet["cells"] for treelet in treelets])
+    create_cgns_subgroup(treelet_grp, "TreeletCells", "UserDefinedData_t", "I4", cells, options)
+
+
+# writes the quantised geometry of a single block
+# the positions are stored as bytes of interleaved 16 bit xyz triples
+def create_quantised_subgroup(zone_grp, quant, options=None):
+    quant_grp = create_cgns_subgroup(zone_grp, "QuantisedGeometry", "UserDefinedData_t", "MT")
+    create_cgns_subgroup(quant_grp, "QuantBox", "UserDefinedData_t", "R4", quant["box"])
+    create_cgns_subgroup(quant_grp, "QuantCoordinates", "UserDefinedData_t", "C1", quant["coords"].view(np.uint8).ravel(), options)
+    create_cgns_subgroup(quant_grp, "ConnectivityVarint", "UserDefinedData_t", "C1", quant["con_varint"], options)
+
+
+# writes the quantised geometry of all blocks packed in the same order as the blocks
+# the positions are sliced by the vertex offsets, VarintOffsets gives the slice of each block's connectivity bytes
+def create_packed_quantised_group(packed_grp, quants, options=None):
+    quant_grp = create_cgns_subgroup(packed_grp, "QuantisedGeometry", "UserDefinedData_t", "MT")
+
+    boxes = np.concatenate([quant["box"] for quant in quants])
+    create_cgns_subgroup(quant_grp, "QuantBox", "UserDefinedData_t", "R4", boxes)
+
+    coords = np.concatenate([quant["coords"] for quant in quants])
+    create_cgns_subgroup(quant_grp, "QuantCoordinates", "UserDefinedData_t", "C1", coords.view(np.uint8).ravel(), options)
+
+    varint_offsets = np.zeros(len(quants) + 1, dtype=np.int64)
+    varint_offsets[1:] = np.cumsum([len(quant["con_varint"]) for quant in quants])
+    create_cgns_subgroup(quant_grp, "VarintOffsets", "UserDefinedData_t", "I8", varint_offsets)
+
+    con_varint = np.concatenate([quant["con_varint"] for quant in quants])
+    create_cgns_subgroup(quant_grp, "ConnectivityVarint", "UserDefinedData_t", "C1", con_varint, options)
+
+
+# writes the references of leaves with shared vertices packed in the same order as the blocks
+# each is an (owner node, index within owner) pair, RefOffsets gives the slice of each block's pairs
+def create_packed_refs_group(packed_grp, refs, options=None):
+    ref_offsets = np.zeros(len(refs) + 1, dtype=np.int64)
+    ref_offsets[1:] = np.cumsum([len(block_refs) for block_refs in refs])
+    create_cgns_subgroup(packed_grp, "RefOffsets", "UserDefinedData_t", "I8", ref_offsets)
+
+    packed_refs = np.concatenate(refs).ravel()
+    create_cgns_subgroup(packed_grp, "VertexRefs", "UserDefinedData_t", "I4", packed_refs, options)
+
+
+# concatenates the arrays of each block, or returns empty if there are no blocks, such as in an empty shard
+def concatenate_blocks(arrays, empty):
+    if len(arrays) == 0: return empty
+    return np.concatenate(arrays)
+
+
+# writes the mesh data of all leaves as slices of one dataset per field
+# BlockNodes holds the node index of each leaf in ascending order, the offsets give each leaf's slice
+# the simplified meshes of internal nodes are packed in the same way in PackedLodBlocks
+# meshes may be empty, the datasets are then empty and the optional groups aren't written
+def create_packed_blocks_group(base_grp, meshes, t_index=0, options=None, treelets=None, grp_name="PackedBlocks", refs=None, quants=None):
+    packed_grp = create_cgns_subgroup(base_grp, grp_name, "UserDefinedData_t", "MT")
+
+    block_nodes = np.array([mesh.id for mesh in meshes], dtype=np.uint32)
+    create_cgns_subgroup(packed_grp, "BlockNodes", "UserDefinedData_t", "I4", block_nodes)
+
+    vert_offsets = np.zeros(len(meshes) + 1, dtype=np.int64)
+    vert_offsets[1:] = np.cumsum([len(mesh.positions) for mesh in meshes])
+    create_cgns_subgroup(packed_grp, "VertOffsets", "UserDefinedData_t", "I8", vert_offsets)
+
+    conn_offsets = np.zeros(len(meshes) + 1, dtype=np.int64)
+    conn_offsets[1:] = np.cumsum([len(mesh.connectivity) for mesh in meshes])
+    create_cgns_subgroup(packed_grp, "ConnOffsets", "UserDefinedData_t", "I8", conn_offsets)
+
+    # write the positions of the vertices
+    positions = concatenate_blocks([mesh.positions for mesh in meshes], np.empty((0, 3), dtype=np.float32))
+    coords_grp = create_cgns_subgroup(packed_grp, "GridCoordinates", "GridCoordinates_t", "MT")
+    create_cgns_subgroup(coords_grp, "CoordinateX", "DataArray_t", "R4", positions.T[0], options)
+    create_cgns_subgroup(coords_grp, "CoordinateY", "DataArray_t", "R4", positions.T[1], options)
+    create_cgns_subgroup(coords_grp, "CoordinateZ", "DataArray_t", "R4", positions.T[2], options)
+
+    # write connectivity, local to each block and 1-based as in the zones
+    one_based_con = concatenate_blocks([mesh.connectivity for mesh in meshes], np.empty(0, dtype=np.uint32)) + 1
+    elem_grp = create_cgns_subgroup(packed_grp, "GridElements", "Elements_t", "I4", np.array([10, 0], dtype=np.int32))
+    create_cgns_subgroup(elem_grp, "ElementConnectivity", "DataArray_t", "I4", one_based_con, options)
+
+    # write vertex values
+    sol_grp = create_cgns_subgroup(packed_grp, get_time_step_name("FlowSolution", t_index), "FlowSolution_t", "MT")
+    if len(meshes) == 0: return
+    for name in meshes[0].values:
+        packed_vals = np.concatenate([mesh.values[name] for mesh in meshes])
+        create_cgns_subgroup(sol_grp, name, "DataArray_t", "R4", packed_vals, options)
+
+    if treelets is not None:
+        create_packed_treelets_group(packed_grp, treelets, options)
+
+    if refs is not None:
+        create_packed_refs_group(packed_grp, refs, options)
+
+    if quants is not None:
+        create_packed_quantised_group(packed_grp, quants, options)
+
+
+# the path of the block mesh file, or of one of its shards
+def get_block_mesh_path(out_name, shard=None):
+    if shard is None: return f"{out_name}_block_mesh.cgns"
+    return f"{out_name}_block_mesh_{shard}.cgns"
+
+
+# creates the base group of a block mesh file with the sizes of the blocks
+def create_block_mesh_base(file, tree, max_verts, t_index=0, treelet_info=None, lod_meshes=None):
+    file.create_dataset("format", data=string_to_np_char("IEEE_LITTLE_32\0"))
+    file.create_dataset("hdf5version", data=string_to_np_char("HDF5 Version 1.10.4" + "\0"*14))
+    create_cgns_subgroup(file, "CGNSLibraryVersion", "CGNSLibraryVersion_t", "R4", np.array([3.3], dtype=np.float32))
+
+    base_grp = create_cgns_subgroup(file, "Base", "CGNSBase_t", "I4", np.array([3, 3], dtype=np.int32))
+
+    # write information about max verts and max cells across all zones
+    prim_data = np.array([tree.max_cells, max_verts], dtype=np.uint32)
+    create_cgns_subgroup(base_grp, "MaxPrimitives", "UserDefinedData_t", "I4", prim_data)
+    add_time_step(base_grp, t_index)
+
+    if treelet_info is not None:
+        create_cgns_subgroup(base_grp, "TreeletInfo", "UserDefinedData_t", "I4", treelet_info)
+
+    if lod_meshes is not None:
+        lod_nodes = np.array([mesh.id for mesh in lod_meshes], dtype=np.uint32)
+        create_cgns_subgroup(base_grp, "LodNodes", "UserDefinedData_t", "I4", lod_nodes)
+
+    return base_grp
+
 
 # writes the data that the server will read from to a file
 # contains the mesh data for each of the tree leaf nodes
-def save_block_mesh_data(out_name, meshes, tree, max_verts):
-    with h5py.File(f"{out_name}_block_mesh.cgns", "w") as file:
-        file.create_dataset("format", data=string_to_np_char("IEEE_LITTLE_32\0"))
-        file.create_dataset("hdf5version", data=string_to_np_char("HDF5 Version 1.10.4" + "\0"*14))
-        create_cgns_subgroup(file, "CGNSLibraryVersion", "CGNSLibraryVersion_t", "R4", np.array([3.3], dtype=np.float32))
-    
-        base_grp = create_cgns_subgroup(file, "Base", "CGNSBase_t", "I4", np.array([3, 3], dtype=np.int32))
+# treelets are optional and in the same order as the meshes
+# shard is the index of the shard of a sharded file to write, the meshes are then only those within it
+# lod_meshes are the optional simplified meshes of internal nodes, written in the same way as the leaves
+# refs are the vertices each mesh references from others if the meshes only hold their owned vertices
+# quants and lod_quants are the optional quantised geometry of the meshes and lod meshes
+def save_block_mesh_data(out_name, meshes, tree, max_verts, t_index=0, options=None, treelets=None, treelet_info=None, lod_meshes=None, refs=None, quants=None, lod_quants=None, shard=None):
+    with h5py.File(get_block_mesh_path(out_name, shard), "w", **get_file_kwargs(options)) as file:
+        base_grp = create_block_mesh_base(file, tree, max_verts, t_index, None if treelets is None else treelet_info, lod_meshes)
 
-        # write information about max verts and max cells across all zones
-        prim_data = np.array([tree.max_cells, max_verts], dtype=np.uint32)
-        create_cgns_subgroup(base_grp, "MaxPrimitives", "UserDefinedData_t", "I4", prim_data)
+        if options is not None and options["packed"]:
+            create_packed_blocks_group(base_grp, meshes, t_index, options, treelets, refs=refs, quants=quants)
+            if lod_meshes:
+                create_packed_blocks_group(base_grp, lod_meshes, t_index, options, grp_name="PackedLodBlocks", quants=lod_quants)
+            return
 
         # create the zones for each mesh
-        for mesh in meshes:
+        for i, mesh in enumerate(meshes):
             # name each after its node index rather than mesh (leaf) index
-            mesh.create_zone_subgroup(base_grp, "Zone%i" % mesh.id)
+            zone_grp = mesh.create_zone_subgroup(base_grp, "Zone%i" % mesh.id, t_index, options)
+            if treelets is not None:
+                create_treelet_subgroup(zone_grp, treelets[i], options)
+            if refs is not None:
+                create_cgns_subgroup(zone_grp, "VertexRefs", "UserDefinedData_t", "I4", refs[i].ravel(), options)
+            if quants is not None:
+                create_quantised_subgroup(zone_grp, quants[i], options)
 
+        for i, mesh in enumerate(lod_meshes or []):
+            zone_grp = mesh.create_zone_subgroup(base_grp, "Zone%i" % mesh.id, t_index, options)
+            if lod_quants is not None:
+                create_quantised_subgroup(zone_grp, lod_quants[i], options)
 
-def main():
+
+# the first block node of each shard, the leaf meshes are divided evenly between the shards in node order
+# > the first shard starts at 0 so it also holds the simplified meshes of any nodes before the first leaf
+def get_shard_starts(meshes, shard_count):
+    leaf_nodes = np.array([mesh.id for mesh in meshes], dtype=np.int64)
+    shard_count = max(min(shard_count, len(leaf_nodes)), 1)
+    starts = leaf_nodes[np.linspace(0, len(leaf_nodes), shard_count, endpoint=False).astype(np.int64)]
+    starts[0] = 0
+    return starts
+
+
+# the shard each mesh is stored in
+def get_mesh_shards(meshes, shard_starts):
+    return np.searchsorted(shard_starts, [mesh.id for mesh in meshes], "right") - 1
+
+
+# the items of an optional list of per mesh data that are in the shard
+def select_shard(items, mesh_shards, shard):
+    if items is None: return None
+    return [item for item, item_shard in zip(items, mesh_shards) if item_shard == shard]
+
+
+# writes the blocks to a file for each shard, each holding the blocks from its start up to the next shard's
+# the manifest is written where the unsharded file would be, the server routes blocks to the shards it lists
+# the other arguments are as save_block_mesh_data
+def save_sharded_block_mesh_data(shard_count, out_name, meshes, tree, max_verts, t_index=0, options=None, treelets=None, treelet_info=None, lod_meshes=None, refs=None, quants=None, lod_quants=None):
+    shard_starts = get_shard_starts(meshes, shard_count)
+    mesh_shards = get_mesh_shards(meshes, shard_starts)
+    lod_shards = get_mesh_shards(lod_meshes or [], shard_starts)
+
+    for shard in range(len(shard_starts)):
+        save_block_mesh_data(
+            out_name,
+            select_shard(meshes, mesh_shards, shard),
+            tree,
+            max_verts,
+            t_index,
+            options,
+            select_shard(treelets, mesh_shards, shard),
+            treelet_info,
+            select_shard(lod_meshes, lod_shards, shard),
+            select_shard(refs, mesh_shards, shard),
+            select_shard(quants, mesh_shards, shard),
+            select_shard(lod_quants, lod_shards, shard),
+            shard
+        )
+
+    with h5py.File(get_block_mesh_path(out_name), "w", **get_file_kwargs(options)) as file:
+        base_grp = create_block_mesh_base(file, tree, max_verts, t_index, None if treelets is None else treelet_info, lod_meshes)
+        manifest_grp = create_cgns_subgroup(base_grp, "ShardManifest", "UserDefinedData_t", "MT")
+        create_cgns_subgroup(manifest_grp, "ShardStarts", "UserDefinedData_t", "I8", shard_starts.astype(np.int64))
+
+        # the names of the shard files relative to the manifest, one per line
+        shard_names = [os.path.basename(get_block_mesh_path(out_name, shard)) for shard in range(len(shard_starts))]
+        create_cgns_subgroup(manifest_grp, "ShardFiles", "UserDefinedData_t", "C1", string_to_np_char("\n".join(shard_names)))
+
+
+# reads the start and the path of each shard from the manifest of a sharded block mesh file
+def read_shard_manifest(path, manifest_grp):
+    shard_names = manifest_grp["ShardFiles/ data"][()].tobytes().decode().split("\n")
+    shard_paths = [os.path.join(os.path.dirname(path), name) for name in shard_names]
+    return manifest_grp["ShardStarts/ data"][()], shard_paths
+
+
+# writes the value range of each block for every scalar of the time step into the block index
+def write_block_index_ranges(index_grp, node_val_ranges, t_index=0):
+    block_nodes = index_grp["BlockNodes/ data"][()]
+    ranges_grp = require_cgns_subgroup(index_grp, get_time_step_name("FlowSolutionRanges", t_index), "UserDefinedData_t", "MT")
+
+    for name, buff in node_val_ranges.items():
+        overwrite_cgns_subgroup(ranges_grp, name, "DataArray_t", "R4", buff[block_nodes])
+
+
+# writes the index of every block in the block mesh file, so requests can be planned without reading the blocks
+# meshes are the full leaf meshes followed by any lod meshes, quants are their quantised geometry if generated
+# the blocks are in ascending node order
+# > the index of a sharded file is only written to its manifest
+def save_block_index(out_name, meshes, node_val_ranges, t_index=0, quants=None):
+    order = np.argsort([mesh.id for mesh in meshes], kind="stable")
+
+    with h5py.File(get_block_mesh_path(out_name), "r+") as file:
+        index_grp = create_cgns_subgroup(file["Base"], "BlockIndex", "UserDefinedData_t", "MT")
+
+        block_nodes = np.array([meshes[i].id for i in order], dtype=np.uint32)
+        create_cgns_subgroup(index_grp, "BlockNodes", "UserDefinedData_t", "I4", block_nodes)
+
+        vert_counts = np.array([len(meshes[i].positions) for i in order], dtype=np.uint32)
+        create_cgns_subgroup(index_grp, "VertCounts", "UserDefinedData_t", "I4", vert_counts)
+
+        cell_counts = np.array([meshes[i].get_cell_count() for i in order], dtype=np.uint32)
+        create_cgns_subgroup(index_grp, "CellCounts", "UserDefinedData_t", "I4", cell_counts)
+
+        if quants is not None:
+            varint_byte_counts = np.array([len(quants[i]["con_varint"]) for i in order], dtype=np.uint32)
+            create_cgns_subgroup(index_grp, "VarintByteCounts", "UserDefinedData_t", "I4", varint_byte_counts)
+
+        write_block_index_ranges(index_grp, node_val_ranges, t_index)
+
+
+# saves the tree and the value independent gather information so scalars can be updated with -u
+def save_tree_sidecar(out_name, tree, max_verts, vert_count, plan):
+    tree_data = np.array([tree.node_count, tree.leaf_count, tree.max_cells, max_verts, vert_count], dtype=np.uint64)
+    np.savez(f"{out_name}_tree.npz", node_buffer=tree.node_buffer, tree_data=tree_data, **plan)
+
+
+def load_tree_sidecar(out_name):
+    with np.load(f"{out_name}_tree.npz") as file:
+        return {name: file[name] for name in file.files}
+
+
+# the names written to CornerValueType for each --corner-type
+CORNER_VALUE_TYPES = {
+    "sample": "Sample",
+    "polynomial": "Polynomial",
+}
+
+# the default chunk length of compressed packed datasets
+DEFAULT_PACKED_CHUNK_SIZE = 8192
+
+
+def create_parser():
     parser = argparse.ArgumentParser(prog="generate_block_mesh")
     parser.add_argument("file-path", help="path to the cgns file to process")
     parser.add_argument("-s", "--scalars", nargs="*", default=["pick"], help="flow solution scalar datasets to include")
     parser.add_argument("-d", "--depth", type=int, default=40, help="max depth of the tree")
     parser.add_argument("-c", "--max-cells", type=int, default=1024, help="max cells in the leaf nodes")
+    parser.add_argument("--max-verts", type=int, default=None, help="max vertices in the leaf nodes, unlimited by default")
+    parser.add_argument("--straddle", choices=STRADDLE_POLICIES, default="duplicate", help="how cells crossing split planes are divided, centroid is only for analysis with -n")
+    parser.add_argument("--nudge-tolerance", type=float, default=DEFAULT_NUDGE_TOLERANCE, help="furthest the split planes are nudged from the centre as a fraction of the node's extent")
+    parser.add_argument("--node-layout", choices=NODE_LAYOUTS, default="dfs", help="order the nodes are written in the node tree")
+    parser.add_argument("--layout-top-depth", type=int, default=DEFAULT_LAYOUT_TOP_DEPTH, help="levels at the top of the veb node layout written breadth first")
+    parser.add_argument("--split-outliers", type=float, nargs="?", const=99, default=None, help="split leaves with more cells or vertices than this percentile of the leaves, 99 if no value is given")
     parser.add_argument("-o", "--output", default="out", help="output file prefix")
     parser.add_argument("-v", "--verbose", action="store_true", help="enable verbose output")
     parser.add_argument("-e", "--export", action="store_true", help="export tree and mesh data as csv")
@@ -152,33 +500,148 @@ def main():
     parser.add_argument("--mirror-y", type=float, default=None, help="position of optional y mirror")
     parser.add_argument("--mirror-z", type=float, default=None, help="position of optional z mirror")
     parser.add_argument("--decimate", type=float, default=0, help="proportion of cells to remove from input mesh")
+    parser.add_argument("--no-cleanup", action="store_true", help="keep degenerate and duplicate cells and unused vertices of the loaded mesh")
+    parser.add_argument("--mesh-cache", default=None, help="directory of the cache of loaded meshes, repeat conversions of the same file and loading arguments reuse the mesh")
+    parser.add_argument("--mesh-cache-size", type=float, default=DEFAULT_CACHE_SIZE / 2**30, help="size in GiB the mesh cache is kept within by removing the least recently used meshes")
+    parser.add_argument("--mesh-cache-hash", action="store_true", help="identify the source files in the mesh cache by hashing their contents rather than by path and modification time")
+    parser.add_argument("-t", "--time-steps", nargs="+", default=["0"], help="time steps of the values to use or 'all', fun3d data only")
+    parser.add_argument("--save-tree", action="store_true", help="save the tree and leaf vertex maps so scalars can be updated later with -u")
+    parser.add_argument("-u", "--update", action="store_true", help="only regenerate the scalars of existing output files, reusing the tree saved with --save-tree")
+    parser.add_argument("--compression", choices=["gzip", "lzf"], default=None, help="compression filter for the block mesh datasets")
+    parser.add_argument("--compression-level", type=int, default=None, help="gzip compression level from 0 to 9")
+    parser.add_argument("--shuffle", action="store_true", help="apply the shuffle filter to the block mesh datasets")
+    parser.add_argument("--chunk-size", type=int, default=None, help="chunk length in elements of the block mesh datasets")
+    parser.add_argument("--libver-latest", action="store_true", help="write the block mesh file with the latest hdf5 file format")
+    parser.add_argument("--page-size", type=int, default=None, help="use paged aggregation in the block mesh file with this page size in bytes")
+    parser.add_argument("--shards", type=int, default=1, help="split the block mesh file into this many files by leaf range, listed in a manifest at the usual path")
+    parser.add_argument("--corner-type", choices=["sample", "polynomial"], default="sample", help="sample the values at the node corners or fit a trilinear polynomial within each node")
+    parser.add_argument("--lod-depth", type=int, default=-1, help="generate simplified meshes for the internal nodes down to this depth, -1 for none")
+    parser.add_argument("--treelet-depth", type=int, default=0, help="depth of the treelets to generate over the cells of each block, 0 for none")
+    parser.add_argument("--packed", action="store_true", help="store the leaf meshes as slices of one dataset per field instead of a zone each")
+    parser.add_argument("--shared-verts", action="store_true", help="store vertices shared between leaves once, other leaves reference them")
+    parser.add_argument("--quantise", action="store_true", help="also store the block geometry with 16 bit positions and varint connectivity for compact transfer")
+    parser.add_argument("--reorder-mesh", action="store_true", help="reorder the vertices and cells of the mesh along a morton curve before building the tree")
+    parser.add_argument("--reorder-leaves", action="store_true", help="reorder the cells and vertices of each leaf block along a morton curve")
+    parser.add_argument("--profile", action="store_true", help="record the time and peak memory of each stage to {output}profile.json")
+    parser.add_argument("--profile-cprofile", action="store_true", help="also dump the cProfile stats of each stage, implies --profile")
+    parser.add_argument("--profile-tracemalloc", action="store_true", help="also trace the memory allocated in each stage with tracemalloc, implies --profile")
 
+    return parser
 
-    args = vars(parser.parse_args())
 
-    if args["verbose"]: print(args)
+# the hdf5 layout options for the block mesh file
+def get_output_options(args):
+    options = dict(DEFAULT_OUTPUT_OPTIONS)
+    for name in options:
+        if args.get(name) is not None: options[name] = args[name]
+
+    # automatic chunks can be much larger than a block, so reads would decompress far more than needed
+    if options["packed"] and options["compression"] is not None and options["chunk_size"] is None:
+        options["chunk_size"] = DEFAULT_PACKED_CHUNK_SIZE
+    
+    return options
+
 
-    mesh = load_mesh_from_file(
-        args["file-path"], 
-        args["scalars"], 
-        args["data_type"], 
-        args["size_x"],
-        args["size_y"],
-        args["size_z"],
-        args["decimate"],
-        args["verbose"]
+# finds the indices of the time steps selected with -t
+def get_time_steps(args):
+    if "all" in args["time_steps"]:
+        return list(range(get_time_step_count(args["file-path"])))
+    
+    return [int(t) for t in args["time_steps"]]
+
+
+# the dataset and options a profile was recorded with, so reports can be compared across datasets and changes
+def get_profile_info(args, original_verts=None, original_cells=None):
+    return {
+        "file": args["file-path"],
+        "max_cells": args["max_cells"],
+        "original_verts": original_verts,
+        "original_cells": original_cells,
+        "args": {key: value for key, value in args.items() if not key.startswith("profile")},
+    }
+
+
+# creates the profiler of a conversion from the parsed arguments, this records nothing unless --profile is set
+def create_profiler(args):
+    return StageProfiler(
+        args["output"], 
+        args.get("profile", False), 
+        args.get("profile_cprofile", False), 
+        args.get("profile_tracemalloc", False)
     )
-    if mesh is None: 
-        print("Could not load mesh, exiting...")
+
+
+# the arguments that change the mesh prepare_mesh returns, these key its cache entries
+def get_mesh_cache_args(args):
+    return {
+        "scalars": sorted(args["scalars"]),
+        "data_type": args["data_type"],
+        "size": [args["size_x"], args["size_y"], args["size_z"]],
+        "decimate": args["decimate"],
+        "mirrors": [args["mirror_x"], args["mirror_y"], args["mirror_z"]],
+        "time_step": get_time_steps(args)[0],
+        "cleanup": not args["no_cleanup"],
+    }
+
+
+# opens the mesh cache if --mesh-cache is set and the mesh can be cached
+# > meshes with values picked interactively or with test data transferred are not
+def get_mesh_cache(args):
+    if args["mesh_cache"] is None: return
+    if "pick" in args["scalars"] or args["transfer"]:
+        if args["verbose"]: print("Not using the mesh cache, the scalars must be given with -s and --transfer not set")
         return
 
+    return MeshCache(args["mesh_cache"], int(args["mesh_cache_size"] * 2**30), args["verbose"])
+
+
+# loads the mesh from the input file and prepares it for tree generation
+def prepare_mesh(args, profiler=None):
+    profiler = profiler or StageProfiler(args["output"])
+
+    cache = get_mesh_cache(args)
+    if cache is not None:
+        with profiler.stage("cache_load"):
+            cache_key = get_cache_key(get_mesh_source_paths(args["file-path"]), get_mesh_cache_args(args), args["mesh_cache_hash"])
+            mesh = cache.load(cache_key)
+        if mesh is not None:
+            if args["verbose"]: print(mesh)
+            return mesh
+
+    with profiler.stage("load"):
+        mesh = load_mesh_from_file(
+            args["file-path"], 
+            args["scalars"], 
+            args["data_type"], 
+            args["size_x"],
+            args["size_y"],
+            args["size_z"],
+            args["decimate"],
+            args["verbose"],
+            get_time_steps(args)[0]
+        )
+    if mesh is None: return
+
+    # remove what no cell needs before the vertices are duplicated by mirroring
+    if not args["no_cleanup"]:
+        if args["verbose"]: print("Cleaning mesh...")
+        with profiler.stage("cleanup"):
+            removed = clean_mesh(mesh, args["verbose"])
+        if any(removed.values()):
+            print(
+                "Removed %i degenerate cells, %i duplicate cells and %i unused vertices" % 
+                (removed["degenerate_cells"], removed["duplicate_cells"], removed["unused_verts"])
+            )
+
     # if any mirrors are supplied with -m*, calculate their effect
     mirror_arr = [args["mirror_x"], args["mirror_y"], args["mirror_z"]]
     if args["mirror_x"] is not None and args["mirror_y"] is not None and args["mirror_z"] is not None:
         if args["verbose"]: print("Mirroring mesh..")
-        mesh.mirror(mirror_arr, args["verbose"])
+        with profiler.stage("mirror"):
+            mesh.mirror(mirror_arr, args["verbose"])
 
-    mesh.calculate_box()
+    with profiler.stage("box"):
+        mesh.calculate_box()
     if args["verbose"]: print(mesh.box)
 
     # if -t is set, transfer the test data onto the mesh too
@@ -187,46 +650,407 @@ def main():
         add_test_data(mesh)
     
 
-    mesh.calculate_limits()
+    with profiler.stage("limits"):
+        mesh.calculate_limits()
     if args["verbose"]: print(mesh)
 
-    original_verts = len(mesh.positions)
-    original_cells = mesh.get_cell_count()
+    if cache is not None:
+        with profiler.stage("cache_store"):
+            cache.store(cache_key, mesh, {"file": args["file-path"], "args": get_mesh_cache_args(args)})
 
-    # generate the tree
-    if args["verbose"]: print("Generating tree...")
-    tree = Tree.generate_node_median(mesh, args["depth"], args["max_cells"], args["verbose"])
+    return mesh
+
+
+# generates the node values and leaf meshes for a tree over the mesh and writes the outputs
+# vert_order is the original index of each vertex if the mesh was reordered
+def process_tree(mesh, tree, args, original_verts, original_cells, vert_order=None, profiler=None):
+    profiler = profiler or StageProfiler(args["output"])
 
     if args["verbose"]: print("Serialising tree...")
-    node_buffer, cells_buffer = tree.convert_to_buffers()
+    with profiler.stage("serialise"):
+        node_buffer, cells_buffer = tree.convert_to_buffers(args["node_layout"], args["layout_top_depth"])
+
+    # the blocks are built from the cell buffer so this orders their cells and vertices
+    if args["reorder_leaves"]:
+        if args["verbose"]: print("Reordering leaf cells...")
+        with profiler.stage("reorder_leaves"):
+            reorder_leaf_cells(mesh, tree)
+
+    # find how values are gathered for the corners, ranges and leaves
+    # this is only needed if there are values, the tree is saved or vertices are shared
+    plan = None
+    if len(mesh.values) > 0 or args["save_tree"] or args["shared_verts"]:
+        if args["verbose"]: print("Generating gather plan...")
+        with profiler.stage("gather_plan"):
+            plan = generate_gather_plan(mesh, tree)
+
+        if args["corner_type"] == "polynomial":
+            if args["verbose"]: print("Generating polynomial fits...")
+            with profiler.stage("poly_plan"):
+                plan.update(generate_poly_plan(mesh, tree, plan))
+
+        # values of later time steps and updates are loaded in the original order
+        if vert_order is not None:
+            plan["vert_order"] = vert_order
+        # and with the vertices the cleanup removed
+        if mesh.source_verts is not None:
+            plan["source_verts"] = mesh.source_verts
 
     # generate the corner values
     if args["verbose"]: print("Generating corner values...")
-    corner_values = generate_corner_values(mesh, tree)
+    with profiler.stage("corner_values"):
+        corner_values = generate_corner_values(mesh, tree, plan)
 
     if args["verbose"]: print("Generating node value ranges...")
-    node_val_ranges = generate_node_val_ranges(mesh, tree)
+    with profiler.stage("ranges"):
+        node_val_ranges = generate_node_val_ranges(mesh, tree, plan)
+
+    # the client culls and skips nodes by the boxes of their cells rather than their split planes
+    if args["verbose"]: print("Generating node bounds...")
+    with profiler.stage("node_bounds"):
+        node_bounds = generate_node_bounds(mesh, tree, None if plan is None else plan["node_depth"])
 
     # split the mesh into blocks using the tree
     if args["verbose"]: print("Splitting mesh...")
-    leaf_meshes = split_mesh_at_leaves(mesh, tree)
+    with profiler.stage("split"):
+        leaf_meshes = split_mesh_at_leaves(mesh, tree)
     max_verts = max(map(lambda m : len(m.positions), leaf_meshes))
 
+    # build the treelets over each block so the client doesn't have to
+    treelets = None
+    treelet_info = None
+    if args["treelet_depth"] > 0:
+        if args["verbose"]: print("Generating treelets...")
+        with profiler.stage("treelets"):
+            treelets = generate_leaf_treelets(leaf_meshes, tree, args["treelet_depth"])
+        treelet_info = get_treelet_info(args["treelet_depth"], treelets)
+
+    # build coarse meshes for the top of the tree within the same budget as the leaves
+    lod_meshes = None
+    lod_nodes = None
+    if args["lod_depth"] >= 0:
+        if args["verbose"]: print("Generating lod meshes...")
+        with profiler.stage("lod_meshes"):
+            lod_meshes, lod_plan = generate_lod_meshes(mesh, tree, args["lod_depth"], tree.max_cells, max_verts, args["verbose"])
+        lod_nodes = lod_plan["lod_nodes"]
+        if plan is not None: plan.update(lod_plan)
+
+    # store the vertices on the boundaries between leaves in only one of them
+    # the full leaf meshes are kept for the exported info, treelets and max verts are unchanged
+    block_meshes = leaf_meshes
+    block_refs = None
+    if args["shared_verts"]:
+        if args["verbose"]: print("Encoding shared vertices...")
+        with profiler.stage("shared_verts"):
+            shared_plan = generate_shared_plan(plan)
+            block_meshes, block_refs = encode_shared_meshes(leaf_meshes, plan, shared_plan)
+        # only the owned vertices are needed to update the values
+        plan["shared_owned_verts"] = shared_plan["shared_owned_verts"]
+        plan["shared_owned_offsets"] = shared_plan["shared_owned_offsets"]
+
+    # precompute the compact geometry, boxes cover all vertices of the full blocks
+    quants = None
+    lod_quants = None
+    if args["quantise"]:
+        if args["verbose"]: print("Quantising geometry...")
+        with profiler.stage("quantise"):
+            quants = [generate_quantised_geometry(b, m.positions) for b, m in zip(block_meshes, leaf_meshes)]
+            if lod_meshes is not None:
+                lod_quants = [generate_quantised_geometry(m, m.positions) for m in lod_meshes]
+
     # export the tree info as csv files
     if args["export"]:
         if args["verbose"]: print("Exporting info...")
-        export_meshes_info(args["output"], leaf_meshes)
-        export_overview_info(args["output"], original_verts, original_cells, args["max_cells"], leaf_meshes)
+        with profiler.stage("export"):
+            export_meshes_info(args["output"], leaf_meshes)
+            export_overview_info(args["output"], original_verts, original_cells, args["max_cells"], leaf_meshes)
 
     if not args["no_files"]:
+        # the mesh holds the values of the first time step
+        time_steps = get_time_steps(args)
+
         # create partial cgns file for client to load
         if args["verbose"]: print("Creating partial out file...")
-        save_partial_data(args["output"], tree, max_verts, corner_values, node_val_ranges, mesh.limits)
+        with profiler.stage("write_partial"):
+            save_partial_data(
+                args["output"], 
+                tree, 
+                max_verts, 
+                corner_values, 
+                node_val_ranges, 
+                mesh.limits, 
+                time_steps[0], 
+                treelet_info, 
+                CORNER_VALUE_TYPES[args["corner_type"]],
+                lod_nodes,
+                args["quantise"],
+                node_bounds
+            )
 
         # create mesh cgns file for server to serve blocks from
         if args["verbose"]: print("Creating full mesh out file...")
-        save_block_mesh_data(args["output"], leaf_meshes, tree, max_verts)
+        # large files are split into shards by leaf range behind a manifest
+        save_blocks = save_block_mesh_data
+        if args["shards"] > 1:
+            save_blocks = partial(save_sharded_block_mesh_data, args["shards"])
+
+        with profiler.stage("write_block_mesh"):
+            save_blocks(
+                args["output"], 
+                block_meshes, 
+                tree, 
+                max_verts, 
+                time_steps[0], 
+                get_output_options(args), 
+                treelets, 
+                treelet_info, 
+                lod_meshes,
+                block_refs,
+                quants,
+                lod_quants
+            )
+
+        # index the full blocks, with all of their vertices if they are shared
+        if args["verbose"]: print("Writing block index...")
+        with profiler.stage("write_block_index"):
+            save_block_index(
+                args["output"],
+                leaf_meshes + (lod_meshes or []),
+                node_val_ranges,
+                time_steps[0],
+                None if quants is None else quants + (lod_quants or [])
+            )
+
+        if args["save_tree"]:
+            if args["verbose"]: print("Saving tree...")
+            with profiler.stage("save_tree"):
+                save_tree_sidecar(args["output"], tree, max_verts, len(mesh.positions), plan)
+
+        # add the values of any other time steps, the geometry is only stored once
+        if len(mesh.values) == 0: return
+        for t_index in time_steps[1:]:
+            with profiler.stage("load_values_T%i" % t_index):
+                values = load_step_values(args, t_index, len(mesh.positions), mesh.source_verts)
+            if values is None:
+                print("Could not load values for time step %i, skipping..." % t_index)
+                continue
+
+            with profiler.stage("write_update_T%i" % t_index):
+                write_scalar_update(args["output"], plan, tree.node_buffer, values, t_index, args["verbose"], get_output_options(args))
+
+
+# loads the values of a time step to add to a mesh with vert_count vertices
+# source_verts is the index in the file of each vertex before mirroring if the cleanup removed any
+def load_step_values(args, t_index, vert_count, source_verts=None):
+    values = load_values_from_file(args["file-path"], args["scalars"], args["data_type"], args["verbose"], t_index)
+    if values is None: return
+
+    if source_verts is not None:
+        values = {name: buff[source_verts] for name, buff in values.items()}
+
+    # mirroring duplicates the vertices for every combination of mirrors
+    if args["mirror_x"] is not None and args["mirror_y"] is not None and args["mirror_z"] is not None:
+        values = {name: np.tile(buff, 8) for name, buff in values.items()}
+
+    for name, buff in values.items():
+        if len(buff) != vert_count:
+            print("%s has %i values but the tree was built for %i vertices" % (name, len(buff), vert_count))
+            return
+    
+    return values
+
+
+# writes the scalar data of a time step into existing output files using the gather plan
+# replaces any existing data for the same scalars and time step
+def write_scalar_update(out_name, plan, node_buffer, values, t_index, verbose=False, options=None):
+    # the plan refers to the vertices of the reordered mesh
+    if "vert_order" in plan:
+        values = {name: buff[plan["vert_order"]] for name, buff in values.items()}
+
+    limits = {name: {"min": np.min(buff), "max": np.max(buff)} for name, buff in values.items()}
+
+    if verbose: print("Generating corner values...")
+    corner_values = {name: gather_node_corner_values_buffer(buff, node_buffer, plan) for name, buff in values.items()}
 
+    if verbose: print("Generating node value ranges...")
+    node_val_ranges = {name: gather_node_val_range_buffer(buff, node_buffer, plan) for name, buff in values.items()}
+
+    if verbose: print("Updating partial out file...")
+    with h5py.File(f"{out_name}_partial.cgns", "r+") as file:
+        node_zone_grp = file["Base/NodeZone"]
+        write_node_values(node_zone_grp, corner_values, node_val_ranges, limits, t_index)
+        add_time_step(node_zone_grp, t_index)
+
+    if verbose: print("Updating full mesh out file...")
+    with h5py.File(get_block_mesh_path(out_name), "r+") as file:
+        base_grp = file["Base"]
+        add_time_step(base_grp, t_index)
+
+        if "BlockIndex" in base_grp:
+            write_block_index_ranges(base_grp["BlockIndex"], node_val_ranges, t_index)
+
+        if "ShardManifest" not in base_grp:
+            write_block_values(base_grp, plan, values, t_index, options)
+            return
+        
+        shard_starts, shard_paths = read_shard_manifest(file.filename, base_grp["ShardManifest"])
+
+    # each shard holds the blocks from its start up to the next shard's
+    shard_ends = np.append(shard_starts[1:], np.iinfo(np.int64).max)
+    for shard_path, node_range in zip(shard_paths, zip(shard_starts, shard_ends)):
+        with h5py.File(shard_path, "r+") as file:
+            add_time_step(file["Base"], t_index)
+            write_block_values(file["Base"], plan, values, t_index, options, node_range)
+
+
+# the slice of the rows of the sorted nodes that are within the [start, end) node range, all if it is None
+def get_node_range_rows(nodes, node_range=None):
+    if node_range is None: return slice(0, len(nodes))
+    return slice(*np.searchsorted(nodes, node_range))
+
+
+# writes the values of the blocks within the node range, or of all blocks, into the base group of a block mesh file
+def write_block_values(base_grp, plan, values, t_index, options=None, node_range=None):
+    # blocks with shared vertices only hold the values of those they own
+    shared = "shared_owned_verts" in plan
+    leaf_rows = get_node_range_rows(plan["leaf_nodes"], node_range)
+    lod_rows = get_node_range_rows(plan["lod_nodes"], node_range) if "lod_nodes" in plan else slice(0, 0)
+
+    if "PackedBlocks" in base_grp:
+        # leaves are packed in ascending node order, as in the plan
+        if shared:
+            block_verts, offsets = plan["shared_owned_verts"], plan["shared_owned_offsets"]
+        else:
+            block_verts, offsets = plan["leaf_verts"], plan["leaf_vert_offsets"]
+        block_verts = block_verts[offsets[leaf_rows.start] : offsets[leaf_rows.stop]]
+
+        sol_name = get_time_step_name("FlowSolution", t_index)
+        sol_grp = require_cgns_subgroup(base_grp["PackedBlocks"], sol_name, "FlowSolution_t", "MT")
+        for name, buff in values.items():
+            overwrite_cgns_subgroup(sol_grp, name, "DataArray_t", "R4", buff[block_verts], options)
+
+        if "PackedLodBlocks" in base_grp:
+            lod_sol_grp = require_cgns_subgroup(base_grp["PackedLodBlocks"], sol_name, "FlowSolution_t", "MT")
+            for name, buff in values.items():
+                lod_vals = np.concatenate(gather_lod_values(buff, plan)[lod_rows])
+                overwrite_cgns_subgroup(lod_sol_grp, name, "DataArray_t", "R4", lod_vals, options)
+        return
+
+    gather_block_values = gather_owned_values if shared else gather_leaf_values
+    leaf_values = {name: gather_block_values(buff, plan)[leaf_rows] for name, buff in values.items()}
+    zone_values = [(plan["leaf_nodes"][leaf_rows], leaf_values)]
+    if "lod_nodes" in plan:
+        lod_values = {name: gather_lod_values(buff, plan)[lod_rows] for name, buff in values.items()}
+        zone_values.append((plan["lod_nodes"][lod_rows], lod_values))
+
+    for node_indices, block_values in zone_values:
+        for i, node_index in enumerate(node_indices):
+            zone_grp = base_grp["Zone%i" % node_index]
+            sol_grp = require_cgns_subgroup(zone_grp, get_time_step_name("FlowSolution", t_index), "FlowSolution_t", "MT")
+            for name in values:
+                overwrite_cgns_subgroup(sol_grp, name, "DataArray_t", "R4", block_values[name][i], options)
+
+
+# regenerates only the scalar data of existing output files using the saved tree
+# used when the mesh is unchanged but values are added, or for new time steps
+def update_scalars(args, profiler=None):
+    profiler = profiler or StageProfiler(args["output"])
+    try:
+        plan = load_tree_sidecar(args["output"])
+    except OSError:
+        print("Could not open %s_tree.npz, generate the files with --save-tree first" % args["output"])
+        return
+    
+    vert_count = plan["tree_data"][4]
+
+    for t_index in get_time_steps(args):
+        if args["verbose"]: print("Updating time step %i..." % t_index)
+        with profiler.stage("load_values_T%i" % t_index):
+            values = load_step_values(args, t_index, vert_count, plan.get("source_verts"))
+        if values is None:
+            print("Could not load values, exiting...")
+            return
+
+        with profiler.stage("write_update_T%i" % t_index):
+            write_scalar_update(args["output"], plan, plan["node_buffer"], values, t_index, args["verbose"], get_output_options(args))
+
+
+# the vertex budget and straddling cell policy arguments of the tree generation
+def get_split_args(args):
+    return args["max_verts"], args["straddle"], args["nudge_tolerance"]
+
+
+# whether the straddling cell policy can be used with the other arguments, prints why not if it can't
+def check_split_args(args):
+    # the client finds the cells at a point by the split planes, which misses cells assigned to one side
+    if args["straddle"] == "centroid" and not args["no_files"]:
+        print("The centroid straddle policy can only be used with -n")
+        return False
+
+    return True
+
+
+# reports how much the centroid straddle policy extends the leaves beyond their split planes
+def report_split_growth(tree, args):
+    if args["straddle"] != "centroid": return
+    print("Leaf bounds are extended by %.3fx in volume on average, %.3fx at most" % tree.get_bounds_growth())
+
+
+# splits the largest leaves of the tree if requested and reports how much the block size shrank
+def split_tree_outliers(mesh, tree, args):
+    if args["verbose"]: print("Splitting outlier leaves...")
+    result = tree.split_outliers(mesh, args["depth"], args["split_outliers"], args["verbose"])
+    print(
+        "Split %i outlier leaves, max cells %i -> %i, max verts %i -> %i" % 
+        (result["split_count"], *result["max_cells"], *result["max_verts"])
+    )
+
+
+# runs a full conversion with the parsed arguments
+def run(args):
+    if args["verbose"]: print(args)
+    profiler = create_profiler(args)
+
+    if args["update"]:
+        update_scalars(args, profiler)
+        profiler.write_report(get_profile_info(args))
+        return
+
+    if not check_split_args(args):
+        print("Exiting...")
+        return
+
+    mesh = prepare_mesh(args, profiler)
+    if mesh is None: 
+        print("Could not load mesh, exiting...")
+        return
+
+    original_verts = len(mesh.positions)
+    original_cells = mesh.get_cell_count()
+
+    vert_order = None
+    if args["reorder_mesh"]:
+        if args["verbose"]: print("Reordering mesh...")
+        with profiler.stage("reorder_mesh"):
+            vert_order = reorder_mesh(mesh)
+
+    # generate the tree
+    if args["verbose"]: print("Generating tree...")
+    with profiler.stage("tree_build"):
+        tree = Tree.generate_node_median(mesh, args["depth"], args["max_cells"], args["verbose"], *get_split_args(args))
+
+    if args["split_outliers"] is not None:
+        with profiler.stage("split_outliers"):
+            split_tree_outliers(mesh, tree, args)
+
+    report_split_growth(tree, args)
+
+    process_tree(mesh, tree, args, original_verts, original_cells, vert_order, profiler)
+    profiler.write_report(get_profile_info(args, original_verts, original_cells))
+
+
+def main():
+    run(vars(create_parser().parse_args()))
 
 
 if __name__ == "__main__":
@@ -4,91 +4,212 @@
 from modules.utils import *
 import numpy as np
 import math
+from functools import partial
 
 
-def create_cgns_subgroup(group, name, label, type, data=None):
+# the default output options, writes contiguous uncompressed datasets
+DEFAULT_OUTPUT_OPTIONS = {
+    # "gzip", "lzf" or None
+    "compression": None,
+    # gzip level 0-9, None for the h5py default
+    "compression_level": None,
+    "shuffle": False,
+    # chunk length in elements, None for automatic chunking when filters are used
+    "chunk_size": None,
+    # use the latest hdf5 file format
+    "libver_latest": False,
+    # page size in bytes for paged aggregation, None for the default file space strategy
+    "page_size": None,
+    # store the leaf data as slices of one dataset per field
+    "packed": False,
+}
+
+
+# h5py dataset creation keyword arguments for the output options
+def get_dataset_kwargs(data, options):
+    kwargs = {}
+    # filters and chunking can't be used with empty datasets
+    if options is None or len(data) == 0: return kwargs
+
+    if options["compression"] is not None:
+        kwargs["compression"] = options["compression"]
+        if options["compression"] == "gzip" and options["compression_level"] is not None:
+            kwargs["compression_opts"] = options["compression_level"]
+    if options["shuffle"]:
+        kwargs["shuffle"] = True
+    if options["chunk_size"] is not None:
+        # chunks can't be larger than the dataset
+        kwargs["chunks"] = (min(options["chunk_size"], len(data)),)
+
+    return kwargs
+
+
+# h5py file keyword arguments for the output options
+def get_file_kwargs(options):
+    kwargs = {}
+    if options is None: return kwargs
+
+    if options["libver_latest"]:
+        kwargs["libver"] = "latest"
+    if options["page_size"] is not None:
+        kwargs["fs_strategy"] = "page"
+        kwargs["fs_page_size"] = options["page_size"]
+
+    return kwargs
+
+
+# options are the output options used for the data array, if any
+def create_cgns_subgroup(group, name, label, type, data=None, options=None):
     sub_grp = group.create_group(name)
     sub_grp.attrs["name"] = name
     sub_grp.attrs["label"] = label
     sub_grp.attrs["type"] = type
     if data is not None:
-        sub_grp.create_dataset(" data", data=data)
+        sub_grp.create_dataset(" data", data=data, **get_dataset_kwargs(data, options))
     
     return sub_grp
 
 
+# returns the existing subgroup with this name or creates a new one
+def require_cgns_subgroup(group, name, label, type):
+    if name in group: return group[name]
+    return create_cgns_subgroup(group, name, label, type)
+
+
+# creates a subgroup, replacing any existing subgroup with the same name
+def overwrite_cgns_subgroup(group, name, label, type, data=None, options=None):
+    if name in group: del group[name]
+    return create_cgns_subgroup(group, name, label, type, data, options)
+
+
 def get_zone_value_names(zone_node):
     flow_sol = zone_node["FlowSolution"]
     return list(flow_sol.keys())
 
-def get_zone_positions(zone_grp):
-      # check if this is unstructured
-    if charcodes_to_string(zone_grp["ZoneType/ data"]) != "Unstructured":
-        raise TypeError("Dataset mesh is not unstructured")
-    
-    coords_grp = zone_grp["GridCoordinates"]
-    # print(list(coords_node.keys()))
-    x_dset = coords_grp["CoordinateX/ data"]
-    x_pos = np.empty(x_dset.shape, dtype=x_dset.dtype)
-    x_dset.read_direct(x_pos)
-    
-    y_dset = coords_grp["CoordinateY/ data"]
-    y_pos = np.empty(y_dset.shape, dtype=y_dset.dtype)
-    y_dset.read_direct(y_pos)
-    
-    z_dset = coords_grp["CoordinateZ/ data"]
-    z_pos = np.empty(z_dset.shape, dtype=z_dset.dtype)
-    z_dset.read_direct(z_pos)
 
-    return np.array([x_pos, y_pos, z_pos]).transpose()
+# the names of the values present in every one of the zones, in the order of the first
+def get_zones_value_names(zone_grps):
+    return [
+        name for name in get_zone_value_names(zone_grps[0]) 
+        if all(name in zone_grp["FlowSolution"] for zone_grp in zone_grps[1:])
+    ]
 
-def get_zone_values(zone_grp, val_names):
-    # check if this is unstructured
-    if charcodes_to_string(zone_grp["ZoneType/ data"]) != "Unstructured":
-        raise TypeError("Dataset mesh is not unstructured")
-    
-    # retrieve vertex scalar data
-    values = {}
-    for name in val_names:
-        try:
-            values[name] = np.array(zone_grp["FlowSolution"][name][" data"], copy=True)
-        except:
-            print("Couldn't load array", name)
-    
-    return values
 
-def get_zone_tet_conn(zone_grp):
-    # check if this is unstructured
-    if charcodes_to_string(zone_grp["ZoneType/ data"]) != "Unstructured":
-        raise TypeError("Dataset mesh is not unstructured")
-    
-    elements_groups = []
-    conn_len = 0
+def is_unstructured_zone(zone_grp):
+    return charcodes_to_string(zone_grp["ZoneType/ data"]) == "Unstructured"
+
+
+# every unstructured zone of every base in the file, in file order
+def get_unstructured_zones(file):
+    group_type = type(file["/"])
+    zone_grps = []
+    for base_grp in file.values():
+        if type(base_grp) != group_type or base_grp.attrs.get("label") != b"CGNSBase_t": continue
+        for zone_grp in base_grp.values():
+            if type(zone_grp) != group_type or zone_grp.attrs.get("label") != b"Zone_t": continue
+            if is_unstructured_zone(zone_grp): zone_grps.append(zone_grp)
+
+    if len(zone_grps) == 0:
+        raise TypeError("Dataset has no unstructured zones")
+
+    return zone_grps
 
-    # get the total connectivity array length
+
+def get_zone_vert_count(zone_grp):
+    return len(zone_grp["GridCoordinates/CoordinateX/ data"])
+
+
+# the index of the first vertex of each zone once they are merged, and the total vertex count
+def get_zone_vert_starts(zone_grps):
+    counts = [get_zone_vert_count(zone_grp) for zone_grp in zone_grps]
+    return [int(start) for start in np.cumsum([0] + counts[:-1])], sum(counts)
+
+
+# the element groups of the zone holding cells of the given type
+def get_zone_element_groups(zone_grp, element_type):
+    elements_groups = []
     for child in zone_grp.values():
         if type(child) != type(zone_grp): continue
         # child is group
         if child.attrs["label"] != b'Elements_t': continue
         # group is elements group
-        if child[" data"][0] != CGNS_ELEMENT_INTS["tet"]: continue
-        # group contains tets
-        
+        if child[" data"][0] != CGNS_ELEMENT_INTS[element_type]: continue
+        # group contains cells of this type
         elements_groups.append(child)
-        conn_len += len(child["ElementConnectivity/ data"])
 
-    
+    return elements_groups
+
+
+# reads the whole of a 1d dataset into out from start on the executor
+# after is then called with the slice of out it was read into
+def submit_read(executor, dset, out, start, after=None):
+    def read():
+        if len(dset) > 0:
+            dset.read_direct(out, np.s_[:], np.s_[start:start + len(dset)])
+        if after is not None: after(out[start:start + len(dset)])
+
+    return executor.submit(read)
+
+
+# waits for the reads to complete, raising any of their errors
+def wait_for_reads(reads):
+    for read in reads: read.result()
 
-    connectivity = np.empty(conn_len, dtype=np.uint32)
-    curr_offset = 0
 
-    for group in elements_groups:
-        # read connectivity information
-        con_dset = group["ElementConnectivity/ data"]
-        con_dset.read_direct(connectivity, np.s_[:], np.s_[curr_offset:curr_offset + len(con_dset)])
-        curr_offset += len(con_dset)
+# reads of the vertex positions of the zones into one (n, 3) array, one read per axis per zone
+# returns the positions and the reads, which must be waited for before they are used
+def get_zones_positions(zone_grps, executor):
+    vert_starts, vert_count = get_zone_vert_starts(zone_grps)
+    axis_names = ["CoordinateX", "CoordinateY", "CoordinateZ"]
+    dtype = np.result_type(*(zone_grp["GridCoordinates"][name][" data"].dtype for zone_grp in zone_grps for name in axis_names))
 
-    # correct for 1-based indexing
-    # connectivity -= 1
+    # the axes are each contiguous for read_direct, the positions are their transpose
+    coords = np.empty((3, vert_count), dtype=dtype)
+    reads = []
+    for zone_grp, vert_start in zip(zone_grps, vert_starts):
+        for axis, name in enumerate(axis_names):
+            reads.append(submit_read(executor, zone_grp["GridCoordinates"][name][" data"], coords[axis], vert_start))
+
+    return coords.transpose(), reads
+
+
+# reads of the values with these names of the zones into one array each
+# returns the values and the reads, which must be waited for before they are used
+def get_zones_values(zone_grps, val_names, executor):
+    vert_starts, vert_count = get_zone_vert_starts(zone_grps)
+
+    values = {}
+    reads = []
+    for name in val_names:
+        dsets = [zone_grp["FlowSolution"][name][" data"] for zone_grp in zone_grps]
+        values[name] = np.empty(vert_count, dtype=np.result_type(*(dset.dtype for dset in dsets)))
+        for dset, vert_start in zip(dsets, vert_starts):
+            reads.append(submit_read(executor, dset, values[name], vert_start))
+
+    return values, reads
+
+
+# reads of the connectivity of the elements of this type in all of the zones into one array, with one read per element group
+# the indices are made 0 based and offset by the first vertex of their zone as each group is read
+# returns the connectivity and the reads, which must be waited for before it is used
+def get_zones_element_conn(zone_grps, element_type, executor):
+    vert_starts, vert_count = get_zone_vert_starts(zone_grps)
+    
+    zone_elements = [get_zone_element_groups(zone_grp, element_type) for zone_grp in zone_grps]
+    conn_len = sum(len(group["ElementConnectivity/ data"]) for groups in zone_elements for group in groups)
+    connectivity = np.empty(conn_len, dtype=np.uint32 if vert_count < 2**32 else np.uint64)
+
+    # correct for 1-based indexing and move to the zone's vertices
+    def offset_indices(vert_start, section):
+        section -= 1
+        if vert_start > 0: section += vert_start
+
+    reads = []
+    curr_offset = 0
+    for groups, vert_start in zip(zone_elements, vert_starts):
+        for group in groups:
+            con_dset = group["ElementConnectivity/ data"]
+            reads.append(submit_read(executor, con_dset, connectivity, curr_offset, partial(offset_indices, vert_start)))
+            curr_offset += len(con_dset)
 
-    return connectivity
\ No newline at end of file
+    return connectivity, reads
@@ -0,0 +1,80 @@
+# cleanup.py
+# removes the cells and vertices of a loaded mesh that add nothing to it
+# > degenerate cells, with zero volume or a repeated vertex, and repeats of a cell with the same vertices
+# > vertices no cell uses, such as those of removed cells, which would otherwise be carried through every stage
+# > the remaining vertices keep their order, the index in the loaded mesh of each is kept so values loaded later
+#   can be matched to them
+
+import numpy as np
+
+
+# the number of cells whose volumes are found at once
+VOLUME_CHUNK_CELLS = 2**22
+
+
+# six times the signed volume of each tet, in double precision
+def get_cell_volumes(positions, cells):
+    volumes = np.empty(len(cells), dtype=np.float64)
+    for start in range(0, len(cells), VOLUME_CHUNK_CELLS):
+        corners = positions[cells[start : start + VOLUME_CHUNK_CELLS]].astype(np.float64)
+        edges = corners[:, 1:] - corners[:, :1]
+        volumes[start : start + VOLUME_CHUNK_CELLS] = np.einsum("ij,ij->i", np.cross(edges[:, 0], edges[:, 1]), edges[:, 2])
+
+    return volumes
+
+
+# whether each cell has zero volume, which includes those with a repeated vertex
+def get_degenerate_cells(positions, cells):
+    return get_cell_volumes(positions, cells) == 0
+
+
+# whether each cell has the same vertices as an earlier cell, in any order
+def get_duplicate_cells(cells):
+    sorted_cells = np.sort(cells, axis=1)
+    # stable, so the first of each set of duplicates is kept
+    order = np.lexsort(sorted_cells.T[::-1])
+    sorted_cells = sorted_cells[order]
+
+    duplicate = np.zeros(len(cells), dtype=bool)
+    duplicate[order[1:]] = np.all(sorted_cells[1:] == sorted_cells[:-1], axis=1)
+    return duplicate
+
+
+# removes the vertices no cell uses and renumbers the connectivity
+# returns the index of each remaining vertex in the mesh before, or None if every vertex is used
+def remove_unused_verts(mesh):
+    used = np.zeros(len(mesh.positions), dtype=bool)
+    used[mesh.connectivity] = True
+    if np.all(used): return
+
+    new_index = (np.cumsum(used) - 1).astype(mesh.connectivity.dtype)
+    mesh.connectivity = new_index[mesh.connectivity]
+    mesh.positions = mesh.positions[used]
+    mesh.values = {name: buff[used] for name, buff in mesh.values.items()}
+
+    return np.flatnonzero(used)
+
+
+# removes the degenerate and duplicate cells then the unused vertices of the mesh
+# sets mesh.source_verts to the index in the loaded mesh of each vertex if any were removed
+# returns the number of each removed
+def clean_mesh(mesh, verbose=False):
+    cells = np.reshape(mesh.connectivity, (-1, 4))
+
+    if verbose: print("Finding degenerate cells...")
+    degenerate = get_degenerate_cells(mesh.positions, cells)
+    if verbose: print("Finding duplicate cells...")
+    duplicate = get_duplicate_cells(cells) & ~degenerate
+
+    removed = degenerate | duplicate
+    if np.any(removed):
+        mesh.connectivity = cells[~removed].ravel()
+
+    vert_count = len(mesh.positions)
+    mesh.source_verts = remove_unused_verts(mesh)
+
+    return {
+        "degenerate_cells": int(np.sum(degenerate)),
+        "duplicate_cells": int(np.sum(duplicate)),
+        "unused_verts": vert_count - len(mesh.positions),
+    }
@@ -0,0 +1,145 @@
+# decompose.py
+# splits pyramids, prisms and hexes into tets
+# > elements use the cgns vertex ordering, pyramids have their base first and the apex last, prisms and hexes
+#   have their bottom face first then the vertices above each in turn
+# > every quad face is split along the diagonal through its smallest vertex index, so neighbouring elements
+#   always split their shared faces the same way and the tets are conforming
+#   Dompierre et al. 1999, How to subdivide pyramids, prisms and hexahedra into tetrahedra
+# > each element is first permuted so its smallest vertex comes first, then split using the table of its case,
+#   both as gathers over the whole array
+# > the tets have positive volume if the element does
+
+import numpy as np
+
+
+# the number of vertices of each element type
+ELEMENT_VERT_COUNTS = {
+    "tet": 4,
+    "pyramid": 5,
+    "prism": 6,
+    "hex": 8,
+}
+
+# rotates the base so its first diagonal is through its smallest vertex, indexed by its position mod 2
+PYRAMID_PERMS = np.array([
+    [0, 1, 2, 3, 4],
+    [1, 2, 3, 0, 4],
+])
+PYRAMID_TETS = np.array([[0, 1, 2, 4], [0, 2, 3, 4]])
+
+# moves each vertex to the first position, indexed by that vertex
+PRISM_PERMS = np.array([
+    [0, 1, 2, 3, 4, 5],
+    [1, 2, 0, 4, 5, 3],
+    [2, 0, 1, 5, 3, 4],
+    [3, 5, 4, 0, 2, 1],
+    [4, 3, 5, 1, 0, 2],
+    [5, 4, 3, 2, 1, 0],
+])
+# indexed by whether the quad face opposite the first vertex is split along 1-5 (0) or 2-4 (1)
+PRISM_TETS = np.array([
+    [[0, 1, 2, 5], [0, 1, 5, 4], [0, 4, 5, 3]],
+    [[0, 1, 2, 4], [0, 4, 2, 5], [0, 4, 5, 3]],
+])
+
+# moves each vertex to the first position, indexed by that vertex
+HEX_PERMS = np.array([
+    [0, 1, 2, 3, 4, 5, 6, 7],
+    [1, 0, 4, 5, 2, 3, 7, 6],
+    [2, 1, 5, 6, 3, 0, 4, 7],
+    [3, 0, 1, 2, 7, 4, 5, 6],
+    [4, 0, 3, 7, 5, 1, 2, 6],
+    [5, 1, 0, 4, 6, 2, 3, 7],
+    [6, 2, 1, 5, 7, 3, 0, 4],
+    [7, 3, 2, 6, 4, 0, 1, 5],
+])
+# rotations by 0, 120 and 240 degrees about the diagonal from the first vertex to vertex 6
+HEX_AXIS_PERMS = np.array([
+    [0, 1, 2, 3, 4, 5, 6, 7],
+    [0, 3, 7, 4, 1, 2, 6, 5],
+    [0, 4, 5, 1, 3, 7, 6, 2],
+])
+# indexed by how many of the three faces around vertex 6 are split through it
+# > with one, it is the face 1-2-6-5, with two, the face 4-5-6-7 is not
+# > the first case is 5 tets, the others are 6
+HEX_TETS = [
+    np.array([[1, 2, 0, 5], [3, 0, 2, 7], [4, 5, 0, 7], [6, 2, 5, 7], [0, 5, 2, 7]]),
+    np.array([[4, 5, 0, 7], [3, 0, 2, 7], [7, 1, 0, 2], [7, 0, 1, 5], [7, 1, 2, 6], [7, 1, 6, 5]]),
+    np.array([[4, 5, 0, 7], [6, 1, 0, 2], [6, 2, 0, 3], [6, 0, 1, 5], [6, 3, 0, 7], [6, 0, 5, 7]]),
+    np.array([[0, 6, 1, 2], [0, 6, 2, 3], [0, 6, 3, 7], [0, 6, 7, 4], [0, 6, 4, 5], [0, 6, 5, 1]]),
+]
+
+
+# whether the diagonal a-c of the quad a-b-c-d is through its smallest vertex
+def is_diagonal_smallest(a, c, b, d):
+    return np.minimum(a, c) < np.minimum(b, d)
+
+
+# permutes the vertices of each element, perms is indexed by case
+def permute_elements(elements, perms, cases):
+    return np.take_along_axis(elements, perms[cases], axis=1)
+
+
+def split_pyramids(pyramids):
+    pyramids = permute_elements(pyramids, PYRAMID_PERMS, np.argmin(pyramids[:, :4], axis=1) % 2)
+    return pyramids[:, PYRAMID_TETS]
+
+
+def split_prisms(prisms):
+    prisms = permute_elements(prisms, PRISM_PERMS, np.argmin(prisms, axis=1))
+    case = ~is_diagonal_smallest(prisms[:, 1], prisms[:, 5], prisms[:, 2], prisms[:, 4])
+    return np.take_along_axis(prisms, PRISM_TETS[case.astype(np.intp)].reshape(len(prisms), -1), axis=1)
+
+
+def split_hexes(hexes):
+    hexes = permute_elements(hexes, HEX_PERMS, np.argmin(hexes, axis=1))
+
+    # which of the faces around vertex 6 are split through it, named by their vertex adjacent to the first
+    through_1 = is_diagonal_smallest(hexes[:, 1], hexes[:, 6], hexes[:, 2], hexes[:, 5])
+    through_3 = is_diagonal_smallest(hexes[:, 3], hexes[:, 6], hexes[:, 2], hexes[:, 7])
+    through_4 = is_diagonal_smallest(hexes[:, 4], hexes[:, 6], hexes[:, 5], hexes[:, 7])
+    through_count = through_1.astype(np.intp) + through_3 + through_4
+
+    # rotate about the first vertex so the faces split through vertex 6 are those of the tables
+    rotation = np.zeros(len(hexes), dtype=np.intp)
+    one = through_count == 1
+    rotation[one] = np.where(through_3, 1, np.where(through_4, 2, 0))[one]
+    two = through_count == 2
+    rotation[two] = np.where(~through_1, 1, np.where(~through_3, 2, 0))[two]
+    hexes = permute_elements(hexes, HEX_AXIS_PERMS, rotation)
+
+    return np.concatenate([hexes[through_count == i][:, tets].reshape(-1, 4) for i, tets in enumerate(HEX_TETS)])
+
+
+SPLIT_FUNCTIONS = {
+    "pyramid": split_pyramids,
+    "prism": split_prisms,
+    "hex": split_hexes,
+}
+
+
+# the connectivity of the tets the elements of this type are split into
+# elements is their connectivity, flat or one row per element
+def decompose_to_tets(elements, element_type):
+    elements = np.reshape(elements, (-1, ELEMENT_VERT_COUNTS[element_type]))
+    if element_type == "tet": return elements.ravel()
+
+    return SPLIT_FUNCTIONS[element_type](elements).ravel()
+
+
+# the connectivity of the tets of the elements of every type, as one array
+# elements is the connectivity of the elements of each type
+def elements_to_tets(elements, verbose=False):
+    parts = []
+    for element_type, conn in elements.items():
+        # conn may be flat or have a row per element
+        count = np.size(conn) // ELEMENT_VERT_COUNTS[element_type]
+        if count == 0: continue
+        if verbose: print("%i %s elements" % (count, element_type))
+        parts.append(decompose_to_tets(conn, element_type))
+
+    if len(parts) == 0: return np.empty(0, dtype=np.uint32)
+    # only tets, the common case, isn't copied
+    if len(parts) == 1: return parts[0]
+
+    return np.concatenate(parts)
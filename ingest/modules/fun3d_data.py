@@ -24,7 +24,8 @@ class File ():
         
         self.__bytes_per_t_step = (self.__header["n_nodes"] * self.__header["n_variables"] + 1) * 4
 
-        self.__t_step_count = len(self.__file_bytes)//self.__bytes_per_t_step
+        # the header isn't part of the time step data
+        self.__t_step_count = (len(self.__file_bytes) - self.__header["bytes"])//self.__bytes_per_t_step
 
     def __extract_header(self):
         # current byte position
@@ -68,6 +69,9 @@ class File ():
     def get_variable_names(self):
         return self.__header["variables"]
     
+    def get_t_step_count(self):
+        return self.__t_step_count
+    
     def get_value_array(self, name, t_index = 0):
         if t_index >= self.__t_step_count:
             # past the maximum time step
@@ -1,16 +1,18 @@
 # leaf_mesh.py
-import cProfile
 from modules.utils import *
 from modules.mesh import Mesh
 import celltools
 
 
-def get_containing_cell(pos, node, mesh, tree):
+# the depth of each node, wide enough for any -d as a uint8 would wrap above 255
+NODE_DEPTH_DTYPE = np.uint16
+
+
+def get_containing_cell(pos, cells, mesh):
     m_con = np.reshape(mesh.connectivity, (-1, 4))
     m_pos = mesh.positions
     cell = {}
 
-    cells = tree.cell_buffer[node["left_ptr"] : node["left_ptr"] + node["cell_count"]]
     for cell_id in cells:        
         if not celltools.point_in_cell_bounds4(pos, cell_id, m_pos, m_con): continue
 
@@ -26,12 +28,11 @@ def get_containing_cell(pos, node, mesh, tree):
     return None
 
 
-def sample_vals_with_cell(vals, cell):
-    return np.dot(vals[cell["points_indices"]], cell["factors"])
-
-
-def get_leaf_corner_vals(mesh, vals, node, box, tree):
-    corner_vals = np.empty(8, dtype=np.float32)
+# finds the vertices and interpolation factors that sample the values at each corner of a leaf
+# these don't depend on the values, so can be reused for every values buffer
+def get_leaf_corner_weights(mesh, cells, box):
+    indices = np.zeros((8, 4), dtype=np.uint32)
+    factors = np.zeros((8, 4), dtype=np.float64)
 
     points = [
         np.array(box["min"], np.float32),
@@ -44,44 +45,55 @@ def get_leaf_corner_vals(mesh, vals, node, box, tree):
         np.array(box["max"], np.float32),
     ]
     for i, point in enumerate(points):
-        cell = get_containing_cell(point, node, mesh, tree)
-        if cell is not None:
-            corner_vals[i] = sample_vals_with_cell(vals, cell)
-            continue
-        
-
-        # // use the nearest vertex instead
-        # const vert = tree.getClosestVertexInLeaf(point, leafNode);
-        # if (vert.index !== undefined) {
-        #     cornerVals[i] = dataBuff[vert.index];
-        #     continue;
-        # }
+        cell = get_containing_cell(point, cells, mesh)
+        # if not found, the leaf likely has no cells
+        # the zero factors then give a corner value of 0
+        if cell is None: continue
 
-        # leaf likely has no cells, default to 0
-        corner_vals[i] = 0
+        indices[i] = cell["points_indices"]
+        factors[i] = cell["factors"]
     
-    return corner_vals
+    return indices, factors
 
 
-def merge_corner_vals(corner_vals, split_dim, left_ptr, right_ptr):
-    left_corners = corner_vals[left_ptr]
-    right_corners = corner_vals[right_ptr]
-    this_corners = np.empty(8, dtype=np.float32)
+# finds the global vertex indices of each leaf's block mesh
+# vertices are in the order they are first referenced by the leaf's cells, as in split_mesh_at_leaves
+def get_leaf_vert_indices(mesh, tree, leaf_nodes):
+    node_buffer = tree.node_buffer
+    cell_counts = node_buffer["cell_count"][leaf_nodes].astype(np.int64)
+    cell_ptrs = tree.cell_offsets[leaf_nodes]
 
-    # select which is coincident with the parent node's corners
-    for i in range(8):
-        if (i >> split_dim & 1) == 1:
-            this_corners[i] = right_corners[i]
-        else:
-            this_corners[i] = left_corners[i]
-    
-    return this_corners
+    # gather the cells of all leaves into one contiguous list
+    seg_starts = np.cumsum(cell_counts) - cell_counts
+    leaf_cells = tree.cell_buffer[np.arange(cell_counts.sum()) + np.repeat(cell_ptrs - seg_starts, cell_counts)]
 
+    verts = np.reshape(mesh.connectivity, (-1, 4))[leaf_cells].ravel()
+    vert_leaves = np.repeat(np.arange(len(leaf_nodes), dtype=np.int64), cell_counts * 4)
 
-# generates corner values for a single values buffer
-def generate_corner_values_buffer(mesh, vals, tree):
+    # first occurrence of each vertex within each leaf
+    _, first = np.unique(vert_leaves * len(mesh.positions) + verts, return_index=True)
+    first.sort()
+
+    offsets = np.zeros(len(leaf_nodes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(vert_leaves[first], minlength=len(leaf_nodes)))
+
+    return verts[first].astype(np.uint32), offsets
+
+
+# creates the value-independent information needed to generate corner values and node ranges
+# > corner_indices, corner_factors: the vertices and factors sampled for each corner of each leaf
+# > corner_src: for each node and corner, the leaf whose corner value is used
+# > leaf_verts, leaf_vert_offsets: the global vertices in each leaf's block mesh
+def generate_gather_plan(mesh, tree):
     node_buffer = tree.node_buffer
-    corner_vals = np.empty((tree.node_count, 8), dtype=np.float32)
+    leaf_nodes = np.flatnonzero(node_buffer["right_ptr"] == 0)
+    # row of each leaf node within the per-leaf arrays
+    leaf_rows = np.cumsum(node_buffer["right_ptr"] == 0) - 1
+
+    corner_indices = np.zeros((len(leaf_nodes), 8, 4), dtype=np.uint32)
+    corner_factors = np.zeros((len(leaf_nodes), 8, 4), dtype=np.float64)
+    corner_src = np.empty((tree.node_count, 8), dtype=np.uint32)
+    node_depth = np.zeros(tree.node_count, dtype=NODE_DEPTH_DTYPE)
 
     # the next nodes to process
     queue = [ 
@@ -93,22 +105,19 @@ def generate_corner_values_buffer(mesh, vals, tree):
             "merge": False
         }
     ]
-    processed = 0
     while len(queue) > 0:
-        processed += 1
         item = queue.pop()
+        node_depth[item["index"]] = item["depth"]
 
         if item["node"]["right_ptr"] == 0:
-            # get the corner values for this box and write to buffer
-            # cProfile.runctx("get_leaf_corner_vals(mesh, vals, item['node'], item['box'], tree)", globals(), locals())
-            # input()
-            corner_vals[item["index"]] = get_leaf_corner_vals(
+            # find how to sample the corners of this leaf
+            leaf_row = leaf_rows[item["index"]]
+            corner_indices[leaf_row], corner_factors[leaf_row] = get_leaf_corner_weights(
                 mesh, 
-                vals, 
-                item["node"], 
-                item["box"], 
-                tree
+                tree.get_leaf_cells(item["index"]), 
+                item["box"]
             )
+            corner_src[item["index"]] = leaf_row
             
         elif not item["merge"]:
             # going down
@@ -146,131 +155,340 @@ def generate_corner_values_buffer(mesh, vals, tree):
 
         else:
             # going back up
-            # calculate the node corners from its children
+            # select which child's corners are coincident with this node's corners
             split_dim = item["depth"] % 3
-
-            corner_vals[item["index"]] = merge_corner_vals(
-                corner_vals, 
-                split_dim, 
-                item["node"]["left_ptr"],
-                item["node"]["right_ptr"]
+            right_corners = (np.arange(8) >> split_dim & 1) == 1
+            corner_src[item["index"]] = np.where(
+                right_corners,
+                corner_src[item["node"]["right_ptr"]],
+                corner_src[item["node"]["left_ptr"]]
             )
 
-    return corner_vals
+    leaf_verts, leaf_vert_offsets = get_leaf_vert_indices(mesh, tree, leaf_nodes)
 
-# externally called to generate all needed from the values that are in the mesh
-def generate_corner_values(mesh, tree):
     return {
-        name: generate_corner_values_buffer(mesh, mesh.values[name], tree)
-        for name in mesh.values
+        "leaf_nodes": leaf_nodes.astype(np.uint32),
+        "leaf_verts": leaf_verts,
+        "leaf_vert_offsets": leaf_vert_offsets,
+        "corner_indices": corner_indices,
+        "corner_factors": corner_factors,
+        "corner_src": corner_src,
+        "node_depth": node_depth,
     }
 
 
+# generates corner values for a single values buffer
+def gather_corner_values_buffer(vals, plan):
+    # sample the corners of all leaves at once
+    # matmul gives the same float64 result as a dot product of each corner's samples and factors
+    leaf_samples = vals[plan["corner_indices"]].astype(np.float64)[..., None, :]
+    leaf_corner_vals = np.matmul(leaf_samples, plan["corner_factors"][..., None])[..., 0, 0].astype(np.float32)
+
+    return leaf_corner_vals[plan["corner_src"], np.arange(8)]
+
+# polynomial corner values ======================================================
+# each node stores the coefficients of f(x,y,z) = a + bx + cy + dz + exy + fxz + gyz + hxyz
+# these are in data space coordinates, as evaluated by the client
+# fitting is done in coordinates normalised to the node box to keep the problems well conditioned
+
+# the polynomial terms of each coefficient as x, y, z exponents
+POLY_TERMS = np.array([
+    [0, 0, 0],
+    [1, 0, 0],
+    [0, 1, 0],
+    [0, 0, 1],
+    [1, 1, 0],
+    [1, 0, 1],
+    [0, 1, 1],
+    [1, 1, 1],
+], dtype=bool)
+
+# fractions of a child box along each axis where it is sampled when merging
+POLY_MERGE_SAMPLES = np.array([1/6, 1/2, 5/6])
+
+# how many leaves are fitted at once, limits the size of the padded arrays
+POLY_LEAF_BATCH = 1024
+
+
+# the value of each polynomial term at the given positions, shape (..., 8)
+def get_poly_basis(pos):
+    basis = np.ones((*pos.shape[:-1], 8), dtype=np.float64)
+    for i, term in enumerate(POLY_TERMS):
+        for d in np.flatnonzero(term):
+            basis[..., i] *= pos[..., d]
+
+    return basis
+
+
+# finds the box of every node as (node_count, 2, 3) min and max
+def get_node_boxes(node_buffer, node_depth, box):
+    boxes = np.empty((len(node_buffer), 2, 3), dtype=np.float64)
+    boxes[0] = box
+
+    branch = node_buffer["right_ptr"] != 0
+    for depth in range(int(node_depth.max())):
+        nodes = np.flatnonzero(branch & (node_depth == depth))
+        dim = depth % 3
+        split_vals = node_buffer["split_val"][nodes]
+        
+        left_ptrs = node_buffer["left_ptr"][nodes]
+        boxes[left_ptrs] = boxes[nodes]
+        boxes[left_ptrs, 1, dim] = split_vals
 
+        right_ptrs = node_buffer["right_ptr"][nodes]
+        boxes[right_ptrs] = boxes[nodes]
+        boxes[right_ptrs, 0, dim] = split_vals
 
-# node value ranges =============================================================
-def get_leaf_node_range(mesh, vals, node, tree):
-    range_vals = np.empty(2, dtype=np.float32)
-    m_con = np.reshape(mesh.connectivity, (-1, 4))
+    return boxes
 
-    # if no cells, return range = [0, 0]
-    if node["cell_count"] == 0: return np.zeros(2, dtype=np.float32)
 
-    cells = tree.cell_buffer[node["left_ptr"] : node["left_ptr"] + node["cell_count"]]
-    # initialise range
-    first_val = vals[m_con[cells[0]][0]]
-    range_vals[0] = first_val
-    range_vals[1] = first_val
+# finds the depth of every node, one level at a time from the root
+def get_node_depths(node_buffer):
+    node_depth = np.zeros(len(node_buffer), dtype=NODE_DEPTH_DTYPE)
+    branch = node_buffer["right_ptr"] != 0
 
-    for cell_id in cells:        
-        indices = m_con[cell_id]
-        cell_vals = vals[indices]
-        for val in cell_vals:
-            if range_vals[0] > val: range_vals[0] = val
-            if range_vals[1] < val: range_vals[1] = val
+    nodes = np.zeros(1, dtype=np.int64)
+    depth = 0
+    while len(nodes) > 0:
+        node_depth[nodes] = depth
+        nodes = nodes[branch[nodes]]
+        nodes = np.concatenate([node_buffer["left_ptr"][nodes], node_buffer["right_ptr"][nodes]]).astype(np.int64)
+        depth += 1
 
-    return range_vals
+    return node_depth
 
 
-def merge_node_range_vals(range_vals, left_ptr, right_ptr):
-    left_range = range_vals[left_ptr]
-    right_range = range_vals[right_ptr]
+# finds the tight box of the cells within every node as (node_count, 2, 3) min and max
+# leaves are bounded by the vertices of their cells clipped to their box, parents by the union of their children
+# > occupancy is 1 for nodes that contain any cells, empty nodes are given their full box
+def generate_node_bounds(mesh, tree, node_depth=None):
+    node_buffer = tree.node_buffer
+    if node_depth is None: node_depth = get_node_depths(node_buffer)
+    box = np.array([mesh.box["min"], mesh.box["max"]], dtype=np.float64)
+    node_boxes = get_node_boxes(node_buffer, node_depth, box)
+
+    # empty nodes keep an inverted box so they don't grow their parents
+    bounds = np.empty((len(node_buffer), 2, 3), dtype=np.float64)
+    bounds[:, 0] = np.inf
+    bounds[:, 1] = -np.inf
+
+    leaf_nodes = np.flatnonzero(node_buffer["right_ptr"] == 0)
+    cell_counts = node_buffer["cell_count"][leaf_nodes].astype(np.int64)
+    filled = cell_counts > 0
+    if np.any(filled):
+        cell_pos = mesh.positions[np.reshape(mesh.connectivity, (-1, 4))]
+        cell_min = cell_pos.min(axis=1)
+        cell_max = cell_pos.max(axis=1)
+        del cell_pos
+
+        # gather the cells of all leaves into one contiguous list
+        cell_ptrs = tree.cell_offsets[leaf_nodes]
+        seg_starts = np.cumsum(cell_counts) - cell_counts
+        leaf_cells = tree.cell_buffer[np.arange(cell_counts.sum()) + np.repeat(cell_ptrs - seg_starts, cell_counts)]
+
+        filled_nodes = leaf_nodes[filled]
+        bounds[filled_nodes, 0] = np.maximum(
+            np.minimum.reduceat(cell_min[leaf_cells], seg_starts[filled], axis=0),
+            node_boxes[filled_nodes, 0]
+        )
+        bounds[filled_nodes, 1] = np.minimum(
+            np.maximum.reduceat(cell_max[leaf_cells], seg_starts[filled], axis=0),
+            node_boxes[filled_nodes, 1]
+        )
+
+    branch = node_buffer["right_ptr"] != 0
+    for depth in range(int(node_depth.max()) - 1, -1, -1):
+        nodes = np.flatnonzero(branch & (node_depth == depth))
+        left_ptrs = node_buffer["left_ptr"][nodes]
+        right_ptrs = node_buffer["right_ptr"][nodes]
+        bounds[nodes, 0] = np.minimum(bounds[left_ptrs, 0], bounds[right_ptrs, 0])
+        bounds[nodes, 1] = np.maximum(bounds[left_ptrs, 1], bounds[right_ptrs, 1])
+
+    occupancy = np.isfinite(bounds[:, 0, 0])
+    bounds[~occupancy] = node_boxes[~occupancy]
+
+    return bounds.astype(np.float32), occupancy.astype(np.uint8)
+
+
+# the centre and half size of each box, positions are normalised to [-1, 1] with these
+def get_box_normalisation(boxes):
+    centre = 0.5 * (boxes[:, 0] + boxes[:, 1])
+    half_size = 0.5 * (boxes[:, 1] - boxes[:, 0])
+    # flat boxes are left unscaled in that axis
+    half_size[half_size == 0] = 1
+    return centre, half_size
+
+
+# converts coefficients of polynomials in normalised coordinates into data space coordinates
+# expands each term prod((x_d - c_d)/h_d) over the subsets of its axes
+def poly_coeffs_to_data_space(coeffs, centre, half_size):
+    data_coeffs = np.zeros_like(coeffs)
+    for i, term in enumerate(POLY_TERMS):
+        for j, sub_term in enumerate(POLY_TERMS):
+            # only terms made of a subset of the axes of this term contribute
+            if np.any(sub_term & ~term): continue
+            factor = coeffs[:, i].copy()
+            for d in np.flatnonzero(term):
+                if sub_term[d]:
+                    factor /= half_size[:, d]
+                else:
+                    factor *= -centre[:, d] / half_size[:, d]
+            data_coeffs[:, j] += factor
 
-    return np.array([
-        min(left_range[0], right_range[0]),
-        max(left_range[1], right_range[1]),
-    ], dtype=np.float32)
+    return data_coeffs
 
 
-def generate_node_val_range_buffer(mesh, vals, tree):
-    node_buffer = tree.node_buffer
-    node_range_vals = np.empty((tree.node_count, 2), dtype=np.float32)
+# least squares fits of the polynomial to the vertices of each leaf only depend on the positions
+# the pseudo-inverse rows of each leaf vertex are stored in the same order as leaf_verts so a fit
+# is the sum of these scaled by the vertex values
+def generate_poly_plan(mesh, tree, plan):
+    box = np.array([mesh.box["min"], mesh.box["max"]], dtype=np.float64)
+    node_boxes = get_node_boxes(tree.node_buffer, plan["node_depth"], box)
+    leaf_centre, leaf_half_size = get_box_normalisation(node_boxes[plan["leaf_nodes"]])
 
-    # the next nodes to process
-    queue = [ 
-        {
-            "node": node_buffer[0],
-            "index": 0,
-            "depth": 0,
-            "merge": False
-        }
-    ]
-    processed = 0
-    while len(queue) > 0:
-        processed += 1
-        item = queue.pop()
+    offsets = plan["leaf_vert_offsets"]
+    counts = np.diff(offsets)
+    leaf_pinv = np.zeros((len(plan["leaf_verts"]), 8), dtype=np.float64)
 
-        if item["node"]["right_ptr"] == 0:
-            # get the range for this leaf
-            node_range_vals[item["index"]] = get_leaf_node_range(mesh, vals, item["node"], tree)
-            
-        elif not item["merge"]:
-            # going down
-            # push itself to handle going back up the tree
-            queue.append({
-                "node": item["node"],
-                "index": item["index"],
-                "depth": item["depth"],
-                "merge": True
-            })
+    # fit batches of leaves at once, padded with empty rows which don't affect the fit
+    for start in range(0, len(counts), POLY_LEAF_BATCH):
+        batch = slice(start, start + POLY_LEAF_BATCH)
+        batch_counts = counts[batch]
+        if batch_counts.max(initial=0) == 0: continue
 
-            # add its children to the next nodes
-            left_node  = node_buffer[item["node"]["left_ptr"]]
-            queue.append({
-                "node": left_node,
-                "index": item["node"]["left_ptr"],
-                "depth": item["depth"] + 1,
-                "merge": False
-            })
+        pad_index = np.arange(batch_counts.max())
+        valid = pad_index < batch_counts[:, None]
+        vert_rows = np.where(valid, offsets[:-1][batch, None] + pad_index, 0)
 
-            right_node = node_buffer[item["node"]["right_ptr"]]
-            queue.append({
-                "node": right_node,
-                "index": item["node"]["right_ptr"],
-                "depth": item["depth"] + 1,
-                "merge": False
-            })
+        pos = mesh.positions[plan["leaf_verts"][vert_rows]].astype(np.float64)
+        norm_pos = (pos - leaf_centre[batch, None]) / leaf_half_size[batch, None]
+        design = np.where(valid[..., None], get_poly_basis(norm_pos), 0)
 
-        else:
-            # going back up
-            # calculate the node corners from its children
-            split_dim = item["depth"] % 3
+        # (leaves, 8, verts) -> rows of each valid vertex
+        batch_pinv = np.linalg.pinv(design).transpose(0, 2, 1)
+        leaf_pinv[vert_rows[valid]] = batch_pinv[valid]
+
+    return {
+        "poly_leaf_pinv": leaf_pinv,
+        "poly_box": box,
+    }
 
-            node_range_vals[item["index"]] = merge_node_range_vals(
-                node_range_vals, 
-                item["node"]["left_ptr"],
-                item["node"]["right_ptr"]
-            )
+
+# samples two child polynomials over their boxes and fits the parent polynomial to them
+# batched over all of the nodes given
+def merge_poly_coeffs(left_coeffs, right_coeffs, left_boxes, right_boxes, parent_boxes):
+    grid = np.stack(np.meshgrid(POLY_MERGE_SAMPLES, POLY_MERGE_SAMPLES, POLY_MERGE_SAMPLES, indexing="ij"), axis=-1)
+    grid = grid.reshape(-1, 3)
+
+    # sample positions in data space, (nodes, samples, 3)
+    left_pos = left_boxes[:, None, 0] + grid * (left_boxes[:, None, 1] - left_boxes[:, None, 0])
+    right_pos = right_boxes[:, None, 0] + grid * (right_boxes[:, None, 1] - right_boxes[:, None, 0])
+    pos = np.concatenate([left_pos, right_pos], axis=1)
+    vals = np.concatenate([
+        np.sum(get_poly_basis(left_pos) * left_coeffs[:, None], axis=-1),
+        np.sum(get_poly_basis(right_pos) * right_coeffs[:, None], axis=-1),
+    ], axis=1)
+
+    centre, half_size = get_box_normalisation(parent_boxes)
+    design = get_poly_basis((pos - centre[:, None]) / half_size[:, None])
+    # lstsq doesn't broadcast, the stacked pseudo-inverse gives the same least squares solution
+    norm_coeffs = np.matmul(np.linalg.pinv(design), vals[..., None])[..., 0]
+
+    return poly_coeffs_to_data_space(norm_coeffs, centre, half_size)
+
+
+# generates the polynomial coefficients of all nodes for a single values buffer
+# leaves are fitted to their vertices, then parents are fitted to their children one level at a time
+def gather_poly_corner_values_buffer(vals, node_buffer, plan):
+    node_coeffs = np.zeros((len(node_buffer), 8), dtype=np.float64)
+    node_boxes = get_node_boxes(node_buffer, plan["node_depth"], plan["poly_box"])
+
+    # leaves with no vertices keep all zero coefficients
+    offsets = plan["leaf_vert_offsets"]
+    filled = np.diff(offsets) > 0
+    if np.any(filled):
+        weighted = plan["poly_leaf_pinv"] * vals[plan["leaf_verts"]].astype(np.float64)[:, None]
+        norm_coeffs = np.add.reduceat(weighted, offsets[:-1][filled], axis=0)
+        filled_nodes = plan["leaf_nodes"][filled]
+        centre, half_size = get_box_normalisation(node_boxes[filled_nodes])
+        node_coeffs[filled_nodes] = poly_coeffs_to_data_space(norm_coeffs, centre, half_size)
+
+    branch = node_buffer["right_ptr"] != 0
+    node_depth = plan["node_depth"]
+    for depth in range(int(node_depth.max()) - 1, -1, -1):
+        nodes = np.flatnonzero(branch & (node_depth == depth))
+        left_ptrs = node_buffer["left_ptr"][nodes]
+        right_ptrs = node_buffer["right_ptr"][nodes]
+        node_coeffs[nodes] = merge_poly_coeffs(
+            node_coeffs[left_ptrs], 
+            node_coeffs[right_ptrs], 
+            node_boxes[left_ptrs], 
+            node_boxes[right_ptrs], 
+            node_boxes[nodes]
+        )
+
+    return node_coeffs.astype(np.float32)
+
+
+# generates the corner values of the type the plan was made for
+def gather_node_corner_values_buffer(vals, node_buffer, plan):
+    if "poly_leaf_pinv" in plan:
+        return gather_poly_corner_values_buffer(vals, node_buffer, plan)
+    
+    return gather_corner_values_buffer(vals, plan)
+
+
+# externally called to generate all needed from the values that are in the mesh
+def generate_corner_values(mesh, tree, plan):
+    return {
+        name: gather_node_corner_values_buffer(mesh.values[name], tree.node_buffer, plan)
+        for name in mesh.values
+    }
+
+
+
+
+# node value ranges =============================================================
+# generates the node value ranges for a single values buffer
+def gather_node_val_range_buffer(vals, node_buffer, plan):
+    node_range_vals = np.zeros((len(node_buffer), 2), dtype=np.float32)
+
+    # leaves with no cells keep a range of [0, 0]
+    offsets = plan["leaf_vert_offsets"]
+    filled = np.diff(offsets) > 0
+    if np.any(filled):
+        leaf_vals = vals[plan["leaf_verts"]]
+        starts = offsets[:-1][filled]
+        filled_nodes = plan["leaf_nodes"][filled]
+        node_range_vals[filled_nodes, 0] = np.minimum.reduceat(leaf_vals, starts)
+        node_range_vals[filled_nodes, 1] = np.maximum.reduceat(leaf_vals, starts)
+
+    # merge the ranges up the tree one level at a time
+    branch = node_buffer["right_ptr"] != 0
+    node_depth = plan["node_depth"]
+    for depth in range(int(node_depth.max()) - 1, -1, -1):
+        nodes = np.flatnonzero(branch & (node_depth == depth))
+        left_ranges = node_range_vals[node_buffer["left_ptr"][nodes]]
+        right_ranges = node_range_vals[node_buffer["right_ptr"][nodes]]
+        node_range_vals[nodes, 0] = np.minimum(left_ranges[:, 0], right_ranges[:, 0])
+        node_range_vals[nodes, 1] = np.maximum(left_ranges[:, 1], right_ranges[:, 1])
 
     return node_range_vals
 
-def generate_node_val_ranges(mesh, tree):
+def generate_node_val_ranges(mesh, tree, plan):
     return {
-        name: generate_node_val_range_buffer(mesh, mesh.values[name], tree)
+        name: gather_node_val_range_buffer(mesh.values[name], tree.node_buffer, plan)
         for name in mesh.values
     }
     
 
+# gathers the values of each leaf's block mesh vertices
+def gather_leaf_values(vals, plan):
+    leaf_vals = vals[plan["leaf_verts"]]
+    offsets = plan["leaf_vert_offsets"]
+    return [leaf_vals[offsets[i] : offsets[i + 1]] for i in range(len(plan["leaf_nodes"]))]
+
+
 # splits the given mesh into the blocks for each leaf node
 def split_mesh_at_leaves(mesh, tree):
     block_meshes = []
@@ -294,9 +512,8 @@ def split_mesh_at_leaves(mesh, tree):
         curr_con_index = 0
         next_vert_index = 0
         unique_verts = {}
-        cells_ptr = node["left_ptr"]
 
-        this_cells = tree.cell_buffer[cells_ptr : cells_ptr + node["cell_count"]]
+        this_cells = tree.get_leaf_cells(i)
 
 
         # iterate through all cells in this leaf node
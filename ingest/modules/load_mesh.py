@@ -1,7 +1,8 @@
 import numpy as np
+import os
 import random
 import time
-import cProfile
+from concurrent.futures import ThreadPoolExecutor
 
 import h5py
 import modules.fun3d_data as f3d
@@ -11,6 +12,11 @@ from modules.cgns import *
 from modules.utils import *
 from modules.mesh import Mesh
 from modules.leaf_mesh import *
+from modules.decompose import elements_to_tets
+
+
+# the number of datasets read from cgns files at once
+CGNS_READ_THREADS = min(8, os.cpu_count() or 1)
 
 
 # generates a mapping to be used when building a mesh from structured data
@@ -211,61 +217,91 @@ def load_mesh_from_cgns(path, scalars, verbose = False):
         print("CGNS Version", file["CGNSLibraryVersion"][" data"][0])
         print(charcodes_to_string(file[" hdf5version"][:]))
 
-    # get the zone group to be used
-    zone_grp = file["Base"]["Zone1"]
+    # the unstructured zones are merged into one mesh
+    zone_grps = get_unstructured_zones(file)
+    if verbose: print("Reading %i zones..." % len(zone_grps))
 
     # extract the names of the data arrays
-    value_names = get_zone_value_names(zone_grp)
+    value_names = get_zones_value_names(zone_grps)
     selected_value_names = filter_value_names(value_names, scalars)
 
-    # extract the buffers from the file
-    positions = get_zone_positions(zone_grp)
-    connectivity = get_zone_tet_conn(zone_grp) - 1
-    values = get_zone_values(zone_grp, selected_value_names)
+    # extract the buffers from the file, every dataset is read into place concurrently
+    with ThreadPoolExecutor(CGNS_READ_THREADS) as executor:
+        positions, pos_reads = get_zones_positions(zone_grps, executor)
+        elements = {}
+        conn_reads = []
+        for element_type in ["tet", "pyramid", "prism", "hex"]:
+            elements[element_type], reads = get_zones_element_conn(zone_grps, element_type, executor)
+            conn_reads.extend(reads)
+        values, val_reads = get_zones_values(zone_grps, selected_value_names, executor)
+        wait_for_reads(pos_reads + conn_reads + val_reads)
     
     # close original file
     file.close()
 
+    # any other volume elements are split into tets
+    connectivity = elements_to_tets(elements, verbose)
+
     return Mesh(positions, connectivity, values)
 
 
-def load_mesh_from_fun3d(path, scalars, verbose = False):
+# reads the values of a single time step from the fun3d volume data file that accompanies the mesh
+def get_fun3d_values(path, scalars, t_index = 0):
+    val_path = path.replace("_mesh.lb4", "_volume_data")
+    val_file = f3d.File(val_path)
+
+    if t_index >= val_file.get_t_step_count():
+        print("Time step %i not found, file has %i time steps" % (t_index, val_file.get_t_step_count()))
+        val_file.close()
+        return
+
+    selected_value_names = filter_value_names(val_file.get_variable_names(), scalars)
+    values = {name: val_file.get_value_array(name, t_index) for name in selected_value_names}
+    val_file.close()
+
+    return values
+
+
+def load_mesh_from_fun3d(path, scalars, verbose = False, t_index = 0):
     if verbose: print("Opening binary UGRID file...")
 
     # get mesh
     mesh_file = ugrid.File(path)
     positions = mesh_file.get_positions()
-    connectivity = mesh_file.get_tet_con() - 1
+    # the pyramids, prisms and hexes are split into tets
+    connectivity = mesh_file.get_all_tet_con(verbose) - 1
     mesh_file.close()
 
 
     # get values
-    val_path = path.replace("_mesh.lb4", "_volume_data")
-    val_file = f3d.File(val_path)
-
-    selected_value_names = filter_value_names(val_file.get_variable_names(), scalars)
-    values = {name: val_file.get_value_array(name) for name in selected_value_names}
+    values = get_fun3d_values(path, scalars, t_index)
+    if values is None: return
 
     return Mesh(positions, connectivity, values)
 
 
+# reads the scalar values of a raw structured file
+def get_raw_values(path, scalars, d_type_str):
+    values = {}
+    if "Default" in filter_value_names(["Default"], scalars):
+        with open(path, "rb") as file:
+            raw_data = np.frombuffer(file.read(), dtype=np.dtype(d_type_str))
+        values = {
+            "Default": np.astype(raw_data, np.float32)
+        }
+    
+    return values
+
+
 def load_mesh_from_raw(path, scalars, d_type_str, size_x, size_y, size_z, dec_frac, verbose = False):
     
     if verbose: print("Opening RAW file...")
-    file = open(path, "rb")
     
     # treat this as a raw 3d volumetric structured data file
     size = np.array((size_x, size_y, size_z), dtype=np.uint32)
 
     # read scalar values
-    values = {}
-    if "Default" in filter_value_names(["Default"], scalars):
-        raw_data = np.frombuffer(file.read(), dtype=np.dtype(d_type_str))
-        values = {
-            "Default": np.astype(raw_data, np.float32)
-        }
-
-    file.close()
+    values = get_raw_values(path, scalars, d_type_str)
 
     # create positions array
     positions = np.empty((size[0] * size[1] * size[2], 3), dtype=np.float32)
@@ -278,7 +314,6 @@ def load_mesh_from_raw(path, scalars, d_type_str, size_x, size_y, size_z, dec_fr
     if dec_frac > 0:
         connectivity = create_raw_tet_con_dec(size, dec_frac, verbose)
         # connectivity = None
-        # cProfile.runctx("connectivity = create_raw_tet_con_dec(size, dec_frac, verbose)", globals(), locals())
     else:
         connectivity = create_raw_tet_con(size, verbose)
 
@@ -315,15 +350,65 @@ def filter_value_names(value_names, choices):
 
 
 
-def load_mesh_from_file(path, scalars, d_type_str, size_x, size_y, size_z, decimate, verbose = False):
+def load_mesh_from_file(path, scalars, d_type_str, size_x, size_y, size_z, decimate, verbose = False, t_index = 0):
+    if t_index > 0 and ".lb4" not in path:
+        print("Time steps are only supported for fun3d files")
+        return
+
     if path.split(".")[-1].lower() == "cgns":
         return load_mesh_from_cgns(path, scalars, verbose)
     elif ".lb4" in path:
-        return load_mesh_from_fun3d(path, scalars, verbose)
+        return load_mesh_from_fun3d(path, scalars, verbose, t_index)
     elif ".raw" in path:
         return load_mesh_from_raw(path, scalars, d_type_str, size_x, size_y, size_z, decimate, verbose)
     else:
         print("Could not open this file type, try a file with .cgns, .lb4 or .raw extension")
         return
-    
-   
\ No newline at end of file
+
+
+# loads only the scalar values from the file, the mesh geometry isn't read
+def load_values_from_file(path, scalars, d_type_str, verbose = False, t_index = 0):
+    if t_index > 0 and ".lb4" not in path:
+        print("Time steps are only supported for fun3d files")
+        return
+
+    if verbose: print("Reading values...")
+
+    if path.split(".")[-1].lower() == "cgns":
+        try:
+            file = h5py.File(path, "r")
+        except OSError:
+            print("Could not open file")
+            return
+        
+        zone_grps = get_unstructured_zones(file)
+        selected_value_names = filter_value_names(get_zones_value_names(zone_grps), scalars)
+        with ThreadPoolExecutor(CGNS_READ_THREADS) as executor:
+            values, val_reads = get_zones_values(zone_grps, selected_value_names, executor)
+            wait_for_reads(val_reads)
+        file.close()
+        return values
+    elif ".lb4" in path:
+        return get_fun3d_values(path, scalars, t_index)
+    elif ".raw" in path:
+        return get_raw_values(path, scalars, d_type_str)
+    else:
+        print("Could not open this file type, try a file with .cgns, .lb4 or .raw extension")
+        return
+
+
+# the number of time steps of values in the file, only fun3d data can have more than one
+def get_time_step_count(path):
+    if ".lb4" not in path: return 1
+
+    val_file = f3d.File(path.replace("_mesh.lb4", "_volume_data"))
+    count = val_file.get_t_step_count()
+    val_file.close()
+
+    return count
+
+
+# the files read when loading the mesh at path, fun3d values are in a separate file
+def get_mesh_source_paths(path):
+    if ".lb4" in path: return [path, path.replace("_mesh.lb4", "_volume_data")]
+    return [path]
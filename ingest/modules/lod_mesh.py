@@ -0,0 +1,149 @@
+# lod_mesh.py
+# generates simplified meshes for the internal nodes near the top of the tree
+# these can be requested in place of all of the leaves below them when the node is far away
+import numpy as np
+from modules.mesh import Mesh
+
+
+# factor the clustering grid resolution is reduced by until the mesh fits within the budget
+LOD_RESOLUTION_STEP = 0.8
+
+
+# finds the internal nodes at or above the given depth, in ascending order
+def get_lod_nodes(node_buffer, lod_depth):
+    lod_nodes = []
+    queue = [(0, 0)]
+    while len(queue) > 0:
+        index, depth = queue.pop()
+        node = node_buffer[index]
+        if node["right_ptr"] == 0 or depth > lod_depth: continue
+
+        lod_nodes.append(index)
+        queue.append((int(node["left_ptr"]), depth + 1))
+        queue.append((int(node["right_ptr"]), depth + 1))
+
+    return np.sort(np.array(lod_nodes, dtype=np.uint32))
+
+
+# gathers the cells of all the leaves below a node from the node and cell buffers
+def get_subtree_cells_buffer(tree, index):
+    leaf_cells = []
+    queue = [index]
+    while len(queue) > 0:
+        curr_index = queue.pop()
+        node = tree.node_buffer[curr_index]
+        if node["right_ptr"] == 0:
+            leaf_cells.append(tree.get_leaf_cells(curr_index))
+        else:
+            queue.append(node["left_ptr"])
+            queue.append(node["right_ptr"])
+
+    # cells that straddle split planes appear in multiple leaves
+    return np.unique(np.concatenate(leaf_cells))
+
+
+# simplifies a set of tets by clustering their vertices on a regular grid
+# returns the cluster of each vertex and the tets between clusters, degenerate and repeated tets are removed
+def cluster_tets(pos, con, resolution):
+    box_min = pos.min(axis=0)
+    extent = pos.max(axis=0) - box_min
+    cell_size = max(extent.max(), np.finfo(np.float64).tiny) / resolution
+    grid_counts = np.maximum(np.ceil(extent / cell_size).astype(np.int64), 1)
+
+    grid_index = np.minimum(((pos - box_min) / cell_size).astype(np.int64), grid_counts - 1)
+    keys = grid_index[:, 0] + grid_counts[0] * (grid_index[:, 1] + grid_counts[1] * grid_index[:, 2])
+    _, vert_cluster = np.unique(keys, return_inverse=True)
+
+    tets = vert_cluster[con]
+    sorted_tets = np.sort(tets, axis=1)
+    non_degenerate = np.all(sorted_tets[:, 1:] != sorted_tets[:, :-1], axis=1)
+    tets = tets[non_degenerate]
+
+    # keep the first of any tets between the same clusters
+    _, first = np.unique(sorted_tets[non_degenerate], axis=0, return_index=True)
+    return vert_cluster, tets[np.sort(first)]
+
+
+# creates the simplified mesh for a single node within the cell and vertex budget
+# returns the vertices of the full mesh in each cluster, and the connectivity between clusters
+def simplify_node_mesh(mesh, tree, index, max_cells, max_verts):
+    cells = get_subtree_cells_buffer(tree, index)
+    full_con = np.reshape(mesh.connectivity, (-1, 4))[cells]
+    verts, local_con = np.unique(full_con, return_inverse=True)
+    local_con = local_con.reshape(-1, 4)
+    pos = mesh.positions[verts].astype(np.float64)
+
+    # start at roughly one vertex per grid cell and coarsen until it fits
+    resolution = max(int(np.ceil(len(verts)**(1/3))), 1)
+    while True:
+        vert_cluster, tets = cluster_tets(pos, local_con, resolution)
+        used_clusters, cluster_con = np.unique(tets.ravel(), return_inverse=True)
+        if len(tets) <= max_cells and len(used_clusters) <= max_verts: break
+        resolution = int(resolution * LOD_RESOLUTION_STEP)
+
+    # group the vertices of the clusters that are used
+    used = np.isin(vert_cluster, used_clusters)
+    member_cluster = np.searchsorted(used_clusters, vert_cluster[used])
+    order = np.argsort(member_cluster, kind="stable")
+    members = verts[used][order]
+    member_offsets = np.zeros(len(used_clusters) + 1, dtype=np.int64)
+    member_offsets[1:] = np.cumsum(np.bincount(member_cluster, minlength=len(used_clusters)))
+
+    return members.astype(np.uint32), member_offsets, cluster_con.astype(np.uint32)
+
+
+# each value of a simplified mesh is the mean of the values of the vertices in its cluster
+def gather_cluster_values(vals, members, member_offsets):
+    if len(members) == 0: return np.empty(0, dtype=np.float32)
+    sums = np.add.reduceat(vals[members].astype(np.float64), member_offsets[:-1])
+    return (sums / np.diff(member_offsets)).astype(np.float32)
+
+
+# generates the simplified meshes of all internal nodes at or above lod_depth
+# each fits within the max cells and verts of the leaf blocks so the same buffers can be used
+# returns the meshes and the value-independent information to regenerate their values
+def generate_lod_meshes(mesh, tree, lod_depth, max_cells, max_verts, verbose=False):
+    lod_meshes = []
+    lod_members = []
+    lod_member_offsets = []
+    lod_vert_offsets = [0]
+    total_members = 0
+
+    for index in get_lod_nodes(tree.node_buffer, lod_depth):
+        members, member_offsets, con = simplify_node_mesh(
+            mesh, tree, index, max_cells, max_verts
+        )
+        # the node simplified to nothing
+        if len(con) == 0: continue
+
+        counts = np.diff(member_offsets)[:, None]
+        positions = np.add.reduceat(mesh.positions[members].astype(np.float64), member_offsets[:-1]) / counts
+        values = {
+            name: gather_cluster_values(buff, members, member_offsets)
+            for name, buff in mesh.values.items()
+        }
+        lod_meshes.append(Mesh(positions.astype(np.float32), con, values, int(index)))
+
+        if verbose: print("node %i: %i cells, %i verts" % (index, len(con)//4, len(positions)))
+
+        # offsets are kept relative to the concatenated members of all nodes
+        lod_members.append(members)
+        lod_member_offsets.append(member_offsets[:-1] + total_members)
+        lod_vert_offsets.append(lod_vert_offsets[-1] + len(positions))
+        total_members += len(members)
+
+    lod_plan = {
+        "lod_nodes": np.array([m.id for m in lod_meshes], dtype=np.uint32),
+        "lod_members": np.concatenate(lod_members + [np.empty(0, dtype=np.uint32)]),
+        "lod_member_offsets": np.concatenate(lod_member_offsets + [np.array([total_members], dtype=np.int64)]),
+        "lod_vert_offsets": np.array(lod_vert_offsets, dtype=np.int64),
+    }
+
+    return lod_meshes, lod_plan
+
+
+# gathers the values of each lod mesh's vertices
+def gather_lod_values(vals, lod_plan):
+    lod_vals = gather_cluster_values(vals, lod_plan["lod_members"], lod_plan["lod_member_offsets"])
+    offsets = lod_plan["lod_vert_offsets"]
+    return [lod_vals[offsets[i] : offsets[i + 1]] for i in range(len(lod_plan["lod_nodes"]))]
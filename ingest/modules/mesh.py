@@ -16,6 +16,8 @@ class Mesh:
         self.connectivity = connectivity
         self.values = values
         self.id = id
+        # the index of each vertex in the file it was loaded from, if they differ
+        self.source_verts = None
 
     def __str__(self):
         s = "".join([
@@ -150,7 +152,8 @@ class Mesh:
         self.values[name] = newArray
 
     # fills the supplied hdf5 zone group
-    def create_zone_subgroup(self, base_grp, zone_grp_name):
+    # options are the output options used for the data arrays
+    def create_zone_subgroup(self, base_grp, zone_grp_name, t_index=0, options=None):
         zone_data = np.array((len(self.positions), len(self.connectivity)//4, 0), dtype=np.int32)
         zone_grp = create_cgns_subgroup(base_grp, zone_grp_name, "Zone_t", "I4", zone_data)
 
@@ -158,9 +161,9 @@ class Mesh:
 
         # write the positions of the vertices
         coords_grp = create_cgns_subgroup(zone_grp, "GridCoordinates", "GridCoordinates_t", "MT")
-        create_cgns_subgroup(coords_grp, "CoordinateX", "DataArray_t", "R4", self.positions.T[0])
-        create_cgns_subgroup(coords_grp, "CoordinateY", "DataArray_t", "R4", self.positions.T[1])
-        create_cgns_subgroup(coords_grp, "CoordinateZ", "DataArray_t", "R4", self.positions.T[2])
+        create_cgns_subgroup(coords_grp, "CoordinateX", "DataArray_t", "R4", self.positions.T[0], options)
+        create_cgns_subgroup(coords_grp, "CoordinateY", "DataArray_t", "R4", self.positions.T[1], options)
+        create_cgns_subgroup(coords_grp, "CoordinateZ", "DataArray_t", "R4", self.positions.T[2], options)
 
         # 10 -> tet
         elem_grp = create_cgns_subgroup(zone_grp, "GridElements", "Elements_t", "I4", np.array([10, 0], dtype=np.int32))
@@ -169,9 +172,11 @@ class Mesh:
         # write connectivity
         # TODO: determine if this can be 1 based as per the spec
         one_based_con = self.connectivity + 1
-        create_cgns_subgroup(elem_grp, "ElementConnectivity", "DataArray_t", "I4", one_based_con)
+        create_cgns_subgroup(elem_grp, "ElementConnectivity", "DataArray_t", "I4", one_based_con, options)
 
         # write vertex values
-        sol_grp = create_cgns_subgroup(zone_grp, "FlowSolution", "FlowSolution_t", "MT")
+        sol_grp = create_cgns_subgroup(zone_grp, get_time_step_name("FlowSolution", t_index), "FlowSolution_t", "MT")
         for name, buff in self.values.items():
-            create_cgns_subgroup(sol_grp, name, "DataArray_t", "R4", buff)
\ No newline at end of file
+            create_cgns_subgroup(sol_grp, name, "DataArray_t", "R4", buff, options)
+
+        return zone_grp
@@ -0,0 +1,168 @@
+# mesh_cache.py
+# an on disk cache of loaded meshes so repeat conversions of the same dataset skip parsing and tet generation
+# > each entry is a directory named by the digest of its key, holding the positions, connectivity, values and
+#   source vertices as .npy files with the value names, box and limits in meta.json
+# > entries are memory mapped when reused, copy on write so the files are never changed
+# > the modification time of meta.json is the last use of the entry, the least recently used entries are removed
+#   once the cache is larger than its size limit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from modules.mesh import Mesh
+
+
+# bumped whenever the way meshes are loaded changes, so older entries are never used
+# > 2 removes degenerate and duplicate cells and unused vertices
+# > 3 merges every unstructured zone of cgns files
+# > 4 splits pyramids, prisms and hexes into tets
+CACHE_VERSION = 4
+
+# the size the cache is trimmed to after each entry is added, in bytes
+DEFAULT_CACHE_SIZE = 32 * 2**30
+
+# the size of the reads when hashing the contents of the source files
+HASH_CHUNK_BYTES = 2**24
+
+META_NAME = "meta.json"
+
+
+# the identity of a source file, its contents are only hashed if hash_contents as this reads the whole file
+def get_source_info(path, hash_contents=False):
+    stat = os.stat(path)
+    info = {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+    if hash_contents:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_BYTES), b""):
+                digest.update(chunk)
+        info["sha256"] = digest.hexdigest()
+        # the contents alone identify the file, so moved or touched copies still hit
+        del info["path"], info["mtime"]
+
+    return info
+
+
+# the key of the mesh loaded from the source files with the given loader arguments
+# > sources should include every file the loader reads
+# > args must be json serialisable and hold everything that changes the loaded mesh
+def get_cache_key(sources, args, hash_contents=False):
+    key = {
+        "version": CACHE_VERSION,
+        "sources": [get_source_info(path, hash_contents) for path in sources],
+        "args": args,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+# the total size of the files of an entry in bytes
+def get_entry_bytes(entry_path):
+    return sum(entry.stat().st_size for entry in os.scandir(entry_path) if entry.is_file())
+
+
+class MeshCache:
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_SIZE, verbose=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        os.makedirs(path, exist_ok=True)
+
+    def __get_entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    # loads the mesh stored with this key with its box and limits, None if there is no entry
+    def load(self, key):
+        entry_path = self.__get_entry_path(key)
+        meta_path = os.path.join(entry_path, META_NAME)
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        load_array = lambda name: np.load(os.path.join(entry_path, name + ".npy"), mmap_mode="c")
+        positions = load_array("positions")
+        values = {name: load_array("values_%i" % i) for i, name in enumerate(meta["value_names"])}
+        mesh = Mesh(positions, load_array("connectivity"), values)
+        if meta.get("source_verts"): mesh.source_verts = load_array("source_verts")
+
+        # the box and limits are set on the instance as the class ones are shared by every mesh
+        mesh.box = {
+            "min": np.array(meta["box"]["min"], dtype=positions.dtype),
+            "max": np.array(meta["box"]["max"], dtype=positions.dtype),
+        }
+        mesh.limits = {
+            name: {"min": values[name].dtype.type(lim["min"]), "max": values[name].dtype.type(lim["max"])}
+            for name, lim in meta["limits"].items()
+        }
+
+        # mark the entry as used
+        os.utime(meta_path)
+        if self.verbose: print("Loaded mesh from cache entry %s" % key)
+        return mesh
+
+    # stores the mesh with this key, the box and limits of the mesh must have been calculated
+    # info is written in meta.json to describe the entry
+    def store(self, key, mesh, info=None):
+        entry_path = self.__get_entry_path(key)
+        if os.path.exists(entry_path): return
+
+        value_names = list(mesh.values.keys())
+        meta = {
+            "info": info or {},
+            "value_names": value_names,
+            "source_verts": mesh.source_verts is not None,
+            "box": {"min": np.asarray(mesh.box["min"]).tolist(), "max": np.asarray(mesh.box["max"]).tolist()},
+            "limits": {
+                name: {"min": float(mesh.limits[name]["min"]), "max": float(mesh.limits[name]["max"])}
+                for name in value_names
+            },
+        }
+
+        # written to a temporary directory first so a partly written entry is never loaded
+        temp_path = tempfile.mkdtemp(prefix=".tmp_", dir=self.path)
+        try:
+            np.save(os.path.join(temp_path, "positions.npy"), mesh.positions)
+            np.save(os.path.join(temp_path, "connectivity.npy"), mesh.connectivity)
+            if mesh.source_verts is not None:
+                np.save(os.path.join(temp_path, "source_verts.npy"), mesh.source_verts)
+            for i, name in enumerate(value_names):
+                np.save(os.path.join(temp_path, "values_%i.npy" % i), mesh.values[name])
+            with open(os.path.join(temp_path, META_NAME), "w") as file:
+                json.dump(meta, file, indent=4)
+            os.rename(temp_path, entry_path)
+        except OSError:
+            # another process stored the same entry first, or the disk is full
+            shutil.rmtree(temp_path, ignore_errors=True)
+            if not os.path.exists(entry_path):
+                print("Could not write mesh cache entry %s" % key)
+                return
+
+        if self.verbose: print("Stored mesh in cache entry %s" % key)
+        self.evict(keep=key)
+
+    # removes the least recently used entries until the cache is within its size limit
+    # the entry keep is never removed, even if it alone is larger than the limit
+    def evict(self, keep=None):
+        entries = []
+        for entry in os.scandir(self.path):
+            meta_path = os.path.join(entry.path, META_NAME)
+            if not entry.is_dir() or not os.path.exists(meta_path): continue
+            entries.append((os.stat(meta_path).st_mtime, entry.name, get_entry_bytes(entry.path)))
+
+        total_bytes = sum(entry[2] for entry in entries)
+        for _, key, entry_bytes in sorted(entries):
+            if total_bytes <= self.max_bytes: break
+            if key == keep: continue
+            shutil.rmtree(self.__get_entry_path(key), ignore_errors=True)
+            total_bytes -= entry_bytes
+            if self.verbose: print("Evicted mesh cache entry %s" % key)
@@ -0,0 +1,97 @@
+# profiler.py
+# records the wall time, cpu time and peak memory of each stage of a conversion and writes them as a json report
+# > cprofile also dumps the cProfile stats of each stage, which can be read with pstats or snakeviz
+# > trace_memory also records the peak of the memory traced by tracemalloc in each stage and dumps a snapshot
+#   of the allocations alive at its end, which can be read with tracemalloc.Snapshot.load
+import contextlib
+import cProfile
+import json
+import re
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory won't be recorded
+    resource = None
+
+
+# the peak resident memory of the process so far in bytes
+def get_peak_rss():
+    if resource is None: return None
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageProfiler:
+    def __init__(self, prefix, enabled=False, cprofile=False, trace_memory=False):
+        self.prefix = prefix
+        self.enabled = enabled or cprofile or trace_memory
+        self.cprofile = cprofile
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.start_t = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    # file name for the dumps of a stage, stages may be entered more than once so they are numbered
+    def __get_dump_path(self, name, ext):
+        return "%sprofile_%02i_%s.%s" % (self.prefix, len(self.stages), re.sub(r"\W", "_", name), ext)
+
+    # records a stage, stages should not be nested
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start_peak_rss = get_peak_rss()
+        if self.trace_memory: tracemalloc.reset_peak()
+        profile = cProfile.Profile() if self.cprofile else None
+        start_t = time.perf_counter()
+        start_cpu = time.process_time()
+        if profile is not None: profile.enable()
+
+        try:
+            yield
+        finally:
+            if profile is not None: profile.disable()
+            result = {
+                "name": name,
+                "wall_time": time.perf_counter() - start_t,
+                "cpu_time": time.process_time() - start_cpu,
+            }
+
+            # the peak over the whole process so far, and how much this stage raised it
+            peak_rss = get_peak_rss()
+            if peak_rss is not None:
+                result["peak_rss"] = peak_rss
+                result["peak_rss_increase"] = peak_rss - start_peak_rss
+
+            if profile is not None:
+                result["cprofile"] = self.__get_dump_path(name, "prof")
+                profile.dump_stats(result["cprofile"])
+
+            if self.trace_memory:
+                result["traced_peak"] = tracemalloc.get_traced_memory()[1]
+                result["tracemalloc"] = self.__get_dump_path(name, "tracemalloc")
+                tracemalloc.take_snapshot().dump(result["tracemalloc"])
+
+            self.stages.append(result)
+
+    # writes the stages recorded and the totals to {prefix}profile.json
+    def write_report(self, info=None):
+        if not self.enabled: return
+
+        report = {
+            "info": info or {},
+            "wall_time": time.perf_counter() - self.start_t,
+            "cpu_time": time.process_time() - self.start_cpu,
+            "peak_rss": get_peak_rss(),
+            "stages": self.stages,
+        }
+        with open(self.prefix + "profile.json", "w") as file:
+            json.dump(report, file, indent=4)
@@ -0,0 +1,66 @@
+# quantise.py
+# generates the compact encodings of the block geometry that the server can send in place of the full precision data
+# > positions are quantised to 16 bits within the bounding box of each block
+# > connectivity is delta coded and stored as variable length integers
+import numpy as np
+
+
+QUANT_BITS = 16
+QUANT_MAX = 2**QUANT_BITS - 1
+
+# the most bytes a 32 bit value takes as a varint
+VARINT_MAX_BYTES = 5
+
+
+# the bounding box of a block's vertices as [min x, min y, min z, max x, max y, max z]
+# this is used rather than the leaf box as cells that straddle the leaf boundaries have vertices outside it
+def get_quant_box(positions):
+    if len(positions) == 0: return np.zeros(6, dtype=np.float32)
+    return np.concatenate([positions.min(axis=0), positions.max(axis=0)]).astype(np.float32)
+
+
+# quantises positions to 16 bit integers within the box
+# the error in each axis is at most half a step, extent / (2 * 65535)
+def quantise_positions(positions, box):
+    box_min = box[:3].astype(np.float64)
+    extent = box[3:].astype(np.float64) - box_min
+    # flat boxes quantise every position to 0
+    scale = np.divide(QUANT_MAX, extent, out=np.zeros(3), where=extent > 0)
+    quantised = np.rint((positions.astype(np.float64) - box_min) * scale)
+    return np.clip(quantised, 0, QUANT_MAX).astype(np.uint16)
+
+
+# encodes unsigned integers as little endian base 128 varints
+def encode_varints(values):
+    values = values.astype(np.uint64)
+    shifts = 7 * np.arange(VARINT_MAX_BYTES, dtype=np.uint64)
+    groups = (values[:, None] >> shifts) & np.uint64(0x7f)
+
+    # every value takes at least one byte, the high bit marks that more follow
+    byte_counts = np.ones(len(values), dtype=np.int64)
+    for i in range(1, VARINT_MAX_BYTES):
+        byte_counts += values >= np.uint64(1 << (7 * i))
+    used = np.arange(VARINT_MAX_BYTES) < byte_counts[:, None]
+    more = np.arange(VARINT_MAX_BYTES) < byte_counts[:, None] - 1
+    groups |= np.where(more, np.uint64(0x80), np.uint64(0))
+
+    return groups[used].astype(np.uint8)
+
+
+# codes the differences between consecutive indices, zigzagged so small negative steps stay small
+def encode_delta_varints(indices):
+    deltas = np.diff(indices.astype(np.int64), prepend=0)
+    zigzag = (deltas << 1) ^ (deltas >> 63)
+    return encode_varints(zigzag)
+
+
+# generates the quantised geometry of a block
+# full_positions are the positions of every vertex the block uses, which set the box, and may differ from the
+# block mesh's own if it references vertices stored in others
+def generate_quantised_geometry(mesh, full_positions):
+    box = get_quant_box(full_positions)
+    return {
+        "box": box,
+        "coords": quantise_positions(mesh.positions, box),
+        "con_varint": encode_delta_varints(mesh.connectivity),
+    }
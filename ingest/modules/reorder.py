@@ -0,0 +1,69 @@
+# reorder.py
+# reorders cells and vertices along a morton (z-order) curve so those close in space are close in memory
+# this improves the locality of the tree build and the blocks, and how well the blocks compress
+import numpy as np
+
+
+# bits per axis of the morton codes, 3 * 21 fit in 64 bits
+MORTON_BITS = 21
+
+
+# spreads the low 21 bits of each value so there are two zero bits between each
+def spread_bits(v):
+    v = v & np.uint64(0x1fffff)
+    v = (v | v << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    v = (v | v << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    v = (v | v << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    v = (v | v << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    v = (v | v << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return v
+
+
+# the morton code of each point within the box
+def get_morton_codes(points, box):
+    box_min = np.array(box["min"], dtype=np.float64)
+    extent = np.array(box["max"], dtype=np.float64) - box_min
+    cell_count = 2**MORTON_BITS
+    scale = np.divide(cell_count, extent, out=np.zeros(3), where=extent > 0)
+
+    grid = np.clip((points.astype(np.float64) - box_min) * scale, 0, cell_count - 1).astype(np.uint64)
+    return spread_bits(grid[:, 0]) | spread_bits(grid[:, 1]) << np.uint64(1) | spread_bits(grid[:, 2]) << np.uint64(2)
+
+
+# the morton codes of the centroids of every cell of the mesh
+def get_cell_morton_codes(mesh):
+    centroids = mesh.positions[np.reshape(mesh.connectivity, (-1, 4))].astype(np.float64).mean(axis=1)
+    return get_morton_codes(centroids, mesh.box)
+
+
+# sorts the cells of each leaf in the tree's cell buffer by the morton codes of their centroids
+# the block vertices are numbered in the order cells first use them, so they follow the same curve
+def reorder_leaf_cells(mesh, tree):
+    node_buffer = tree.node_buffer
+    leaf_nodes = np.flatnonzero(node_buffer["right_ptr"] == 0)
+
+    # the start of the segment of the leaf each entry of the cell buffer belongs to
+    entry_segment = np.empty(len(tree.cell_buffer), dtype=np.int64)
+    for cell_ptr, cell_count in zip(tree.cell_offsets[leaf_nodes], node_buffer["cell_count"][leaf_nodes]):
+        entry_segment[cell_ptr : cell_ptr + cell_count] = cell_ptr
+
+    codes = get_cell_morton_codes(mesh)[tree.cell_buffer]
+    order = np.lexsort((codes, entry_segment))
+    tree.cell_buffer[:] = tree.cell_buffer[order]
+
+
+# reorders the vertices and cells of the whole mesh by their morton codes before the tree is built
+# returns the original index of each vertex, used to reorder values loaded later in the same way
+def reorder_mesh(mesh):
+    vert_order = np.argsort(get_morton_codes(mesh.positions, mesh.box), kind="stable")
+    new_index = np.empty(len(vert_order), dtype=mesh.connectivity.dtype)
+    new_index[vert_order] = np.arange(len(vert_order), dtype=mesh.connectivity.dtype)
+
+    cell_order = np.argsort(get_cell_morton_codes(mesh), kind="stable")
+    cells = np.reshape(mesh.connectivity, (-1, 4))[cell_order]
+
+    mesh.connectivity = new_index[cells].ravel()
+    mesh.positions = mesh.positions[vert_order]
+    mesh.values = {name: buff[vert_order] for name, buff in mesh.values.items()}
+
+    return vert_order
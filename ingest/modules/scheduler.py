@@ -0,0 +1,152 @@
+# scheduler.py
+# runs conversion tasks concurrently within a worker count and memory budget
+
+import concurrent.futures as cf
+import contextlib
+import json
+import os
+import sys
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory won't be recorded
+    resource = None
+
+
+# runs a single task inside a worker process with all of its output written to the log file
+def run_logged(func, args, log_path):
+    start_t = time.time()
+    start_cpu = time.process_time()
+    status = "done"
+
+    with open(log_path, "w") as log_file:
+        with contextlib.redirect_stdout(log_file), contextlib.redirect_stderr(log_file):
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+                status = "failed"
+
+    result = {
+        "status": status,
+        "start": start_t,
+        "wall_time": time.time() - start_t,
+        "cpu_time": time.process_time() - start_cpu,
+    }
+
+    if resource is not None:
+        # each worker only runs one task so this is the peak of the task
+        # > before python 3.11 workers are reused, so it is the peak of every task the worker has run so far
+        # ru_maxrss is in KiB on linux
+        result["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return result
+
+
+class Scheduler:
+    def __init__(self, workers, mem_budget=None, log_dir="logs", verbose=False):
+        self.workers = workers
+        # bytes, None for no limit
+        self.mem_budget = mem_budget
+        self.log_dir = log_dir
+        self.verbose = verbose
+        self.tasks = []
+        self.start_t = None
+
+    # registers a task to be run
+    # func and args must be picklable as they are sent to a worker process
+    # check is called after the task finishes and should return True if its outputs are complete
+    def add_task(self, name, func, args, mem_estimate=0, check=None, skip=False):
+        self.tasks.append({
+            "name": name,
+            "func": func,
+            "args": args,
+            "check": check,
+            "mem_estimate": mem_estimate,
+            "log": os.path.join(self.log_dir, name.replace("/", "_") + ".log"),
+            "status": "skipped" if skip else "pending",
+        })
+
+    # whether there is space to start this task with the tasks already running
+    def __can_start(self, task, running, used_mem):
+        if len(running) >= self.workers: return False
+        # always let a task run by itself, even if it is estimated to be over budget
+        if len(running) == 0 or self.mem_budget is None: return True
+        return used_mem + task["mem_estimate"] <= self.mem_budget
+
+    # writes the timings and results of all tasks to summary.json in the log directory
+    def write_summary(self):
+        summary = {
+            "workers": self.workers,
+            "memory_budget": self.mem_budget,
+            "start": self.start_t,
+            "wall_time": time.time() - self.start_t,
+            "tasks": [
+                {key: val for key, val in task.items() if key not in ("func", "args", "check")}
+                for task in self.tasks
+            ]
+        }
+
+        with open(os.path.join(self.log_dir, "summary.json"), "w") as file:
+            json.dump(summary, file, indent=4)
+
+    # runs all of the pending tasks, blocks until they are finished
+    def run(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.start_t = time.time()
+
+        pending = [task for task in self.tasks if task["status"] == "pending"]
+        print("running %i tasks, %i skipped" % (len(pending), len(self.tasks) - len(pending)))
+
+        running = {}
+        used_mem = 0
+        # a fresh process for each task so memory is returned and peak usage is per task
+        # > max_tasks_per_child is only available from python 3.11, before that workers are kept
+        pool_kwargs = {"max_tasks_per_child": 1} if sys.version_info >= (3, 11) else {}
+        with cf.ProcessPoolExecutor(max_workers=self.workers, **pool_kwargs) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                # start as many tasks as the limits allow
+                for task in pending[:]:
+                    if not self.__can_start(task, running, used_mem): continue
+
+                    future = executor.submit(run_logged, task["func"], task["args"], task["log"])
+                    running[future] = task
+                    used_mem += task["mem_estimate"]
+                    pending.remove(task)
+                    task["status"] = "running"
+                    print("started %s" % task["name"])
+
+                done, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+
+                for future in done:
+                    task = running.pop(future)
+                    used_mem -= task["mem_estimate"]
+
+                    try:
+                        task.update(future.result())
+                    except Exception as e:
+                        # the worker process died, likely killed for using too much memory
+                        task["status"] = "failed"
+                        task["error"] = repr(e)
+
+                    if task["status"] == "done" and task["check"] is not None and not task["check"]():
+                        task["status"] = "incomplete"
+
+                    if self.verbose:
+                        print("%s %s, took %fs" % (task["name"], task["status"], task.get("wall_time", 0)))
+                    else:
+                        print("%s %s" % (task["name"], task["status"]))
+
+                    # keep the summary up to date in case of interruption
+                    self.write_summary()
+
+        self.write_summary()
+
+        failed = [task["name"] for task in self.tasks if task["status"] in ("failed", "incomplete")]
+        if len(failed) > 0:
+            print("%i tasks did not complete: %s" % (len(failed), ", ".join(failed)))
+
+        return self.tasks
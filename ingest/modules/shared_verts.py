@@ -0,0 +1,84 @@
+# shared_verts.py
+# encodes the leaf blocks so that vertices on the boundaries between leaves are only stored once
+# each vertex is owned by the first leaf (in node order) that uses it, other leaves reference it
+import numpy as np
+from modules.mesh import Mesh
+
+
+# finds which leaf owns each vertex of each leaf block and where
+# > shared_owned_verts, shared_owned_offsets: the global vertices stored by each leaf
+# > shared_refs, shared_ref_offsets: the (owner node, index within owner) of the vertices each leaf references
+# > shared_order: for each leaf, the block vertices owned first then referenced, as indices into the block
+def generate_shared_plan(plan):
+    leaf_verts = plan["leaf_verts"]
+    offsets = plan["leaf_vert_offsets"]
+    leaf_count = len(plan["leaf_nodes"])
+    entry_leaf = np.repeat(np.arange(leaf_count), np.diff(offsets))
+
+    # leaves are in ascending order, so the first entry of a vertex is in its owning leaf
+    _, first_entry, inverse = np.unique(leaf_verts, return_index=True, return_inverse=True)
+    owner_entry = first_entry[inverse]
+    owned = owner_entry == np.arange(len(leaf_verts))
+
+    # the index of each owned vertex among those owned by its leaf
+    owned_counts = np.bincount(entry_leaf[owned], minlength=leaf_count)
+    owned_offsets = np.zeros(leaf_count + 1, dtype=np.int64)
+    owned_offsets[1:] = np.cumsum(owned_counts)
+    owned_index = np.cumsum(owned) - 1 - owned_offsets[entry_leaf]
+
+    # order each block with its owned vertices first, keeping the existing order otherwise
+    order = np.lexsort((np.arange(len(leaf_verts)), ~owned, entry_leaf))
+    local_order = (order - offsets[entry_leaf[order]]).astype(np.uint32)
+
+    ref_entries = order[~owned[order]]
+    ref_owners = owner_entry[ref_entries]
+    refs = np.stack([
+        plan["leaf_nodes"][entry_leaf[ref_owners]],
+        owned_index[ref_owners],
+    ], axis=1).astype(np.uint32)
+    ref_offsets = np.zeros(leaf_count + 1, dtype=np.int64)
+    ref_offsets[1:] = np.cumsum(np.bincount(entry_leaf[ref_entries], minlength=leaf_count))
+
+    return {
+        "shared_owned_verts": leaf_verts[owned].astype(np.uint32),
+        "shared_owned_offsets": owned_offsets,
+        "shared_refs": refs,
+        "shared_ref_offsets": ref_offsets,
+        "shared_order": local_order,
+    }
+
+
+# creates the encoded meshes of the leaves, which only hold their owned vertices
+# the connectivity indexes the owned vertices followed by the referenced ones
+# returns the meshes and the references of each
+def encode_shared_meshes(meshes, plan, shared_plan):
+    offsets = plan["leaf_vert_offsets"]
+    owned_offsets = shared_plan["shared_owned_offsets"]
+    ref_offsets = shared_plan["shared_ref_offsets"]
+
+    shared_meshes = []
+    shared_refs = []
+    for i, mesh in enumerate(meshes):
+        order = shared_plan["shared_order"][offsets[i] : offsets[i + 1]]
+        owned_count = owned_offsets[i + 1] - owned_offsets[i]
+        owned_order = order[:owned_count]
+
+        new_index = np.empty(len(order), dtype=np.uint32)
+        new_index[order] = np.arange(len(order), dtype=np.uint32)
+
+        shared_meshes.append(Mesh(
+            mesh.positions[owned_order],
+            new_index[mesh.connectivity],
+            {name: buff[owned_order] for name, buff in mesh.values.items()},
+            mesh.id
+        ))
+        shared_refs.append(shared_plan["shared_refs"][ref_offsets[i] : ref_offsets[i + 1]])
+
+    return shared_meshes, shared_refs
+
+
+# gathers the values of the vertices owned by each leaf
+def gather_owned_values(vals, plan):
+    owned_vals = vals[plan["shared_owned_verts"]]
+    offsets = plan["shared_owned_offsets"]
+    return [owned_vals[offsets[i] : offsets[i + 1]] for i in range(len(plan["leaf_nodes"]))]
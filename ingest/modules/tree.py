@@ -24,72 +24,432 @@ def split_cells(node, dim, mesh_pos, wrapped_con):
     return (left_cells, right_cells)
 
 
+# how cells that straddle a split plane are divided between the children
+# > duplicate: the cell is in both children
+# > nudge: as duplicate, but the plane is moved within a tolerance of the centre to cross the fewest cells
+# > centroid: the cell is only in the child its centroid is in, the child's bounds are extended to contain it
+#   the client finds cells by the split planes alone, so this can't be used to write files
+STRADDLE_POLICIES = ["duplicate", "nudge", "centroid"]
+
+# the furthest the split plane is nudged from the centre, as a fraction of the node's extent
+DEFAULT_NUDGE_TOLERANCE = 0.1
+
+
+# the min and max of the vertices of each cell along the axis
+def get_cell_extents(cells, dim, mesh_pos, wrapped_con):
+    coords = mesh_pos[wrapped_con[np.asarray(cells, dtype=np.int64)], dim]
+    return coords.min(axis=1), coords.max(axis=1)
+
+
+# finds the split plane within the tolerance of the centre of the box that the fewest cells straddle
+# > a cell straddles the plane if its min is <= the plane and its max is > it
+# > the count only changes at the cells' extents, so the best plane is either the centre or a cell's max
+# ties are broken by the distance to the centre
+def find_nudged_split(cells, dim, box, mesh_pos, wrapped_con, tolerance):
+    centre = np.float32(0.5 * (box["min"][dim] + box["max"][dim]))
+    if len(cells) == 0: return centre
+
+    window = tolerance * (box["max"][dim] - box["min"][dim])
+    cell_min, cell_max = get_cell_extents(cells, dim, mesh_pos, wrapped_con)
+    in_window = (cell_max >= centre - window) & (cell_max <= centre + window)
+    candidates = np.concatenate([[centre], cell_max[in_window]]).astype(np.float32)
+
+    straddle_counts = (
+        np.searchsorted(np.sort(cell_min), candidates, "right") - 
+        np.searchsorted(np.sort(cell_max), candidates, "right")
+    )
+    best = np.lexsort((np.abs(candidates - centre), straddle_counts))[0]
+    return candidates[best]
+
+
+# splits the cells into left and right by which side of the plane their centroids are
+def split_cells_by_centroid(cells, dim, s_val, mesh_pos, wrapped_con):
+    cells = np.asarray(cells, dtype=np.int64)
+    centroids = mesh_pos[wrapped_con[cells], dim].mean(axis=1)
+    left = centroids <= s_val
+    return cells[left].tolist(), cells[~left].tolist()
+
+
+# the box of the node extended to contain all of the vertices of its cells
+def get_extended_bounds(box, cells, mesh_pos, wrapped_con):
+    bounds = copy_box(box)
+    if len(cells) == 0: return bounds
+
+    verts = mesh_pos[wrapped_con[np.asarray(cells, dtype=np.int64)]].reshape(-1, 3)
+    for dim in range(3):
+        bounds["min"][dim] = min(bounds["min"][dim], float(verts[:, dim].min()))
+        bounds["max"][dim] = max(bounds["max"][dim], float(verts[:, dim].max()))
+    return bounds
+
+
+# the number of distinct vertices used by the cells
+def count_cell_verts(cells, wrapped_con):
+    if len(cells) == 0: return 0
+    return len(np.unique(wrapped_con[np.asarray(cells, dtype=np.int64)]))
+
+
+# splits a node at the centre of its box along the axis of its depth, creating its two children
+# straddle is the policy for the cells crossing the plane, see STRADDLE_POLICIES
+# the cell count is kept so the tree can be truncated later
+def split_node(parent_node, mesh_pos, wrapped_con, straddle="duplicate", tolerance=DEFAULT_NUDGE_TOLERANCE):
+    curr_depth = parent_node["depth"]
+    curr_dim = curr_depth % 3
+
+    # find the pivot 
+    if straddle == "nudge":
+        parent_node["split_val"] = find_nudged_split(parent_node["cells"], curr_dim, parent_node["box"], mesh_pos, wrapped_con, tolerance)
+    else:
+        parent_node["split_val"] = np.float32(0.5 * (parent_node["box"]["min"][curr_dim] + parent_node["box"]["max"][curr_dim]))
+
+    # split the cells into left and right
+    if straddle == "centroid":
+        left_cells, right_cells = split_cells_by_centroid(parent_node["cells"], curr_dim, parent_node["split_val"], mesh_pos, wrapped_con)
+    else:
+        left_cells, right_cells = split_cells(parent_node, curr_dim, mesh_pos, wrapped_con)
+
+    left_box = copy_box(parent_node["box"])
+    left_box["max"][curr_dim] = parent_node["split_val"]
+    right_box = copy_box(parent_node["box"])
+    right_box["min"][curr_dim] = parent_node["split_val"]
+
+    # create the new left and right nodes
+    left_node = {
+        "this_ptr": 0,
+        "split_val": 0, 
+        "depth": curr_depth + 1,
+        "box": left_box,
+        "cells": left_cells,
+        "parent": parent_node,
+        "left": None,
+        "right": None,
+    }
+
+    right_node = {
+        "this_ptr": 0,
+        "split_val": 0, 
+        "depth": curr_depth + 1,
+        "box": right_box,
+        "cells": right_cells,
+        "parent": parent_node,
+        "left": None,
+        "right": None,
+    }
+
+    # cells are not duplicated so the children's bounds must grow to contain them
+    if straddle == "centroid":
+        left_node["bounds"] = get_extended_bounds(left_box, left_cells, mesh_pos, wrapped_con)
+        right_node["bounds"] = get_extended_bounds(right_box, right_cells, mesh_pos, wrapped_con)
+
+    # make sure the parent is properly closed out
+    parent_node["cell_count"] = len(parent_node["cells"])
+    parent_node["cells"] = None
+    parent_node["left"] = left_node
+    parent_node["right"] = right_node
+
+    return left_node, right_node
+
+
+# whether a node with these cells can be a leaf
+def is_within_budget(cells, wrapped_con, max_cells, max_verts=None):
+    if len(cells) > max_cells: return False
+    return max_verts is None or count_cell_verts(cells, wrapped_con) <= max_verts
+
+
+# gathers the cells of all the leaves below this node
+# > cells keep the ascending order they would have when split from the root
+def get_subtree_cells(node):
+    leaf_cells = []
+    node_queue = [node]
+    while len(node_queue) > 0:
+        curr_node = node_queue.pop()
+        if curr_node["cells"] is not None:
+            leaf_cells.append(curr_node["cells"])
+        else:
+            node_queue.append(curr_node["left"])
+            node_queue.append(curr_node["right"])
+
+    # cells that straddle split planes appear in multiple leaves
+    return np.unique(np.concatenate(leaf_cells).astype(np.uint32))
+
+
+# the largest value of the 32 bit pointers of the node buffer
+UINT32_LIMIT = 2**32 - 1
+
+
+# the orders the nodes of the serialised tree can be laid out in
+# > dfs: depth first with the right child first, so each right child directly follows its parent
+# > bfs: breadth first, one level after another
+# > veb: breadth first for the top levels, then each subtree below them is laid out in van Emde Boas order,
+#   recursively split into a top half and the subtrees below it, so the nodes a traversal visits are close together
+# the root is always first and consumers only follow the pointers, so any layout can be read in the same way
+NODE_LAYOUTS = ["dfs", "bfs", "veb"]
+
+# the levels at the top of the veb layout that are laid out breadth first
+# > every traversal passes through these, 2^10 - 1 nodes take 20KB
+DEFAULT_LAYOUT_TOP_DEPTH = 10
+
+
+# the children of the branch nodes in a list, left to right
+def get_child_nodes(nodes):
+    return [child for node in nodes if node["cells"] is None for child in (node["left"], node["right"])]
+
+
+# the nodes that are the given number of levels below the node, left to right
+def get_nodes_below(node, levels):
+    nodes = [node]
+    for _ in range(levels):
+        nodes = get_child_nodes(nodes)
+    return nodes
+
+
+# the nodes within the given number of levels of the node in van Emde Boas order
+# > the top half of the levels is laid out first, then each of the subtrees hanging below it
+def get_veb_order(node, levels):
+    if levels <= 1 or node["cells"] is not None: return [node]
+
+    top_levels = levels // 2
+    order = get_veb_order(node, top_levels)
+    for child in get_nodes_below(node, top_levels):
+        order.extend(get_veb_order(child, levels - top_levels))
+
+    return order
+
+
+# the nodes of the tree in the order they are written in the given layout, see NODE_LAYOUTS
+def get_node_order(root, layout="dfs", top_depth=DEFAULT_LAYOUT_TOP_DEPTH):
+    if layout == "dfs":
+        order = []
+        node_queue = [root]
+        while len(node_queue) > 0:
+            node = node_queue.pop()
+            order.append(node)
+            if node["cells"] is None:
+                node_queue.append(node["left"])
+                node_queue.append(node["right"])
+        return order
+
+    # the top levels, or all levels for bfs
+    order = []
+    level = [root]
+    depth = 0
+    while len(level) > 0 and (layout == "bfs" or depth < top_depth):
+        order.extend(level)
+        level = get_child_nodes(level)
+        depth += 1
+
+    if layout == "bfs" or len(level) == 0: return order
+
+    # every subtree is laid out with the levels of the deepest so the recursion splits them all alike
+    levels = max(leaf["depth"] for leaf in get_leaves(root)) - root["depth"] - depth + 1
+    for node in level:
+        order.extend(get_veb_order(node, levels))
+
+    return order
+
+
+# the leaf nodes below this node
+def get_leaves(node):
+    leaves = []
+    node_queue = [node]
+    while len(node_queue) > 0:
+        curr_node = node_queue.pop()
+        if curr_node["cells"] is not None:
+            leaves.append(curr_node)
+        else:
+            node_queue.append(curr_node["left"])
+            node_queue.append(curr_node["right"])
+
+    return leaves
+
+
 class Tree:
-    def __init__(self, root, node_count, leaf_count, max_cells, total_cell_count, box):
+    def __init__(self, root, node_count, leaf_count, max_cells, total_cell_count, box, straddle="duplicate", tolerance=DEFAULT_NUDGE_TOLERANCE):
         self.root = root
         self.node_count = node_count
         self.leaf_count = leaf_count
         self.max_cells = max_cells
         self.total_cell_count = total_cell_count
         self.box = box
+        # the straddling cell policy the tree was split with
+        self.straddle = straddle
+        self.tolerance = tolerance
+
+    # how many times more cells the leaves hold than the mesh, from cells straddling the split planes
+    # each duplicate is read, sent and stored once for every leaf it is in
+    def get_duplication_ratio(self, mesh_cell_count):
+        return self.total_cell_count / max(mesh_cell_count, 1)
+
+    # the mean and max ratios of the volume of each leaf's extended bounds to the volume of its box
+    # only the centroid policy extends the bounds, the ratios are 1 otherwise
+    def get_bounds_growth(self):
+        ratios = []
+        for leaf in self.get_leaves():
+            if "bounds" not in leaf: 
+                ratios.append(1)
+                continue
+            box_size = np.subtract(leaf["box"]["max"], leaf["box"]["min"])
+            bounds_size = np.subtract(leaf["bounds"]["max"], leaf["bounds"]["min"])
+            ratios.append(np.prod(bounds_size) / max(np.prod(box_size), 1e-30))
+        
+        return float(np.mean(ratios)), float(np.max(ratios))
 
     # creates a packed buffer representation of the tree
-    def serialise(self):
+    # layout is the order the nodes are written in, see NODE_LAYOUTS
+    # > the cells of the leaves are written in the same order as the leaves
+    # also returns the 64 bit offset of each leaf's cells within the cells buffer
+    # > leaves hold these in left_ptr only if every offset fits in 32 bits, otherwise their left_ptr is 0
+    def serialise(self, layout="dfs", top_depth=DEFAULT_LAYOUT_TOP_DEPTH):
+        nodes = get_node_order(self.root, layout, top_depth)
+        for ptr, node in enumerate(nodes):
+            node["this_ptr"] = ptr
+
         # create the node buffer
         node_buffer = np.empty(self.node_count, dtype=self.node_dtype)
+        node_buffer["split_val"] = [node["split_val"] for node in nodes]
+        node_buffer["parent_ptr"] = [0 if node["parent"] is None else node["parent"]["this_ptr"] for node in nodes]
+
+        # leaves point to their cells with left_ptr and have no right child
+        is_leaf = np.array([node["cells"] is not None for node in nodes], dtype=bool)
+        cell_counts = np.array([len(node["cells"]) if node["cells"] is not None else 0 for node in nodes], dtype=np.int64)
+        cell_ptrs = np.cumsum(cell_counts) - cell_counts
+        child_ptrs = np.array(
+            [(0, 0) if leaf else (node["left"]["this_ptr"], node["right"]["this_ptr"]) for node, leaf in zip(nodes, is_leaf)],
+            dtype=np.int64
+        ).reshape(-1, 2)
+
+        cell_offsets = np.where(is_leaf, cell_ptrs, 0)
+        if self.total_cell_count > UINT32_LIMIT: cell_ptrs = np.zeros_like(cell_ptrs)
+
+        node_buffer["cell_count"] = cell_counts
+        node_buffer["left_ptr"] = np.where(is_leaf, cell_ptrs, child_ptrs[:, 0])
+        node_buffer["right_ptr"] = child_ptrs[:, 1]
+
+        # write the cells data to that buffer
         cells_buffer = np.empty(self.total_cell_count, dtype=np.uint32)
+        for node, ptr, count in zip(nodes, cell_offsets, cell_counts):
+            if count > 0: cells_buffer[ptr : ptr + count] = node["cells"]
 
-        node_queue = [self.root]
+        return node_buffer, cells_buffer, cell_offsets
+            
+            
+    # creates a copy of this tree where the leaves are the shallowest nodes with at most max_cells cells
+    # and, if given, at most max_verts vertices in the mesh
+    # > this is the same tree as generating directly with the larger max_cells and the same max_verts
+    # > must be called before convert_to_buffers as the node objects are needed
+    def truncate(self, max_cells, max_verts=None, mesh=None):
+        wrapped_con = None if max_verts is None else np.reshape(mesh.connectivity, (-1, 4))
+        node_count = 0
+        leaf_count = 0
+        max_cell_count = 0
+        cells_count_sum = 0
+        new_root = None
 
-        curr_ptr = 0
-        curr_cells_ptr = 0
+        # the node to copy, the new parent node and which child of the parent it is
+        node_queue = [(self.root, None, None)]
 
         while len(node_queue) > 0:
-            node = node_queue.pop()
-            node["this_ptr"] = curr_ptr
+            node, parent, side = node_queue.pop()
+            node_count += 1
 
-            node_buffer[curr_ptr]["split_val"] = node["split_val"]
-            node_buffer[curr_ptr]["left_ptr"] = 0
-            node_buffer[curr_ptr]["right_ptr"] = 0
-            
-            # write node to the buffer
-            if node["cells"] is not None:
-                node_buffer[curr_ptr]["cell_count"] = len(node["cells"])
-
-                # write the cells data to that buffer
-                cells_buffer[curr_cells_ptr : curr_cells_ptr + len(node["cells"])] = node["cells"]
-                node_buffer[curr_ptr]["left_ptr"] = curr_cells_ptr
-                curr_cells_ptr += len(node["cells"])
+            new_node = {
+                "this_ptr": 0,
+                "split_val": node["split_val"], 
+                "depth": node["depth"],
+                "box": node["box"],
+                "cells": None,
+                "parent": parent,
+                "left": None,
+                "right": None,
+            }
+
+            if "bounds" in node:
+                new_node["bounds"] = node["bounds"]
+
+            if parent is None:
+                new_root = new_node
             else:
-                node_buffer[curr_ptr]["cell_count"] = 0
-            
-            
-            if node["parent"] is not None:
-                node_buffer[curr_ptr]["parent_ptr"] = node["parent"]["this_ptr"]
-                # update the node's parent
-                if node["parent"]["left"] == node:
-                    node_buffer[node["parent"]["this_ptr"]]["left_ptr"] = curr_ptr
-                else:
-                    node_buffer[node["parent"]["this_ptr"]]["right_ptr"] = curr_ptr
+                parent[side] = new_node
+
+            stays_branch = node["cells"] is None and node["cell_count"] > max_cells
+            # nodes within the cell budget may have been split for their vertices
+            if node["cells"] is None and not stays_branch and max_verts is not None:
+                stays_branch = count_cell_verts(get_subtree_cells(node), wrapped_con) > max_verts
+
+            if stays_branch:
+                # stays as a branch node
+                new_node["cell_count"] = node["cell_count"]
+                node_queue.append((node["left"], new_node, "left"))
+                node_queue.append((node["right"], new_node, "right"))
+                continue
+
+            # this node becomes a leaf
+            if node["cells"] is None:
+                new_node["split_val"] = 0
+                new_node["cells"] = get_subtree_cells(node)
             else:
-               node_buffer[curr_ptr]["parent_ptr"] = 0                 
+                new_node["cells"] = node["cells"]
 
-            if node["left"] is not None:
-                node_queue.append(node["left"])
-            if node["right"] is not None:
-                node_queue.append(node["right"])
+            max_cell_count = max(max_cell_count, len(new_node["cells"]))
+            cells_count_sum += len(new_node["cells"])
+            leaf_count += 1
 
-            curr_ptr += 1
-        
-        return node_buffer, cells_buffer
-            
-            
-    def convert_to_buffers(self):
-        self.node_buffer, self.cell_buffer = self.serialise()
+        return Tree(new_root, node_count, leaf_count, max_cell_count, cells_count_sum, copy_box(self.box), self.straddle, self.tolerance)
+
+    # the leaf nodes of the tree
+    def get_leaves(self):
+        return get_leaves(self.root)
+
+    # splits the leaves with more cells or vertices than the given percentile of the leaves until none do
+    # the blocks are padded to the largest leaf, so a few outliers inflate the size of every block
+    # > must be called before convert_to_buffers as the node objects are needed
+    # returns the number of splits and the largest cell and vertex counts before and after
+    def split_outliers(self, mesh, max_depth, percentile=99, verbose=False):
+        mesh_pos = mesh.positions
+        wrapped_con = np.reshape(mesh.connectivity, (-1, 4))
+
+        leaves = self.get_leaves()
+        cell_counts = np.array([len(leaf["cells"]) for leaf in leaves])
+        vert_counts = np.array([count_cell_verts(leaf["cells"], wrapped_con) for leaf in leaves])
+        cell_limit = np.percentile(cell_counts, percentile)
+        vert_limit = np.percentile(vert_counts, percentile)
+        if verbose: print("Splitting leaves with more than %i cells or %i verts" % (cell_limit, vert_limit))
+
+        is_outlier = lambda node: len(node["cells"]) > cell_limit or count_cell_verts(node["cells"], wrapped_con) > vert_limit
+        node_queue = [leaf for leaf, cells, verts in zip(leaves, cell_counts, vert_counts) if cells > cell_limit or verts > vert_limit]
+        split_count = 0
+        while len(node_queue) > 0:
+            node = node_queue.pop()
+            if node["depth"] + 1 > max_depth: continue
+
+            for child in split_node(node, mesh_pos, wrapped_con, self.straddle, self.tolerance):
+                if is_outlier(child): node_queue.append(child)
+            split_count += 1
+
+        new_leaves = self.get_leaves()
+        new_cell_counts = [len(leaf["cells"]) for leaf in new_leaves]
+        self.node_count += 2 * split_count
+        self.leaf_count += split_count
+        self.max_cells = max(new_cell_counts)
+        self.total_cell_count = sum(new_cell_counts)
+
+        return {
+            "split_count": split_count,
+            "max_cells": (int(cell_counts.max()), self.max_cells),
+            "max_verts": (int(vert_counts.max()), max(count_cell_verts(leaf["cells"], wrapped_con) for leaf in new_leaves)),
+        }
+
+    def convert_to_buffers(self, layout="dfs", top_depth=DEFAULT_LAYOUT_TOP_DEPTH):
+        self.node_buffer, self.cell_buffer, self.cell_offsets = self.serialise(layout, top_depth)
         self.root = None
 
         return self.node_buffer, self.cell_buffer
 
+    # the cells of the leaf at the given index of the node buffer
+    # > must be called after convert_to_buffers
+    def get_leaf_cells(self, index):
+        cell_ptr = self.cell_offsets[index]
+        return self.cell_buffer[cell_ptr : cell_ptr + self.node_buffer["cell_count"][index]]
+
     # definition of the datatype for a single node
     # struct KDTreeNode {
     #     splitVal : f32,
@@ -108,8 +468,11 @@ class Tree:
 
     # Node = namedtuple("Node", (node_dtype[0][0]))
 
+    # generates the tree by splitting nodes at their centre until they have at most max_cells cells
+    # if max_verts is given, nodes are also split until their cells use at most max_verts vertices
+    # straddle and tolerance set how cells crossing the split planes are treated, see STRADDLE_POLICIES
     @staticmethod
-    def generate_node_median(mesh, max_depth, max_cells, verbose):
+    def generate_node_median(mesh, max_depth, max_cells, verbose, max_verts=None, straddle="duplicate", tolerance=DEFAULT_NUDGE_TOLERANCE):
         node_queue = []
         n_app = node_queue.append
         cells_count_sum = 0
@@ -161,8 +524,8 @@ class Tree:
 
             curr_depth = parent_node["depth"]
             # stop the expansion of this node if the tree is deep enough
-            # or stop if the # cells is already low enough
-            if curr_depth + 1 > max_depth or len(parent_node["cells"]) <= max_cells:
+            # or stop if the # cells (and # verts if limited) is already low enough
+            if curr_depth + 1 > max_depth or is_within_budget(parent_node["cells"], wrapped_con, max_cells, max_verts):
                 # console.log(parentNode.points.length);
                 max_cell_count = max(max_cell_count, len(parent_node["cells"]))
                 max_leaf_depth = max(max_leaf_depth, parent_node["depth"])
@@ -171,54 +534,8 @@ class Tree:
                 continue
             
 
-            curr_dim = parent_node["depth"] % 3
-
-            # find the pivot 
-            parent_node["split_val"] = np.float32(0.5 * (parent_node["box"]["min"][curr_dim] + parent_node["box"]["max"][curr_dim]))
-
-
-            # split the cells into left and right
-            left_cells, right_cells = split_cells(parent_node, curr_dim, mesh_pos, wrapped_con)
-
-            # print(len(left_cells), len(right_cells))
-            # print(parent_node["split_val"], curr_dim, curr_depth)
-
-            left_box = copy_box(parent_node["box"])
-            left_box["max"][curr_dim] = parent_node["split_val"]
-            right_box = copy_box(parent_node["box"])
-            right_box["min"][curr_dim] = parent_node["split_val"]
-
-            # print(left_box, right_box)
-            
-            # create the new left and right nodes
-            left_node = {
-                "this_ptr": 0,
-                "split_val": 0, 
-                "depth": curr_depth + 1,
-                "box": left_box,
-                "cells": left_cells,
-                "parent": parent_node,
-                "left": None,
-                "right": None,
-            }
-
-            right_node = {
-                "this_ptr": 0,
-                "split_val": 0, 
-                "depth": curr_depth + 1,
-                "box": right_box,
-                "cells": right_cells,
-                "parent": parent_node,
-                "left": None,
-                "right": None,
-            }
-
-            # make sure the parent is properly closed out
-            parent_node["cells"] = None
-            parent_node["left"] = left_node
-            parent_node["right"] = right_node
-
             # add children to the queue
+            left_node, right_node = split_node(parent_node, mesh_pos, wrapped_con, straddle, tolerance)
             n_app(left_node)
             n_app(right_node)
         
@@ -228,6 +545,7 @@ class Tree:
             print("max tree depth:", max_leaf_depth)
             print("nodes created: %i" % processed)
             print("leaves created: %i" % leaves_count)
+            print("cell duplication ratio: %.3f" % (cells_count_sum / max(mesh.get_cell_count(), 1)))
 
-        return Tree(root, processed, leaves_count, max_cell_count, cells_count_sum, copy_box(mesh.box))
+        return Tree(root, processed, leaves_count, max_cell_count, cells_count_sum, copy_box(mesh.box), straddle, tolerance)
         
@@ -0,0 +1,102 @@
+# treelet.py
+# generates the fixed-depth treelets over the cells of each leaf block
+# matches generateTreelet in static/core/data/cache/treelet.js so the client can use them directly
+import numpy as np
+from modules.utils import *
+from modules.tree import Tree
+
+
+# how many nodes will be in a treelet of the given depth, the root is not stored
+def treelet_node_count_from_depth(depth):
+    return 2**(depth + 1) - 2
+
+
+# finds the box and depth of every leaf of the tree from the node split values
+def get_leaf_boxes(tree):
+    node_buffer = tree.node_buffer
+    leaf_boxes = {}
+
+    queue = [(0, copy_box(tree.box), 0)]
+    while len(queue) > 0:
+        index, box, depth = queue.pop()
+        node = node_buffer[index]
+        if node["right_ptr"] == 0:
+            leaf_boxes[index] = (box, depth)
+            continue
+
+        dim = depth % 3
+        left_box = copy_box(box)
+        left_box["max"][dim] = node["split_val"]
+        right_box = copy_box(box)
+        right_box["min"][dim] = node["split_val"]
+        queue.append((int(node["left_ptr"]), left_box, depth + 1))
+        queue.append((int(node["right_ptr"]), right_box, depth + 1))
+
+    return leaf_boxes
+
+
+# generates a treelet of fixed depth over all the cells of a leaf mesh
+# nodes are in breadth first order, the root's children are at 0 and 1
+# > internal nodes hold the local indices of their children
+# > leaf nodes hold the offset of their cells within the cells buffer in left_ptr
+# > parent_ptr is left as 0, the client fills in the cache slot and offsets the pointers when loaded
+def generate_treelet(mesh, box, root_depth, depth):
+    nodes = np.zeros(treelet_node_count_from_depth(depth), dtype=Tree.node_dtype)
+    # the split checks are done in double precision as in the client
+    cell_pos = mesh.positions[np.reshape(mesh.connectivity, (-1, 4))].astype(np.float64)
+
+    root_split = 0
+    next_ptr = 0
+    # (local index, cells, box) of the nodes at the current depth
+    level = [(-1, np.arange(len(cell_pos), dtype=np.uint32), box)]
+    for level_depth in range(root_depth, root_depth + depth):
+        dim = level_depth % 3
+        next_level = []
+        for index, cells, node_box in level:
+            split_val = 0.5 * (float(node_box["min"][dim]) + float(node_box["max"][dim]))
+
+            # a cell is in a child if any of its points are on that side of the split
+            cell_dim_pos = cell_pos[cells, :, dim]
+            left_cells = cells[np.any(cell_dim_pos <= split_val, axis=1)]
+            right_cells = cells[np.any(cell_dim_pos > split_val, axis=1)]
+
+            left_ptr = next_ptr
+            right_ptr = next_ptr + 1
+            next_ptr += 2
+
+            if index == -1:
+                root_split = split_val
+            else:
+                nodes[index] = (split_val, 0, 0, left_ptr, right_ptr)
+
+            left_box = copy_box(node_box)
+            left_box["max"][dim] = split_val
+            right_box = copy_box(node_box)
+            right_box["min"][dim] = split_val
+            next_level.append((left_ptr, left_cells, left_box))
+            next_level.append((right_ptr, right_cells, right_box))
+
+        level = next_level
+
+    # pack the cells of the treelet leaves
+    cells_offset = 0
+    for index, cells, _ in level:
+        nodes[index] = (0, len(cells), 0, cells_offset, 0)
+        cells_offset += len(cells)
+
+    return {
+        "nodes": nodes,
+        "cells": np.concatenate([cells for _, cells, _ in level]).astype(np.uint32),
+        "root_split": np.array([root_split], dtype=np.float32),
+    }
+
+
+# generates the treelets for all of the leaf meshes in the same order
+def generate_leaf_treelets(meshes, tree, depth):
+    leaf_boxes = get_leaf_boxes(tree)
+    treelets = []
+    for mesh in meshes:
+        box, root_depth = leaf_boxes[mesh.id]
+        treelets.append(generate_treelet(mesh, box, root_depth, depth))
+
+    return treelets
@@ -19,6 +19,13 @@
 
 import numpy as np
 
+from modules.decompose import elements_to_tets
+
+
+# the order of the vertices of a pent (pyramid) with its base first and apex last, as in cgns
+# > the base of a ugrid pyramid is 1-2-5-4 and its apex is 3
+PYRAMID_ORDER = [0, 1, 4, 3, 2]
+
 class File ():
     # num int32s in header
     __LEN_HEADER = 7
@@ -101,6 +108,15 @@ class File ():
     def get_hex_con(self):
         return self.__get_section(self.__file_ints, "hex")
 
+    # the connectivity of every volume element as tets, pyramids, prisms and hexes are split
+    def get_all_tet_con(self, verbose=False):
+        return elements_to_tets({
+            "tet": self.get_tet_con(),
+            "pyramid": np.reshape(self.get_pent_con(), (-1, 5))[:, PYRAMID_ORDER].ravel(),
+            "prism": self.get_prism_con(),
+            "hex": self.get_hex_con(),
+        }, verbose)
+
 
 
     def close(self):
@@ -4,7 +4,10 @@ import numpy as np
 
 CGNS_ELEMENT_INTS = {
     "tet": 10,
-    "tri": 5
+    "tri": 5,
+    "pyramid": 12,
+    "prism": 14,
+    "hex": 17,
 }
 
 def charcodes_to_string(charcodes):
@@ -21,6 +24,13 @@ def copy_box(box):
         "max": [box["max"][0], box["max"][1], box["max"][2]],
     }
 
+
+# name of the group holding the values of a time step
+# the first time step uses the plain name so single time step files are unchanged
+def get_time_step_name(name, t_index):
+    if t_index == 0: return name
+    return "%s_T%i" % (name, t_index)
+
 EPSILON_CELL_TEST = 0.005
 
 
@@ -0,0 +1,66 @@
+# checks that the volume elements of ugrid files are split into tets
+# run from the ingest directory with python test/test_decompose.py
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import modules.ugrid as ugrid
+from modules.decompose import decompose_to_tets
+
+
+# writes a binary ugrid file with only volume elements, connectivity is 1-based
+def write_ugrid(path, positions, tets=(), pyramids=(), prisms=(), hexes=()):
+    sections = [np.asarray(section, dtype=np.uint32).ravel() for section in (tets, pyramids, prisms, hexes)]
+    header = np.array([len(positions), 0, 0, *(len(section) for section in (tets, pyramids, prisms, hexes))], dtype=np.uint32)
+    with open(path, "wb") as file:
+        file.write(header.tobytes())
+        file.write(np.asarray(positions, dtype=np.float32).tobytes())
+        for section in sections:
+            file.write(section.tobytes())
+
+
+# six times the signed volume of each tet
+def get_volumes(positions, tets):
+    corners = positions[np.reshape(tets, (-1, 4))].astype(np.float64)
+    edges = corners[:, 1:] - corners[:, :1]
+    return np.einsum("ij,ij->i", np.cross(edges[:, 0], edges[:, 1]), edges[:, 2])
+
+
+# a single pyramid with its base 1-2-5-4 and apex 3, as in ugrid
+positions = np.array([
+    [0, 0, 0],
+    [1, 0, 0],
+    [0.5, 0.5, 1],
+    [0, 1, 0],
+    [1, 1, 0],
+], dtype=np.float32)
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    path = os.path.join(temp_dir, "pyramid.lb4")
+    write_ugrid(path, positions, pyramids=[[1, 2, 3, 4, 5]])
+    mesh_file = ugrid.File(path)
+    tets = mesh_file.get_all_tet_con() - 1
+    mesh_file.close()
+
+assert len(tets) == 2 * 4, "one pyramid should give 2 tets, got %i indices" % len(tets)
+assert np.all(np.any(np.reshape(tets, (-1, 4)) == 2, axis=1)), "every tet should use the apex"
+volumes = get_volumes(positions, tets)
+assert np.all(volumes > 0), "pyramid tets should have positive volume"
+assert np.isclose(volumes.sum() / 6, 1 / 3), "pyramid tets should fill the pyramid"
+
+# a unit cube with random orderings of its vertex indices is filled with positive tets
+cube = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0], [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1]], dtype=np.float32)
+rng = np.random.default_rng(0)
+for _ in range(100):
+    order = rng.permutation(8)
+    # vertex order[i] is at the position of corner i
+    cube_positions = np.empty_like(cube)
+    cube_positions[order] = cube
+    tets = decompose_to_tets(order, "hex")
+    volumes = get_volumes(cube_positions, tets)
+    assert np.all(volumes > 0) and np.isclose(volumes.sum() / 6, 1), "hex tets should fill the hex"
+
+print("All tests passed!")
@@ -3,17 +3,20 @@
 import { frameInfoStore, StopWatch } from "../../utils/frameInfo.js";
 import { AssociativeCache, ScoredCacheManager } from "./cache.js";
 import { getMeshExtentBox, NODE_BYTE_LENGTH, readNodeFromBuffer, writeNodeToBuffer } from "../cellTreeUtils.js";
-import { generateTreelet, InternalTreeletTopLeftPtr, InternalTreeletTopRightPtr, treeletNodeCountFromDepth } from "./treelet.js";
+import { generateTreelet, InternalTreeletTopLeftPtr, InternalTreeletTopRightPtr, offsetTreelet, treeletNodeCountFromDepth } from "./treelet.js";
 
 // implements a cache object for storing mesh data in block format
 export class MeshCache {
     #cache;
     #treeletDepth;
+    // if the treelets are requested from the server rather than generated
+    #precomputedTreelets;
 
     #treeletNodesPerSlot;
 
-    constructor(blockSizes, blockCount, treeletDepth = 4) {
+    constructor(blockSizes, blockCount, treeletDepth = 4, precomputedTreelets = false) {
         this.#treeletDepth = treeletDepth;
+        this.#precomputedTreelets = treeletDepth > 0 && precomputedTreelets;
         const cacheObj = new AssociativeCache(blockCount);
     
         // mesh buffers
@@ -55,15 +58,20 @@ export class MeshCache {
         for (let [fullPtr, node] of nodesToRequest) {
             const nodePtrOffset = nodeBufferCount + node.meshCacheSlot * this.#treeletNodesPerSlot;
 
-            const treelet = generateTreelet(
-                meshData[fullPtr], 
-                node.fullCellCount, 
-                node.box, 
-                node.depth, 
-                this.#treeletDepth, 
-                nodePtrOffset, 
-                node.meshCacheSlot
-            );
+            let treelet;
+            if (this.#precomputedTreelets) {
+                treelet = offsetTreelet(meshData[fullPtr], nodePtrOffset, node.meshCacheSlot);
+            } else {
+                treelet = generateTreelet(
+                    meshData[fullPtr], 
+                    node.fullCellCount, 
+                    node.box, 
+                    node.depth, 
+                    this.#treeletDepth, 
+                    nodePtrOffset, 
+                    node.meshCacheSlot
+                );
+            }
 
             this.#cache.updateBlockAt(node.meshCacheSlot, {
                 ...(meshData[fullPtr]),
@@ -124,7 +132,7 @@ export class MeshCache {
      * Updates the dynamic mesh cache to contain the mesh corresponding to the true leaf nodes with the highest scores
      * @param {AssociativeCache} nodeCache 
      * @param {ArrayBuffer} renderNodes 
-     * @param {(ptrList : Number[], geometry : Boolean, scalarList : String[])=>Promise<Map<Number,Object>>} getMeshBlocksFunc 
+     * @param {(ptrList : Number[], geometry : Boolean, scalarList : String[], time : Number, treelets : Boolean)=>Promise<Map<Number,Object>>} getMeshBlocksFunc 
      * @param {ArrayBuffer} fullNodes 
      * @param {Object[]} scores A list of leaf nodes within the dynamic tree
      * @param {String[]} scalarNames 
@@ -155,6 +163,9 @@ export class MeshCache {
             if (fullNode.rightPtr != 0) continue;
             // this is a true leaf
 
+            // a block with no cells would be linked as a pruned leaf, so there is nothing to request
+            if (fullNode.cellCount == 0) continue;
+
             if (
                 this.#treeletDepth > 0 && node.rightPtr > 0 || 
                 this.#treeletDepth == 0 && node.cellCount > 0
@@ -221,7 +232,9 @@ export class MeshCache {
             // debugger;
             if (sw) sw.stop();
             const reqSW = new StopWatch()
-            const meshData = await getMeshBlocksFunc(Array.from(nodesToRequest.keys()), true, scalarNames);
+            const meshData = await getMeshBlocksFunc(
+                Array.from(nodesToRequest.keys()), true, scalarNames, undefined, this.#precomputedTreelets
+            );
             frameInfoStore.add("new_blocks", nodesToRequest.size);
             frameInfoStore.add("server", reqSW.stop());
             if (sw) sw.start();
@@ -2,7 +2,7 @@
 // handles the generation of treelets
 
 import { copyBox } from "../../utils/boxUtils.js";
-import { checkCellPosition, NODE_BYTE_LENGTH, writeNodeToBuffer } from "../cellTreeUtils.js";
+import { checkCellPosition, NODE_BYTE_LENGTH, readNodeFromBuffer, writeNodeToBuffer } from "../cellTreeUtils.js";
 
 // where the top left and right nodes will be written inside every treelet
 export const InternalTreeletTopLeftPtr = 0;
@@ -151,4 +151,42 @@ export function generateTreelet(mesh, cellCount, box, treeletRootDepth, treeletD
         cells: cellsBuff,
         rootSplitVal
     }
-}
\ No newline at end of file
+}
+
+
+// prepares a treelet generated at ingest for a cache slot
+// the pointers in precomputed treelets are local, offset them as generateTreelet would and write the slot number
+// returns the nodes and cells buffers for this treelet
+export function offsetTreelet(meshData, nodePtrOffset, slotNum) {
+    // copy so the response buffer is not modified
+    const nodesBuff = meshData.treeletNodes.slice().buffer;
+    const nodeCount = nodesBuff.byteLength/NODE_BYTE_LENGTH;
+
+    let cellCount = 0;
+    for (let i = 0; i < nodeCount; i++) {
+        const node = readNodeFromBuffer(nodesBuff, i * NODE_BYTE_LENGTH);
+        if (node.rightPtr != 0) {
+            // internal node
+            writeNodeToBuffer(
+                nodesBuff, 
+                i * NODE_BYTE_LENGTH, 
+                null, 
+                null, 
+                slotNum, 
+                node.leftPtr + nodePtrOffset, 
+                node.rightPtr + nodePtrOffset
+            );
+        } else {
+            // leaf node, leftPtr is already the location within this slot
+            writeNodeToBuffer(nodesBuff, i * NODE_BYTE_LENGTH, null, null, slotNum, null, null);
+            cellCount = Math.max(cellCount, node.leftPtr + node.cellCount);
+        }
+    }
+
+    return {
+        nodes: nodesBuff,
+        // the cells are padded to the largest treelet in the response
+        cells: meshData.treeletCells.slice(0, cellCount),
+        rootSplitVal: meshData.treeletRootSplit[0]
+    }
+}
@@ -22,6 +22,13 @@ export const DataModifiers = {
     DERIVATIVE_Z: "derivative z",
 };
 
+// how the geometry of mesh blocks is sent by the server
+export const GeometryEncodings = {
+    FLOAT:     "float",     // full precision positions and 32 bit connectivity
+    QUANTISED: "quantised", // 16 bit positions within each block's box, 16 bit connectivity if it fits
+    VARINT:    "varint",    // 16 bit positions and delta coded varint connectivity
+};
+
 // these act as bit masks to create the full resolution mode
 export const ResolutionModes = {
     FULL:              0b00, // resolution is fixed at the maximum 
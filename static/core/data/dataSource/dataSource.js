@@ -3,10 +3,11 @@
 import {mat4} from "../../utils/gl-matrix.js";
 import { FetchSocket } from "../../utils/fetchSocket.js";
 import * as cgns from "./cgns/cgns_hdf5.js";
-import { DataFormats, DataArrayTypes } from "../dataConstants.js";
+import { DataFormats, DataArrayTypes, GeometryEncodings } from "../dataConstants.js";
 import { buildUnstructuredTree, getLeafMeshBuffers, getLeafMeshBuffersAnalyse, loadUnstructuredTree, UnstructuredTree } from "../cellTree.js";
 import { CornerValTypes, createNodeCornerValuesBuffer, loadCornerValues } from "../treeNodeValues.js";
-import { processLeafMeshDataInfo } from "../cellTreeUtils.js";
+import { NODE_BYTE_LENGTH, processLeafMeshDataInfo } from "../cellTreeUtils.js";
+import { treeletNodeCountFromDepth } from "../cache/treelet.js";
 
 const DATA_TYPES = {
     "uint8": Uint8Array,
@@ -20,6 +21,59 @@ const DATA_TYPES = {
 
 const DEFAULT_ARRAY_NAME = "Default";
 
+// largest quantised position value
+const QUANT_MAX = 2**16 - 1;
+
+// the length of a section of the block response, which are padded to 4 bytes in the compact encodings
+const padToWord = (byteLength) => Math.ceil(byteLength/4) * 4;
+
+// converts 16 bit positions back to floats within the box [min x, min y, min z, max x, max y, max z]
+const dequantisePositions = (quantised, box) => {
+    const positions = new Float32Array(quantised.length);
+    for (let i = 0; i < quantised.length; i++) {
+        const dim = i % 3;
+        positions[i] = box[dim] + quantised[i] * (box[dim + 3] - box[dim]) / QUANT_MAX;
+    }
+    return positions;
+};
+
+// decodes zigzagged, delta coded varints into out
+// returns the number of values decoded
+const decodeDeltaVarints = (bytes, out) => {
+    let value = 0;
+    let shift = 0;
+    let prev = 0;
+    let count = 0;
+    for (let i = 0; i < bytes.length; i++) {
+        // avoid bit operators, which are limited to 32 bits
+        value += (bytes[i] & 0x7f) * 2**shift;
+        shift += 7;
+        if (bytes[i] & 0x80) continue;
+
+        prev += value % 2 == 0 ? value / 2 : -(value + 1) / 2;
+        out[count++] = prev;
+        value = 0;
+        shift = 0;
+    }
+    return count;
+};
+
+// the name of the array or group that holds the values of a time step
+// the first time step uses the plain name
+const getTimeStepName = (name, tIndex) => {
+    if (0 == tIndex) return name;
+    return `${name}_T${tIndex}`;
+};
+
+// expands a requested time index or [start, end) range into a list of time steps
+const getTimeStepList = (time) => {
+    if (time === undefined) return [0];
+    if (!Array.isArray(time)) return [time];
+    const timeSteps = [];
+    for (let t = time[0]; t < time[1]; t++) timeSteps.push(t);
+    return timeSteps;
+};
+
 
 // base data sources
 
@@ -305,9 +359,26 @@ export class PartialCGNSDataSource extends EmptyDataSource {
     maxCellCount;
     maxVertCount;
 
+    #nodeZone;
     #cornerFlowSolution;
-    #flowSolutionLimits;
-    #flowSolutionRanges;
+
+    // the time steps that have values available
+    timeSteps = [0];
+
+    // the depth and max cell count of the treelets precomputed for the blocks, if any
+    treeletDepth = 0;
+    maxTreeletCellCount = 0;
+
+    // the internal nodes that have simplified meshes that can be requested like leaf blocks
+    lodNodes = new Set();
+
+    // the encoding the block geometry is requested in, the compact encodings need quantised data from ingest
+    geometryEncoding = GeometryEncodings.FLOAT;
+
+    // the tight box of the cells within each node as min xyz, max xyz and whether it has any cells
+    // only present if generated at ingest
+    nodeBounds;
+    nodeOccupancy;
 
     // all cells are tetrahedra
     vertsPerCell = 4;
@@ -372,23 +443,47 @@ export class PartialCGNSDataSource extends EmptyDataSource {
 
         if ("Sample" == cornTypeStr) {
             this.cornerValType = CornerValTypes.SAMPLE;
+        } else if ("Polynomial" == cornTypeStr) {
+            this.cornerValType = CornerValTypes.POLYNOMIAL;
         } else {
             console.warn(`Unsupported corner value type found: ${cornTypeStr}`);
         }
 
         // get the corner value flow solutions
+        this.#nodeZone = CGNSZoneNode;
         this.#cornerFlowSolution = CGNSZoneNode.get("FlowSolution");
-        // ...and limits
-        this.#flowSolutionLimits = CGNSZoneNode.get("FlowSolutionLimits");
-        // ...and ranges
-        this.#flowSolutionRanges = CGNSZoneNode.get("FlowSolutionRanges");
 
 
+        // get the time steps available, older files only have one
+        const timeStepsBuff = CGNSZoneNode.get("TimeSteps/ data")?.value;
+        if (timeStepsBuff) this.timeSteps = Array.from(timeStepsBuff);
+
         // extract leaf mesh max vert and cell info
         const primCountBuff = CGNSZoneNode.get("MaxPrimitives/ data").value;
         this.maxCellCount = primCountBuff[0];
         this.maxVertCount = primCountBuff[1];
 
+        // get the precomputed treelet info, only present if generated at ingest
+        const treeletInfoBuff = CGNSZoneNode.get("TreeletInfo/ data")?.value;
+        if (treeletInfoBuff) {
+            this.treeletDepth = treeletInfoBuff[0];
+            this.maxTreeletCellCount = treeletInfoBuff[1];
+        }
+
+        // get the internal nodes with simplified meshes, these fit in the same block sizes as the leaves
+        const lodNodesBuff = CGNSZoneNode.get("LodNodes/ data")?.value;
+        if (lodNodesBuff) this.lodNodes = new Set(lodNodesBuff);
+
+        // get the boxes of the cells within the nodes, these are culled and scored by their contents
+        const nodeBoundsBuff = CGNSZoneNode.get("NodeBounds/ data")?.value;
+        if (nodeBoundsBuff) {
+            this.nodeBounds = nodeBoundsBuff;
+            this.nodeOccupancy = CGNSZoneNode.get("NodeOccupancy/ data").value;
+        }
+
+        // use the quantised geometry if it was generated at ingest, roughly halving the geometry transferred
+        if (CGNSZoneNode.get("QuantisationBits/ data")) this.geometryEncoding = GeometryEncodings.QUANTISED;
+
         // convert to block sizes
         this.meshBlockSizes = {
             positions: this.maxVertCount * 3,
@@ -398,15 +493,32 @@ export class PartialCGNSDataSource extends EmptyDataSource {
         };
     }
 
+    // the tight box of the cells within a node of the full tree
+    // returns null if the node has no cells and undefined if the boxes weren't generated
+    getNodeBounds(fullPtr) {
+        if (!this.nodeBounds) return;
+        if (!this.nodeOccupancy[fullPtr]) return null;
+        const offset = fullPtr * 6;
+        return {
+            min: Array.from(this.nodeBounds.subarray(offset, offset + 3)),
+            max: Array.from(this.nodeBounds.subarray(offset + 3, offset + 6)),
+        };
+    }
+
     // takes the monolithic buffer returned by the server and splits it
     // returns an object with geometry and scala buffers broken out
-    parseRespBuffer(buff, parsed, indices, geometry, scalarNames) {
+    // scalars of time steps other than the first are named as in the file e.g. Density_T3
+    parseRespBuffer(buff, parsed, indices, geometry, scalarNames, timeSteps = [0], treelets = false) {
+        const treeletNodeBytes = treeletNodeCountFromDepth(this.treeletDepth) * NODE_BYTE_LENGTH;
+
         let bytesExpected = 0;
         if (geometry) {
-            bytesExpected += indices.length * this.maxVertCount * 3 * 4;
-            bytesExpected += indices.length * this.maxCellCount * this.vertsPerCell * 4;
+            bytesExpected += this.#getGeometryByteLength(buff, indices.length);
+        }
+        if (treelets) {
+            bytesExpected += indices.length * (treeletNodeBytes + 4 + this.maxTreeletCellCount * 4);
         }
-        bytesExpected += indices.length * this.maxVertCount * scalarNames.length * 4;
+        bytesExpected += indices.length * this.maxVertCount * scalarNames.length * timeSteps.length * 4;
 
         const bytesDiff = bytesExpected - buff.byteLength;
         if (bytesDiff !== 0) {
@@ -437,24 +549,105 @@ export class PartialCGNSDataSource extends EmptyDataSource {
         }
 
         // split the buffer into the different semantic parts
-        if (geometry) {
+        if (geometry && GeometryEncodings.FLOAT == this.geometryEncoding) {
             // extract vertex positions and connectivity
             extractSection("positions", Float32Array, this.maxVertCount * 3);
             extractSection("cellConnectivity", Uint32Array, this.maxCellCount * this.vertsPerCell);
+        } else if (geometry) {
+            // decode the compact geometry into the same buffers
+            byteOffset = this.#decodeCompactGeometry(buff, parsed, indices);
+        }
+
+        if (treelets) {
+            // extract the precomputed treelets, the pointers are local to each treelet
+            extractSection("treeletNodes", Uint8Array, treeletNodeBytes);
+            extractSection("treeletRootSplit", Float32Array, 1);
+            extractSection("treeletCells", Uint32Array, this.maxTreeletCellCount);
         }
 
-        for (let i = 0; i < scalarNames.length; i++) {
-            extractSection(scalarNames[i], Float32Array, this.maxVertCount);
+        for (let tIndex of timeSteps) {
+            for (let i = 0; i < scalarNames.length; i++) {
+                extractSection(getTimeStepName(scalarNames[i], tIndex), Float32Array, this.maxVertCount);
+            }
         }
 
         return parsed;
     }
 
+    // the length of the geometry of blockCount blocks in the response
+    // varint connectivity varies in length, so the lengths sent before it are read from the response
+    #getGeometryByteLength(buff, blockCount) {
+        const conLength = this.maxCellCount * this.vertsPerCell;
+        if (GeometryEncodings.FLOAT == this.geometryEncoding) {
+            return blockCount * (this.maxVertCount * 3 * 4 + conLength * 4);
+        }
+
+        const posByteLength = blockCount * 6 * 4 + padToWord(blockCount * this.maxVertCount * 3 * 2);
+        if (GeometryEncodings.VARINT == this.geometryEncoding) {
+            const varintLengths = new Uint32Array(buff, posByteLength, blockCount);
+            return posByteLength + blockCount * 4 + padToWord(varintLengths.reduce((a, b) => a + b, 0));
+        }
+
+        const conBytes = this.maxVertCount <= QUANT_MAX ? 2 : 4;
+        return posByteLength + padToWord(blockCount * conLength * conBytes);
+    }
+
+    // decodes the quantised positions and compact connectivity at the start of the response
+    // the blocks are given full precision positions and 0-based 32 bit connectivity as with the float encoding
+    // returns the byte offset of the end of the geometry
+    #decodeCompactGeometry(buff, parsed, indices) {
+        const posLength = this.maxVertCount * 3;
+        const conLength = this.maxCellCount * this.vertsPerCell;
+
+        let byteOffset = 0;
+        const boxes = new Float32Array(buff, byteOffset, indices.length * 6);
+        byteOffset += boxes.byteLength;
+        const quantised = new Uint16Array(buff, byteOffset, indices.length * posLength);
+        byteOffset += padToWord(quantised.byteLength);
+
+        for (let i = 0; i < indices.length; i++) {
+            parsed[indices[i]].positions = dequantisePositions(
+                quantised.subarray(i * posLength, (i + 1) * posLength),
+                boxes.subarray(i * 6, (i + 1) * 6)
+            );
+        }
+
+        if (GeometryEncodings.VARINT == this.geometryEncoding) {
+            const varintLengths = new Uint32Array(buff, byteOffset, indices.length);
+            byteOffset += varintLengths.byteLength;
+            const varintStart = byteOffset;
+            for (let i = 0; i < indices.length; i++) {
+                const conn = new Uint32Array(conLength);
+                decodeDeltaVarints(new Uint8Array(buff, byteOffset, varintLengths[i]), conn);
+                parsed[indices[i]].cellConnectivity = conn;
+                byteOffset += varintLengths[i];
+            }
+            return varintStart + padToWord(byteOffset - varintStart);
+        }
+
+        // take 1 from every entry to go from 1-based -> 0-based
+        const ConType = this.maxVertCount <= QUANT_MAX ? Uint16Array : Uint32Array;
+        const compactConn = new ConType(buff, byteOffset, indices.length * conLength);
+        for (let i = 0; i < indices.length; i++) {
+            const conn = new Uint32Array(conLength);
+            for (let j = 0; j < conLength; j++) {
+                conn[j] = compactConn[i * conLength + j] - 1;
+            }
+            parsed[indices[i]].cellConnectivity = conn;
+        }
+        return byteOffset + padToWord(compactConn.byteLength);
+    }
+
     // requests the mesh block from the server with this node index
     // waits for the response from the server
     // can return the geometry (vert positions, connectivity)
     // returns the vert-centred data with the supplied identifiers
-    async getMeshBlocks(indices, geometry, scalarNames) {
+    // time is an optional time index or [start, end) range, only the first time step is returned if not given
+    // > when scrubbing through time, only the scalars need to be requested as the geometry is the same
+    // can return the precomputed treelets if the dataset has them
+    // iso is an optional object of scalar name -> value or [min, max] interval, blocks that can't contain these
+    // are skipped by the server and returned as {empty: true}
+    async getMeshBlocks(indices, geometry, scalarNames, time, treelets, iso) {
         // debugger;
         let parsed = {};
         const reqCount = Math.ceil(indices.length/this.#maxBlocksPerRequest);
@@ -469,13 +662,28 @@ export class PartialCGNSDataSource extends EmptyDataSource {
                 geometry: !!geometry,
                 scalars: scalarNames ?? []
             }
+            if (time !== undefined) request.time = time;
+            if (treelets) request.treelets = true;
+            if (geometry && GeometryEncodings.FLOAT != this.geometryEncoding) request.encoding = this.geometryEncoding;
+            if (iso) request.iso = iso;
     
             // send the request
             const resp = await this.#socket.fetch(JSON.stringify(request));
-            const buff = await resp.arrayBuffer();
+            let buff = await resp.arrayBuffer();
             // console.log(buff);
 
-            this.parseRespBuffer(buff, parsed, thisIndices, geometry, scalarNames);
+            let includedIndices = thisIndices;
+            if (iso) {
+                // the response starts with a flag for each requested block, only those included follow
+                const mask = new Uint32Array(buff, 0, thisIndices.length);
+                includedIndices = thisIndices.filter((index, j) => mask[j]);
+                for (let j = 0; j < thisIndices.length; j++) {
+                    if (!mask[j]) parsed[thisIndices[j]] = {empty: true};
+                }
+                buff = buff.slice(mask.byteLength);
+            }
+
+            this.parseRespBuffer(buff, parsed, includedIndices, geometry, scalarNames ?? [], getTimeStepList(time), !!treelets);
         }
 
         // pull out the different buffers
@@ -483,6 +691,68 @@ export class PartialCGNSDataSource extends EmptyDataSource {
         return parsed;
     }
 
+    // finds which of the blocks with these node indices can contain the iso values, without fetching them
+    // iso is an object of scalar name -> value or [min, max] interval, time is as for getMeshBlocks
+    // returns a flag for each block, 0 if none of its values in any of the time steps span every interval
+    async getBlockIsoMask(indices, iso, time) {
+        const request = {
+            mode: "isofilter",
+            path: this.meshPath,
+            blocks: indices,
+            iso: iso
+        };
+        if (time !== undefined) request.time = time;
+
+        const resp = await this.#socket.fetch(JSON.stringify(request));
+        return new Uint32Array(await resp.arrayBuffer());
+    }
+
+    // requests the index of the blocks with these node indices, or of every stored block if not given
+    // returns the vertex and cell counts of each block, the byte lengths of its positions, connectivity and
+    // each scalar in the current geometry encoding and the [min, max] of the supplied scalars in each time step
+    // > this is small enough to plan requests against a bandwidth budget and skip blocks that can't contribute
+    async getMeshInfo(indices, scalarNames, time) {
+        const request = {
+            mode: "meshinfo",
+            path: this.meshPath,
+            scalars: scalarNames ?? []
+        };
+        if (indices !== undefined) request.blocks = indices;
+        if (time !== undefined) request.time = time;
+        if (GeometryEncodings.FLOAT != this.geometryEncoding) request.encoding = this.geometryEncoding;
+
+        const resp = await this.#socket.fetch(JSON.stringify(request));
+        const buff = await resp.arrayBuffer();
+
+        const blockCount = new Uint32Array(buff, 0, 1)[0];
+        let byteOffset = 4;
+        const extract = (type, elementCount) => {
+            const arr = new type(buff, byteOffset, elementCount);
+            byteOffset += arr.byteLength;
+            return arr;
+        };
+
+        const info = {
+            nodes: extract(Uint32Array, blockCount),
+            vertCounts: extract(Uint32Array, blockCount),
+            cellCounts: extract(Uint32Array, blockCount),
+            // positions, connectivity and scalar byte lengths of each block
+            fieldByteLengths: extract(Uint32Array, blockCount * 3),
+            ranges: {},
+        };
+        for (let tIndex of getTimeStepList(time)) {
+            for (let name of scalarNames ?? []) {
+                info.ranges[getTimeStepName(name, tIndex)] = extract(Float32Array, blockCount * 2);
+            }
+        }
+
+        if (byteOffset != buff.byteLength) {
+            throw Error("Could not extract mesh info from received buffer; Bytes Difference: " + (byteOffset - buff.byteLength));
+        }
+
+        return info;
+    }
+
     getAvailableDataArrays() {
         const dataNodes = cgns.getChildrenWithLabel(this.#cornerFlowSolution, "DataArray_t");
 
@@ -492,13 +762,20 @@ export class PartialCGNSDataSource extends EmptyDataSource {
     }
 
     // returns only the corner value buffer for this data array name
+    // desc.timeStep optionally selects the time step to use
     getDataArray(desc) {
-        if (this.#valuesCache[desc.name]) return this.#valuesCache[desc.name];
+        const tIndex = desc.timeStep ?? 0;
+        const cacheName = getTimeStepName(desc.name, tIndex);
+        if (this.#valuesCache[cacheName]) return this.#valuesCache[cacheName];
 
-        const data = this.#cornerFlowSolution.get(desc.name + "/ data")?.value;
+        const cornerFlowSolution = this.#nodeZone.get(getTimeStepName("FlowSolution", tIndex));
+        const flowSolutionLimits = this.#nodeZone.get(getTimeStepName("FlowSolutionLimits", tIndex));
+        const flowSolutionRanges = this.#nodeZone.get(getTimeStepName("FlowSolutionRanges", tIndex));
+
+        const data = cornerFlowSolution?.get(desc.name + "/ data")?.value;
         if (!data) return;
-        const limits = this.#flowSolutionLimits?.get(desc.name + "/ data")?.value;
-        const ranges = this.#flowSolutionRanges?.get(desc.name + "/ data")?.value;
+        const limits = flowSolutionLimits?.get(desc.name + "/ data")?.value;
+        const ranges = flowSolutionRanges?.get(desc.name + "/ data")?.value;
 
         const result = {
             name: desc.name,
@@ -507,7 +784,7 @@ export class PartialCGNSDataSource extends EmptyDataSource {
             ranges,
         };
 
-        this.#valuesCache[desc.name] = result;
+        this.#valuesCache[cacheName] = result;
         return result;
     }
 }
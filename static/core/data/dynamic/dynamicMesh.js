@@ -22,7 +22,14 @@ export class DynamicMesh {
         this.treeletDepth = treeletDepth;
         this.usesTreelets = treeletDepth > 0;
 
-        this.#meshCache = new MeshCache(this.#dataSource.meshBlockSizes, leafBlockCount, this.treeletDepth);
+        // use the treelets generated at ingest if they have the depth wanted
+        const precomputedTreelets = this.usesTreelets && this.#dataSource.treeletDepth == treeletDepth;
+        this.#meshCache = new MeshCache(
+            this.#dataSource.meshBlockSizes, 
+            leafBlockCount, 
+            this.treeletDepth, 
+            precomputedTreelets
+        );
     }
     // run when a new data array is selected
     // creates a version of the dynamic mesh value array with the same blocks loaded in the same positions as the
@@ -180,7 +180,9 @@ export class NodeScorer {
 
             if (isDynamicLeaf(currNode, nodeCount)) {
                 // this is a leaf node, get its score
-                currNode.score = scoreFn(currBox, currNode.thisFullPtr);
+                // score the box of the cells within it if known, nodes with no cells are never worth loading
+                const cellsBox = this.#dataSource.getNodeBounds?.(currNode.thisFullPtr ?? 0);
+                currNode.score = null === cellsBox ? 0 : scoreFn(cellsBox ?? currBox, currNode.thisFullPtr);
                 currNode.state = nodeCache.readBuffSlotAt("state", currNode.thisPtr)[0];
                 scores.push(currNode);
             } else {